@@ -0,0 +1,450 @@
+"""
+Alternative server engine, selected with "server_engine": "asyncio".
+
+Instead of one thread per connection, every connection is handled by a single event
+loop running in one thread. Database lookups are pushed to a small, fixed thread pool
+and files are streamed with loop.sendfile(), so the loop itself never blocks on them.
+It serves the same routes as LocalAudioHandler.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import email.utils
+import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, closing
+from email.parser import Parser
+from http import HTTPStatus
+from http.client import HTTPMessage
+from pathlib import Path
+from typing import Optional
+
+from .config import SERVER_CONFIG
+from .db_utils import read_android_audio
+from .http_util import SUFFIX_TO_MIME_TYPE, audio_response_head
+from .lookup import parse_query_components
+from .server_logging import logger, log_access
+from .metrics import RequestTrace, get_request_id
+from .server import (
+    BATCH_MAX_BODY_SIZE,
+    AndroidAudio,
+    ServerState,
+    get_metrics_payload,
+    handle_post_request,
+    match_route,
+    get_version_payload,
+    open_audio_file,
+)
+from .source.audio_source import SERVE_FROM_ANDROID_DB
+
+# same limit as http.server
+MAX_HEADERS = 100
+
+
+class BadRequest(Exception):
+    pass
+
+
+class AsyncRequestHandler:
+    """
+    Handles all requests of a single connection, mirroring LocalAudioHandler.
+    """
+
+    server_version = "LocalAudioAsync"
+
+    def __init__(self, server: AsyncLocalAudioServer, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.timeout = SERVER_CONFIG["keepalive_timeout"]
+        self.max_keepalive_requests = SERVER_CONFIG["keepalive_max_requests"]
+        self.server_timing = SERVER_CONFIG["server_timing"]
+
+        self.responses_on_connection = 0
+        self.trace = RequestTrace()
+        self.request_id: Optional[str] = None
+        self.close_connection = True
+        self.command = ""
+        self.path = ""
+        self.headers = HTTPMessage()
+        # None if the request has a body that was too large to read
+        self.body: Optional[bytes] = b""
+
+    async def handle(self):
+        try:
+            while True:
+                if not await self.handle_one_request() or self.close_connection:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception:
+            logger.exception("Error while handling a connection")
+        finally:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except Exception:
+                pass
+
+    async def readline(self) -> bytes:
+        try:
+            return await asyncio.wait_for(self.reader.readline(), self.timeout)
+        except ValueError as e: # line is longer than the stream's limit
+            raise BadRequest("Line too long") from e
+
+    async def parse_request(self) -> bool:
+        """
+        reads the request line and headers. Returns False if the client closed the connection
+        """
+        request_line = await self.readline()
+        if not request_line:
+            return False
+        # starts timing once the request line has arrived, instead of while waiting on an idle connection
+        self.trace.start = time.perf_counter()
+
+        words = request_line.decode("iso-8859-1").rstrip("\r\n").split()
+        if len(words) != 3 or not words[2].startswith("HTTP/"):
+            raise BadRequest(f"Bad request line: {request_line!r}")
+        self.command, self.path, version = words
+
+        header_lines = []
+        while True:
+            line = await self.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            header_lines.append(line.decode("iso-8859-1"))
+            if len(header_lines) > MAX_HEADERS:
+                raise BadRequest("Too many headers")
+        self.headers = Parser(_class=HTTPMessage).parsestr("".join(header_lines))
+
+        connection_type = self.headers.get("Connection", "").lower()
+        if version == "HTTP/1.0":
+            self.close_connection = connection_type != "keep-alive"
+        else:
+            self.close_connection = connection_type == "close"
+
+        try:
+            content_length = int(self.headers.get("Content-Length", 0) or 0)
+        except ValueError as e:
+            raise BadRequest("Invalid Content-Length") from e
+        if content_length < 0:
+            raise BadRequest("Invalid Content-Length")
+
+        # the body must be consumed even if it isn't used (i.e. for GET), to keep the connection usable
+        self.body = b""
+        if content_length > BATCH_MAX_BODY_SIZE:
+            self.body = None
+            self.close_connection = True
+        elif content_length > 0:
+            self.body = await asyncio.wait_for(self.reader.readexactly(content_length), self.timeout)
+        return True
+
+    async def handle_one_request(self) -> bool:
+        self.trace = RequestTrace()
+        self.request_id = None
+        self.headers = HTTPMessage()
+        self.response_status = None
+        # the number of results (or the lookup response to count them from) for the access log
+        self.log_results = None
+        try:
+            if not await self.parse_request():
+                return False
+        except BadRequest as e:
+            logger.warning("%s", e)
+            self.close_connection = True
+            await self.send_cors_response(400)
+            return False
+
+        if self.command in ("GET", "HEAD"):
+            with self.server.state.prefetcher.interactive():
+                await self.do_GET()
+        elif self.command == "POST":
+            await self.do_POST()
+        else:
+            # like send_error() in the threading engine
+            self.close_connection = True
+            await self.send_cors_response(HTTPStatus.NOT_IMPLEMENTED)
+
+        if self.response_status is not None:
+            self.server.state.metrics.observe_request(self.trace, self.response_status)
+            log_access(
+                self.command, self.path, self.response_status, self.log_results, self.trace.elapsed(),
+                self.request_id,
+            )
+        return True
+
+    async def send_head(self, status: int, headers: list[tuple[str, str]]):
+        self.response_status = status
+        self.responses_on_connection += 1
+        if self.responses_on_connection >= self.max_keepalive_requests:
+            self.close_connection = True
+        if self.close_connection:
+            headers = headers + [("Connection", "close")]
+        if self.server_timing:
+            self.request_id = get_request_id(self.headers.get("X-Request-ID"))
+            headers = headers + [
+                ("X-Request-ID", self.request_id),
+                ("Server-Timing", self.trace.server_timing()),
+                ("Timing-Allow-Origin", "*"),
+                ("Access-Control-Expose-Headers", "X-Request-ID, Server-Timing"),
+            ]
+
+        status = HTTPStatus(status)
+        lines = [
+            f"HTTP/1.1 {status.value} {status.phrase}",
+            f"Server: {self.server_version}",
+            f"Date: {email.utils.formatdate(usegmt=True)}",
+        ]
+        lines += [f"{keyword}: {value}" for keyword, value in headers]
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1", "strict"))
+        await self.drain()
+
+    async def drain(self):
+        await asyncio.wait_for(self.writer.drain(), self.timeout)
+
+    async def send_cors_response(self, code: int):
+        await self.send_head(code, [("Access-Control-Allow-Origin", "*"), ("Content-Length", "0")])
+
+    async def send_payload(self, payload: bytes, content_type: str, status: int = HTTPStatus.OK):
+        headers = [
+            ("Content-type", content_type),
+            ("Content-Length", str(len(payload))),
+            ("Access-Control-Allow-Origin", "*"),
+        ]
+        await self.send_head(status, headers)
+        if self.command != "HEAD":
+            with self.trace.time("write"):
+                self.writer.write(payload)
+                await self.drain()
+
+    async def get_audio(self, media_dir, file_path):
+        audio_file = media_dir.joinpath(file_path)
+
+        mime_type = SUFFIX_TO_MIME_TYPE.get(audio_file.suffix.lower(), None)
+        if mime_type is None:
+            await self.send_cors_response(400)
+            return
+
+        loop = asyncio.get_running_loop()
+        state = self.server.state
+        trace = self.trace
+        if state.audio_cache.enabled:
+            with trace.time("open"):
+                cached = await loop.run_in_executor(self.server.executor, state.get_cached_audio, audio_file)
+            if cached is not None:
+                trace.cache = "hit"
+                data, file_stat = cached
+                body = await self.send_audio_head(mime_type, file_stat.st_size, file_stat.st_mtime_ns)
+                if body is not None:
+                    offset, count = body
+                    with trace.time("send"):
+                        self.writer.write(memoryview(data)[offset:offset + count])
+                        await self.drain()
+                return
+
+        with trace.time("open"):
+            opened = await loop.run_in_executor(self.server.executor, open_audio_file, audio_file)
+        if opened is None:
+            await self.send_cors_response(400)
+            return
+
+        fh, file_stat = opened
+        with fh:
+            body = await self.send_audio_head(mime_type, file_stat.st_size, file_stat.st_mtime_ns)
+            if body is not None:
+                offset, count = body
+                if count > 0:
+                    # uses os.sendfile() where possible, and falls back to chunked reads otherwise
+                    with trace.time("send"):
+                        await loop.sendfile(self.writer.transport, fh, offset, count)
+
+    async def get_android_audio(self, source_id: str, file_path: str):
+        """
+        same as LocalAudioHandler.get_android_audio(), with every database read on the executor
+        """
+        mime_type = SUFFIX_TO_MIME_TYPE.get(Path(file_path).suffix.lower(), None)
+        if mime_type is None:
+            await self.send_cors_response(400)
+            return
+
+        loop = asyncio.get_running_loop()
+        executor = self.server.executor
+        state = self.server.state
+        trace = self.trace
+        # the pooled connection (and the open blob) are released once the response is sent
+        with ExitStack() as stack:
+
+            def open_audio() -> tuple[Optional[sqlite3.Connection], Optional[AndroidAudio]]:
+                connection = stack.enter_context(state.android_db_connection())
+                if connection is None:
+                    return None, None
+                return connection, state.open_android_audio(connection, source_id, file_path)
+
+            with trace.time("open"):
+                connection, audio = await loop.run_in_executor(executor, open_audio)
+            if audio is None:
+                await self.send_cors_response(400)
+                return
+
+            if audio.data is not None:
+                trace.cache = "hit"
+            body = await self.send_audio_head(mime_type, audio.size, audio.mtime_ns)
+            if body is None:
+                return
+            offset, count = body
+            with trace.time("send"):
+                if audio.data is not None:
+                    self.writer.write(memoryview(audio.data)[offset:offset + count])
+                    await self.drain()
+                    return
+                chunks = stack.enter_context(closing(read_android_audio(connection, audio.rowid, offset, count)))
+                while (chunk := await loop.run_in_executor(executor, next, chunks, None)) is not None:
+                    self.writer.write(chunk)
+                    await self.drain()
+
+    async def send_audio_head(self, mime_type: str, size: int, mtime_ns: int) -> Optional[tuple[int, int]]:
+        """
+        same as LocalAudioHandler.send_audio_headers()
+        """
+        head = audio_response_head(self.headers, mime_type, size, mtime_ns, self.command == "HEAD")
+        await self.send_head(head.status, head.headers)
+        return head.body
+
+    async def do_GET(self):
+        trace = self.trace
+        with trace.time("parse"):
+            route, audio_source, file_path = match_route(self.path)
+        trace.route = route
+
+        if route == "version":
+            await self.send_payload(get_version_payload(), "text/plain; charset=UTF-8")
+            return
+
+        if route == "favicon":
+            # skip entirely
+            await self.send_cors_response(400)
+            return
+
+        if route == "metrics":
+            payload, content_type = get_metrics_payload(self.server.state, self.path)
+            await self.send_payload(payload, content_type)
+            return
+
+        if route == "audio":
+            trace.source = audio_source.data.id
+            if audio_source.data.serve_from == SERVE_FROM_ANDROID_DB:
+                await self.get_android_audio(audio_source.data.id, file_path)
+            else:
+                await self.get_audio(audio_source.get_media_dir_path(), file_path)
+            return
+
+        with trace.time("parse"):
+            qcomps = parse_query_components(self.path)
+        if not qcomps:
+            await self.send_cors_response(400)
+            return
+
+        state = self.server.state
+        payload = state.lookup_cache.get(qcomps)
+        trace.cache = "miss" if payload is None else "hit"
+        if payload is None:
+            loop = asyncio.get_running_loop()
+            payload = await loop.run_in_executor(self.server.executor, state.build_lookup_payload, qcomps, trace)
+        self.log_results = payload
+        await self.send_payload(payload, "application/json")
+
+    async def do_POST(self):
+        if "Content-Length" not in self.headers:
+            self.close_connection = True
+            await self.send_cors_response(HTTPStatus.LENGTH_REQUIRED)
+            return
+        if self.body is None:
+            await self.send_cors_response(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+            return
+
+        loop = asyncio.get_running_loop()
+        status, payload = await loop.run_in_executor(
+            self.server.executor, handle_post_request, self.server.state, self.path, self.body, self.trace
+        )
+        if status >= 400:
+            await self.send_cors_response(status)
+            return
+        self.log_results = payload
+        await self.send_payload(payload, "application/json", status)
+
+
+class AsyncLocalAudioServer:
+    """
+    Has the same interface as LocalAudioServer (serve_forever, shutdown, server_close),
+    so either engine can be started the same way.
+    """
+
+    def __init__(self, server_address):
+        self.server_address = server_address
+        # created first (like LocalAudioServer), so a failing ServerState doesn't leave the socket bound
+        self.state = ServerState()
+        try:
+            # bind immediately (like socketserver), so errors such as the port being in use show up early
+            self.socket = socket.create_server(server_address)
+        except BaseException:
+            self.state.close()
+            raise
+        self.executor = ThreadPoolExecutor(
+            max_workers=SERVER_CONFIG["async_executor_workers"],
+            thread_name_prefix="local-audio",
+        )
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stop_event: Optional[asyncio.Event] = None
+        self._stopped = threading.Event()
+        self._handlers: dict[AsyncRequestHandler, asyncio.Task] = {}
+
+    def serve_forever(self):
+        self._stopped.clear()
+        try:
+            asyncio.run(self._serve())
+        finally:
+            self._stopped.set()
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        server = await asyncio.start_server(self.handle_connection, sock=self.socket)
+        async with server:
+            await self._stop_event.wait()
+            # closing the transports ends the handlers of idle keep-alive connections
+            handlers = dict(self._handlers)
+            for handler in handlers:
+                handler.writer.close()
+            await asyncio.gather(*handlers.values(), return_exceptions=True)
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # the head and body are written separately, so Nagle's algorithm would hold back the body
+        # of every response on a persistent connection until the client's delayed ACK arrives
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        handler = AsyncRequestHandler(self, reader, writer)
+        self._handlers[handler] = asyncio.current_task()
+        try:
+            await handler.handle()
+        finally:
+            del self._handlers[handler]
+
+    def shutdown(self):
+        """
+        stops serve_forever() and waits until it has exited. Must be called from another thread
+        """
+        if self._loop is not None and self._stop_event is not None:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
+            self._stopped.wait()
+
+    def server_close(self):
+        self.socket.close()
+        self.executor.shutdown(wait=False)
+        self.state.close()
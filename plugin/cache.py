@@ -0,0 +1,169 @@
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class LookupCache:
+    """
+    Bounded LRU cache of finished lookup responses, keyed by QueryComponents.
+
+    Entries are only valid for the database they were computed from, so the cache
+    must be cleared whenever entries.db is rewritten. The generation counter
+    prevents a lookup that started before the clear from storing a stale result
+    after it.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[Hashable, Any] = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        if self.max_size <= 0:
+            return None
+        with self._lock:
+            value = self._entries.get(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key: Hashable) -> Optional[Any]:
+        """
+        like get(), but doesn't count as a hit or miss, and doesn't mark the entry as recently used
+        """
+        with self._lock:
+            return self._entries.get(key, None)
+
+    def put(self, key: Hashable, value: Any, generation: int):
+        """
+        generation must be the value of self.generation from before the value was computed
+        """
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class AudioCache:
+    """
+    LRU cache of audio file contents, bounded by the total number of bytes it holds.
+
+    Every entry stores a version (i.e. the file's size and mtime), and is only returned
+    if the caller's version still matches, so files that are replaced or removed from the
+    media directories are never served from memory. Like LookupCache, it must also be
+    cleared whenever entries.db is rewritten.
+    """
+
+    def __init__(self, max_bytes: int, max_file_size: int):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[Hashable, tuple[Hashable, bytes]] = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def admits(self, size: int) -> bool:
+        """
+        whether a file of this size may be stored at all
+        """
+        return 0 < size <= min(self.max_file_size, self.max_bytes)
+
+    def get(self, key: Hashable, version: Hashable, count: bool = True) -> Optional[bytes]:
+        """
+        count=False doesn't count as a hit or miss, and doesn't mark the entry as recently used
+        (i.e. for prefetching)
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None and entry[0] != version:
+                # stale, i.e. the file was replaced since it was cached
+                self._remove(key)
+                entry = None
+            if not count:
+                return None if entry is None else entry[1]
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, data: bytes, version: Hashable, generation: int):
+        """
+        generation must be the value of self.generation from before the data was read
+        """
+        if not self.admits(len(data)):
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (version, data)
+            self.resident_bytes += len(data)
+            while self.resident_bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.resident_bytes -= len(evicted)
+
+    def _remove(self, key: Hashable):
+        _, data = self._entries.pop(key)
+        self.resident_bytes -= len(data)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self.resident_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "resident_bytes": self.resident_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
@@ -7,6 +7,8 @@ Source schema:
 - id: string id used as the id in the "source" column, as well as the parameter in the url
 - path: string, path to the source files
 - display: string used to display in Yomitan. Uses %s for the "DISPLAY" column.
+- serve_from (optional): "files" (default) serves the audio files from path,
+    "android_db" serves them from android.db instead (Tools → Local Audio Server → Generate Android database)
 """
 
 import json
@@ -21,7 +23,7 @@ from .source.ozk5 import OZK5AudioSource
 
 from .consts import CONFIG_FILE_NAME, DEFAULT_CONFIG_FILE_NAME
 from .util import get_config_dir, get_data_dir, get_program_root_dir
-from .source.audio_source import AudioSource, AudioSourceData
+from .source.audio_source import AudioSource, AudioSourceData, SERVE_FROM_FILES, SERVE_FROM_VALUES
 
 
 SOURCE_TYPES: Final[dict[str, Type[AudioSource]]] = {
@@ -38,10 +40,58 @@ class JsonConfigSource(TypedDict):
     id: str
     path: str
     display: str
+    serve_from: str # NotRequired[str]
+
+
+class JsonServerConfig(TypedDict):
+    # max number of lookup responses kept in memory (0 disables the cache)
+    lookup_cache_size: int
+    # seconds an idle keep-alive connection is kept open for
+    keepalive_timeout: float
+    # max number of requests served on a single connection
+    keepalive_max_requests: int
+    # "threading" (one thread per connection), "asyncio" (one event loop thread)
+    # or "pool" (a fixed number of threads)
+    server_engine: str
+    # number of threads the asyncio engine runs database lookups and file opens on
+    async_executor_workers: int
+    # max number of lookups in a single batch request
+    batch_max_items: int
+    # total size of the audio files kept in memory, in MB (0 disables the cache)
+    audio_cache_size_mb: float
+    # larger audio files are never kept in memory, in MB
+    audio_cache_max_file_size_mb: float
+    # "off", "error", "warning", "info" (also logs every request) or "debug"
+    log_level: str
+    # fraction of requests that are logged at the "info" level (1 logs every request)
+    access_log_sample_rate: float
+    # file to write the log to ("" writes to stdout)
+    log_file: str
+    # adds Server-Timing and X-Request-ID headers to every response
+    server_timing: bool
+    # stores the response of every default lookup in entries.db when it is generated
+    materialize_responses: bool
+    # bytes of entries.db read through a memory map, in MB (0 disables it)
+    sqlite_mmap_size_mb: float
+    # page cache of each database connection, in MB (0 keeps sqlite's default of about 2 MB)
+    sqlite_cache_size_mb: float
+    # opens entries.db with immutable=1 (only safe if nothing but this add-on rewrites it)
+    sqlite_immutable: bool
+    # reads entries.db once in the background when the server starts
+    sqlite_warmup: bool
+    # number of threads of the "pool" engine
+    pool_workers: int
+    # max number of connections waiting for a thread of the "pool" engine, more are answered with 503
+    pool_queue_size: int
+    # max number of lookups (including batch lookups) handled at once by the "pool" engine
+    pool_max_lookup_requests: int
+    # max number of audio files sent at once by the "pool" engine
+    pool_max_audio_requests: int
 
 
 class JsonConfig(TypedDict):
     sources: list[JsonConfigSource]
+    server: JsonServerConfig
 
 
 def get_default_config_file():
@@ -66,7 +116,11 @@ def read_config() -> JsonConfig:
         with open(config_file, encoding="utf-8") as f:
             user_config = json.load(f)
             for k, v in user_config.items():
-                config[k] = v
+                # nested sections (i.e. "server") fall back to the default per key
+                if isinstance(v, dict) and isinstance(config.get(k, None), dict):
+                    config[k].update(v)
+                else:
+                    config[k] = v
 
     return config
 
@@ -82,6 +136,9 @@ def get_all_sources() -> dict[str, AudioSource]:
         type = source_json["type"]
         path = source_json["path"]
         display = source_json["display"]
+        serve_from = source_json.get("serve_from", SERVE_FROM_FILES)
+        if serve_from not in SERVE_FROM_VALUES:
+            raise Exception(f"Unknown serve_from for source {id}: {serve_from}")
 
         # checks for source_meta.json
         source_meta_path = get_data_dir() / path / "source_meta.json"
@@ -93,10 +150,15 @@ def get_all_sources() -> dict[str, AudioSource]:
                     type = meta_type
 
         AudioSourceClass = SOURCE_TYPES[type]
-        data = AudioSourceData(id, path, display)
+        data = AudioSourceData(id, path, display, serve_from)
         source = AudioSourceClass(data)
         sources[id] = source
     return sources
 
 
+def get_server_config() -> JsonServerConfig:
+    return read_config()["server"]
+
+
 ALL_SOURCES = get_all_sources()
+SERVER_CONFIG = get_server_config()
@@ -0,0 +1,125 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional
+
+# size of the reads used to warm up the database file
+WARMUP_CHUNK_SIZE = 1024 * 1024
+
+
+class ConnectionPool:
+    """
+    Read-only connections to a sqlite database, shared between the server's threads.
+
+    A thread checks out a connection for the duration of a request and returns it
+    afterwards, so the parsed schema and page cache are reused across requests instead
+    of being rebuilt by a fresh sqlite3.connect() every time.
+
+    - mmap_size: bytes of the database that are read through a memory map
+        instead of read() calls (0 disables it)
+    - cache_size: bytes of pages cached per connection (0 keeps sqlite's default)
+    - immutable: opens the database with immutable=1, so sqlite skips all locking and
+        change detection. init_db() never writes to the file that is being served (it replaces it
+        instead), and the pool is invalidated once it has, so this is safe while it is running.
+    """
+
+    def __init__(
+        self,
+        db_path: Path,
+        max_idle: int = 8,
+        mmap_size: int = 0,
+        cache_size: int = 0,
+        immutable: bool = False,
+    ):
+        self.db_path = db_path
+        self.max_idle = max_idle
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self.immutable = immutable
+
+        self._lock = threading.Lock()
+        self._idle: list[sqlite3.Connection] = []
+        # bumped whenever the database file is replaced, so connections opened
+        # against the old file are never put back into the pool
+        self._generation = 0
+        self._closed = False
+        self._warmup_thread: Optional[threading.Thread] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        uri = self.db_path.as_uri() + "?mode=ro"
+        if self.immutable:
+            uri += "&immutable=1"
+        # connections are handed between threads, but only ever used by one at a time
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        if self.mmap_size > 0:
+            conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        if self.cache_size > 0:
+            # negative values are in KiB instead of pages
+            conn.execute(f"PRAGMA cache_size = -{int(self.cache_size) // 1024}")
+        return conn
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            generation = self._generation
+            conn = self._idle.pop() if self._idle else None
+
+        if conn is None:
+            conn = self._connect()
+
+        try:
+            yield conn
+        finally:
+            self._release(conn, generation)
+
+    def _release(self, conn: sqlite3.Connection, generation: int):
+        with self._lock:
+            if (
+                not self._closed
+                and generation == self._generation
+                and len(self._idle) < self.max_idle
+            ):
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def invalidate(self):
+        """
+        closes all idle connections. Connections that are currently in use are closed
+        as soon as they are returned.
+        This must be called whenever the database file is rewritten.
+        """
+        with self._lock:
+            self._generation += 1
+            idle = self._idle
+            self._idle = []
+        for conn in idle:
+            conn.close()
+
+    def warm_up(self) -> threading.Thread:
+        """
+        reads the database file once on a background thread, so that its pages are in the OS page
+        cache (which memory-mapped reads use directly) before the first lookups need them.
+        Returns the thread
+        """
+        if self._warmup_thread is None:
+            self._warmup_thread = threading.Thread(target=self._warm_up, name="local-audio-warmup", daemon=True)
+            self._warmup_thread.start()
+        return self._warmup_thread
+
+    def _warm_up(self):
+        try:
+            with open(self.db_path, "rb", buffering=0) as f:
+                buffer = bytearray(WARMUP_CHUNK_SIZE)
+                while not self._closed and f.readinto(buffer):
+                    pass
+        except OSError:
+            pass
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+        self.invalidate()
+        if self._warmup_thread is not None:
+            self._warmup_thread.join()
@@ -6,11 +6,16 @@ vacuum # so empty space is removed
 
 import os
 import json
+import hashlib
+import multiprocessing
 import shutil
 import sqlite3
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
-from typing import Any, Callable, TypedDict, Optional
-from dataclasses import dataclass, field
+from typing import Any, Callable, Iterable, Iterator, Sequence, TypedDict, Optional
+from functools import lru_cache
 
 from .util import (
     get_android_db_file,
@@ -22,16 +27,52 @@ from .util import (
 )
 from .jp_util import is_hiragana
 #from .all_sources import ID_TO_SOURCE_MAP, SOURCES
-from .config import ALL_SOURCES
+from .config import ALL_SOURCES, SERVER_CONFIG
 from .consts import *
+from .lookup import build_audio_sources, encode_audio_source_list
+from .source.audio_source import AudioSource, EntryRow
+from .json_stream import iter_json_items
+from .fingerprint import SourceFingerprint, fingerprint_matches, get_file_info, take_fingerprint
 
 
 
 # versions when the entries.db database schemas has changed and must be regenerated
 UPDATE_VERSIONS = [
     (1, 3, 0),
+    (1, 8, 0),
 ]
 
+# called whenever entries.db is rewritten, i.e. so the server can drop pooled connections
+DB_CHANGE_LISTENERS: list[Callable[[], None]] = []
+
+# init_db() builds the new database in entries.db.tmp
+TEMP_DB_SUFFIX = ".tmp"
+# number of attempts at replacing entries.db (only retried on Windows), and the delay after the first attempt
+REPLACE_DB_RETRIES = 10
+REPLACE_DB_RETRY_DELAY = 0.1
+
+# with more than one job, each source is read in a worker process into a staging database,
+# in a temporary directory inside the data dir (see add_sources_entries)
+STAGING_DIR_PREFIX = "entries-staging-"
+
+# every source's rows are written by write_entries() with this statement
+INSERT_ENTRY_SQL = (
+    "INSERT INTO temp.staged_entries (expression, reading, source_id, speaker_id, display, file) VALUES (?,?,?,?,?,?)"
+)
+
+# the name of the fingerprint of jmdict_forms.json in the fingerprints table, next to the source ids.
+# It is only a hash of the file. If it changed, get_outdated_sources() returns this name along with the
+# source ids, and update_db() replaces every row that was backfilled with it
+JMDICT_FORMS_FINGERPRINT_NAME = JMDICT_FORMS_JSON_FILE_NAME
+
+# the reading of the materialized response for a lookup without a reading
+NO_READING_KEY = ""
+# number of materialized responses inserted at once
+MATERIALIZE_CHUNK_SIZE = 1000
+
+# size of the reads used to stream an audio file out of android.db
+ANDROID_BLOB_CHUNK_SIZE = 64 * 1024
+
 
 class ExpressionInfo(TypedDict):
     kanji: str
@@ -41,14 +82,20 @@ class ExpressionGroup(TypedDict):
     reading: str
     expressions: list[ExpressionInfo]
 
-@dataclass
-class ExpressionMeta:
-    expression: str
-    reading: str
-    found_audio_row_slices: set[tuple] = field(default_factory=set)
 
+def add_db_change_listener(listener: Callable[[], None]):
+    DB_CHANGE_LISTENERS.append(listener)
+
+
+def remove_db_change_listener(listener: Callable[[], None]):
+    if listener in DB_CHANGE_LISTENERS:
+        DB_CHANGE_LISTENERS.remove(listener)
 
 
+def notify_db_changed():
+    for listener in list(DB_CHANGE_LISTENERS):
+        listener()
+
 
 def android_gen():
     """
@@ -57,14 +104,36 @@ def android_gen():
 
     original_db_path = get_db_file()
     android_db_path = get_android_db_file()
+    # built next to android.db and swapped in once complete (like entries.db),
+    # as the server may be streaming audio out of the old file
+    temp_db_path = android_db_path.with_name(android_db_path.name + TEMP_DB_SUFFIX)
+    remove_db_file(temp_db_path)
 
-    # literally copy entries.db -> android.db
-    shutil.copy(original_db_path, android_db_path)
-
-    with sqlite3.connect(android_db_path) as android_connection:
-        android_cursor = android_connection.cursor()
-        android_write(android_cursor, android_cursor)
-        android_cursor.close()
+    try:
+        # literally copy entries.db -> android.db
+        shutil.copy(original_db_path, temp_db_path)
+
+        android_connection = sqlite3.connect(temp_db_path)
+        try:
+            with android_connection:
+                android_cursor = android_connection.cursor()
+                write_android_entries_table(android_cursor)
+                android_cursor.close()
+            # drops the free pages left by the removed tables, while the file is still small
+            android_connection.execute("VACUUM")
+            with android_connection:
+                android_cursor = android_connection.cursor()
+                android_write(android_cursor, android_cursor)
+                android_cursor.close()
+        finally:
+            android_connection.close()
+        fsync_file(temp_db_path)
+        replace_db_file(temp_db_path, android_db_path)
+    except BaseException:
+        remove_db_file(temp_db_path)
+        raise
+
+    notify_db_changed()
 
     # with sqlite3.connect(original_db_path) as og_connection:
     #    with sqlite3.connect(android_db_path) as android_connection:
@@ -119,11 +188,55 @@ def android_write(og_cur, cur):
             cur.execute(sql, (file_name, source_id, file.read()))
 
 
+def find_android_audio(
+    connection: sqlite3.Connection, source_id: str, file_path: str
+) -> Optional[tuple[int, int]]:
+    """
+    the (rowid, size) of an audio file stored in android.db, without reading the file itself
+    """
+    return connection.execute(
+        "SELECT id, length(data) FROM android WHERE file = :file AND source = :source",
+        {"file": file_path, "source": source_id},
+    ).fetchone()
+
+
+def read_android_audio(connection: sqlite3.Connection, rowid: int, offset: int, count: int) -> Iterator[bytes]:
+    """
+    reads part of an audio file stored in android.db in chunks, so memory use doesn't depend on the file size.
+    Uses incremental blob I/O (Python 3.11+), and otherwise reads each chunk with substr()
+    """
+    if hasattr(connection, "blobopen"):
+        with connection.blobopen("android", "data", rowid, readonly=True) as blob:
+            blob.seek(offset)
+            while count > 0:
+                chunk = blob.read(min(count, ANDROID_BLOB_CHUNK_SIZE))
+                if not chunk:
+                    break
+                count -= len(chunk)
+                yield chunk
+        return
+
+    sql = """
+    SELECT substr(data, :start, :count) FROM android WHERE id = :id
+    """
+    while count > 0:
+        row = connection.execute(
+            sql, {"start": offset + 1, "count": min(count, ANDROID_BLOB_CHUNK_SIZE), "id": rowid}
+        ).fetchone()
+        if row is None or not row[0]:
+            break
+        chunk = row[0]
+        offset += len(chunk)
+        count -= len(chunk)
+        yield chunk
+
+
 def table_exists_and_has_data() -> bool:
     with sqlite3.connect(get_db_file()) as conn:
         cursor = conn.cursor()
         cursor.execute(
-            "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = :name",
+            # entries is a view since v1.8.0, and a table before that
+            "SELECT count(*) FROM sqlite_master WHERE type IN ('table', 'view') AND name = :name",
             {"name": "entries"},
         )
         result = cursor.fetchone()
@@ -173,15 +286,71 @@ def table_must_be_updated():
     return update_check(db_ver, latest_ver, UPDATE_VERSIONS)
 
 
-def attempt_init_db():
+def attempt_init_db(jobs: int = 1):
     """
     attempts to initialize the db if necessary
     """
 
     if not table_exists_and_has_data():
-        init_db()
+        init_db(jobs=jobs)
     elif table_must_be_updated():
-        init_db()
+        init_db(jobs=jobs)
+    else:
+        outdated_sources = get_outdated_sources()
+        if outdated_sources is None:
+            init_db(jobs=jobs)
+        elif outdated_sources:
+            update_db(outdated_sources, jobs=jobs)
+
+
+def get_jmdict_forms_fingerprint(known_files: Sequence[Sequence] = ()) -> SourceFingerprint:
+    """
+    the hash of jmdict_forms.json ("" if it doesn't exist). known_files is the stored fingerprint's files,
+    so the file is only hashed again if its size or modification time changed (see fingerprint.get_file_info)
+    """
+    known = {file[0]: file[1:] for file in known_files}
+    info = get_file_info(
+        get_data_dir().joinpath(JMDICT_FORMS_JSON_FILE_NAME), known.get(JMDICT_FORMS_JSON_FILE_NAME)
+    )
+    return SourceFingerprint(info[2] or "", [], [[JMDICT_FORMS_JSON_FILE_NAME] + info])
+
+
+def get_outdated_sources() -> Optional[list[str]]:
+    """
+    the ids of the sources whose entries must be read again (see update_db): sources whose files changed
+    since their entries were added, and sources that were added to or removed from the config.
+    Also contains JMDICT_FORMS_FINGERPRINT_NAME if jmdict_forms.json changed.
+    Returns None if the whole database must be regenerated instead, i.e. if it was generated by an older version.
+
+    This stats every directory of every source, so it shouldn't be run on Anki's main thread
+    """
+    conn = sqlite3.connect(get_db_file())
+    try:
+        rows = conn.execute("SELECT name, fingerprint, directories, files FROM fingerprints").fetchall()
+        conn.execute("SELECT 1 FROM jmdict_forms_entries LIMIT 1")
+    except sqlite3.OperationalError: # no such table or column, the database was generated by an older version
+        return None
+    finally:
+        conn.close()
+
+    fingerprints = {
+        name: (fingerprint, json.loads(directories), json.loads(files))
+        for name, fingerprint, directories, files in rows
+    }
+    outdated_sources = [id for id in fingerprints if id not in ALL_SOURCES and id != JMDICT_FORMS_FINGERPRINT_NAME]
+    for id, source in ALL_SOURCES.items():
+        stored = fingerprints.get(id)
+        if stored is None or not fingerprint_matches(source, *stored):
+            outdated_sources.append(id)
+
+    jmdict_forms_fingerprint = fingerprints.get(JMDICT_FORMS_FINGERPRINT_NAME)
+    known_files = [] if jmdict_forms_fingerprint is None else jmdict_forms_fingerprint[2]
+    if (
+        jmdict_forms_fingerprint is None
+        or jmdict_forms_fingerprint[0] != get_jmdict_forms_fingerprint(known_files).fingerprint
+    ):
+        outdated_sources.append(JMDICT_FORMS_FINGERPRINT_NAME)
+    return outdated_sources
 
 
 def update_db_version():
@@ -227,19 +396,16 @@ def get_unique_count(conn: sqlite3.Connection) -> int:
     ).fetchone()[0]
 
 
-INSERT_ROW_SQL = "INSERT INTO entries (expression, reading, source, speaker, display, file) VALUES (?,?,?,?,?,?)"
-
-SEARCH_QUERY = f"""
-    SELECT * FROM entries WHERE (
-        expression = ? AND reading = ?
-    )
+def backfill_jmdict_forms(conn: sqlite3.Connection, groups: Iterable[ExpressionGroup], sources: tuple[str, ...] = ()) -> int:
     """
+    Adds the rows of every form in a group of JMdict variant forms that it is missing,
+    copied from the rows of the other forms in the group. Returns the number of rows added
+    (to staged_entries, see move_staged_entries).
 
-def backfill_jmdict_forms_rows(conn: sqlite3.Connection, group: ExpressionGroup, new_rows: list[Any], new_rows_set: set[Any]):
-    """
     Algorithm:
-    - get all rows that match the expressions and reading of the json
-    - for each expression/reading pair in the json:
+    - write all groups to a temporary table, and get all rows that match the expressions and readings
+        of each group at once
+    - for each expression/reading pair of a group, and each audio of the group it doesn't have yet:
         - create a new row if it isn't a duplicate
 
     - NOTES:
@@ -249,62 +415,134 @@ def backfill_jmdict_forms_rows(conn: sqlite3.Connection, group: ExpressionGroup,
             六 can transfer (六 -> 陸 -> 碌), which is not correct!!
         - When checking for duplicates, we must check that the row is not in the
             "going to be added" list as well!
+        - A new row is always a copy of a row of the same source, and duplicates are only
+            checked within a source. So the rows of the given sources (all sources if empty)
+            can be backfilled on their own, i.e. when only some sources were updated.
+        - The new rows are found with a few queries over all groups (instead of one query per form),
+            and only written by the last one. They are added in the same order as the previous
+            per-form algorithm did (see test_db_utils.py): by group, then by the first row of the group
+            with the audio (in the order of the forms, then of the rows), then by form.
+    """
+    cursor = conn.cursor()
+
+    # - member: the position of the form within its group
+    # - searchable: whether the rows of the form are copied to the other forms.
+    #   We skip hiragana only words! This is because we shouldn't map
+    #   hiragana words -> kanji words, as we cannot guarantee that our data of hiragana words
+    #   actually are talking about the correct kanji word.
+    #   It's probably safe to keep katakana words though, since those are a bit more unique.
+    cursor.execute("""
+        CREATE TEMP TABLE jmdict_forms (
+            group_id integer NOT NULL,
+            member integer NOT NULL,
+            expression text NOT NULL,
+            reading text,
+            searchable integer NOT NULL,
+            repeated integer NOT NULL DEFAULT 0,
+            PRIMARY KEY (group_id, member)
+        ) WITHOUT ROWID;
+    """)
+
+    def forms():
+        for group_id, group in enumerate(groups):
+            group_reading = group["reading"]
+            for member, expression in enumerate(group["expressions"]):
+                kanji = expression["kanji"]
+                reading = expression.get("reading", group_reading)
+                yield (group_id, member, kanji, reading, not is_hiragana(kanji))
+
+    cursor.executemany(
+        "INSERT INTO temp.jmdict_forms (group_id, member, expression, reading, searchable) VALUES (?,?,?,?,?)",
+        forms(),
+    )
+
+    source_filter = ""
+    if sources:
+        n_question_marks = ",".join(["?"] * len(sources))
+        source_filter = f"AND e.source_id IN (SELECT id FROM sources WHERE name IN ({n_question_marks}))"
+
+    # the rows of the searchable forms of each group (with the source, speaker, display and file as the
+    # "audio" of the row), numbered in the order the forms and then the rows come in
+    cursor.execute(
+        f"""
+        CREATE TEMP TABLE jmdict_rows AS
+        SELECT
+            f.group_id, e.expression, e.reading, e.source_id, e.speaker_id, e.display, e.file,
+            row_number() OVER (PARTITION BY f.group_id ORDER BY f.member, e.id) AS position
+        FROM temp.jmdict_forms AS f
+        JOIN audio_entries AS e ON e.expression = f.expression AND e.reading = f.reading
+        WHERE f.searchable {source_filter}
+        """,
+        sources,
+    )
+    cursor.execute("CREATE INDEX temp.idx_jmdict_rows ON jmdict_rows(group_id, expression, reading, file)")
+
+    # only the rows of forms that are in more than one group with rows (or twice in one) can be duplicates
+    # of each other, as rows are only added to the groups that have rows
+    cursor.execute("""
+        UPDATE temp.jmdict_forms SET repeated = 1
+        WHERE (expression, reading) IN (
+            SELECT expression, reading FROM temp.jmdict_forms
+            WHERE group_id IN (SELECT group_id FROM temp.jmdict_rows)
+            GROUP BY expression, reading HAVING count(*) > 1
+        )
+    """)
+
+    # - audio: every audio of a group once, with the position of its first row
+    # - missing: the audio of the group for every form that doesn't already have it (non-searchable forms
+    #   never have it, as their rows weren't read)
+    # - new_rows: numbered so only the first of each duplicate row is kept. Numbering sorts the rows,
+    #   so it's skipped for the (many) forms that can't have duplicates
+    cursor.execute("""
+        INSERT INTO temp.staged_entries (expression, reading, source_id, speaker_id, display, file)
+        WITH audio AS (
+            SELECT group_id, source_id, speaker_id, display, file, min(position) AS position
+            FROM temp.jmdict_rows
+            GROUP BY group_id, source_id, speaker_id, display, file
+        ),
+        missing AS (
+            SELECT
+                f.expression, f.reading, a.source_id, a.speaker_id, a.display, a.file,
+                a.group_id, a.position, f.member, f.repeated
+            FROM audio AS a
+            JOIN temp.jmdict_forms AS f ON f.group_id = a.group_id
+            WHERE NOT EXISTS (
+                SELECT 1 FROM temp.jmdict_rows AS r
+                WHERE r.group_id = a.group_id
+                    AND r.expression = f.expression
+                    AND r.reading = f.reading
+                    AND r.file = a.file
+                    AND r.source_id = a.source_id
+                    AND r.speaker_id IS a.speaker_id
+                    AND r.display IS a.display
+            )
+        ),
+        new_rows AS (
+            SELECT *, 1 AS occurrence FROM missing WHERE NOT repeated
+            UNION ALL
+            SELECT *, row_number() OVER (
+                PARTITION BY expression, reading, source_id, speaker_id, display, file
+                ORDER BY group_id, position, member
+            ) AS occurrence
+            FROM missing WHERE repeated
+        )
+        SELECT expression, reading, source_id, speaker_id, display, file
+        FROM new_rows
+        WHERE occurrence = 1
+        ORDER BY group_id, position, member
+    """)
+    count = cursor.rowcount
+
+    cursor.execute("DROP TABLE temp.jmdict_rows")
+    cursor.execute("DROP TABLE temp.jmdict_forms")
+    cursor.close()
+    return count
+
+
+def fill_jmdict_forms(conn: sqlite3.Connection, sources: tuple[str, ...] = ()):
     """
-    # metadata for each entry in the group
-    meta_list: list[ExpressionMeta] = []
-    group_reading = group["reading"]
-    for expression in group["expressions"]:
-        kanji = expression["kanji"]
-        reading = expression.get("reading", group_reading)
-        meta_list.append(ExpressionMeta(kanji, reading))
-
-    # this could be done slightly more efficiently with a group query, but
-    # I'm too lazy to properly do it (requires sorting by expression/reading pair, etc.).
-    all_rows = []
-    for meta in meta_list:
-        # NOTE: we skip hiragana only words from the query! This is because we shouldn't map
-        # hiragana words -> kanji words, as we cannot guarantee that our data of hiragana words
-        # actually are talking about the correct kanji word.
-        # It's probably safe to keep katakana words though, since those are a bit more unique.
-        if not is_hiragana(meta.expression):
-            rows = conn.execute(SEARCH_QUERY, (meta.expression, meta.reading)).fetchall()
-            all_rows.extend(rows)
-
-    if len(all_rows) == 0:
-        return 0
-
-    # DUPLICATE CHECKING from original index
-    for row in all_rows:
-        expression = row[EXPRESSION]
-        reading = row[READING]
-
-        # if the expression and reading matches, make sure we ddd the audio_row_slice to
-        # the found slices var, so we don't add itself back to the database
-        for meta in meta_list:
-            if meta.expression == expression and meta.reading == reading:
-                audio_row_slice = tuple(row[SOURCE:])
-                meta.found_audio_row_slices.add(audio_row_slice)
-
-    #print("META LIST:")
-    #for meta in meta_list:
-    #    print("META", meta.expression, meta.reading, meta.found_audio_row_slices)
-
-    # switch for-loop order so audio_row_slice can be created n times instead of n*m times
-    for row in all_rows:
-        audio_row_slice = row[SOURCE:] # already a tuple
-        for meta in meta_list:
-            if audio_row_slice not in meta.found_audio_row_slices:
-                meta.found_audio_row_slices.add(audio_row_slice)
-                new_row = (meta.expression, meta.reading) + row[SOURCE:]
-                # if we check for containment in new_rows, it kills the runtime speed
-                if new_row not in new_rows_set:
-                    new_rows.append(new_row)
-                    new_rows_set.add(new_row)
-
-
-def fill_jmdict_forms(conn: sqlite3.Connection):
-    """
-    Backfills the database using Jmdict variant forms data
+    Backfills the database using Jmdict variant forms data.
+    If sources is given, only the rows of these sources are backfilled (see update_db)
     """
 
     print(f"(init_db) Filling out JMdict forms...")
@@ -313,120 +551,720 @@ def fill_jmdict_forms(conn: sqlite3.Connection):
         return
 
     with open(jmdict_forms_file, encoding="utf-8") as f:
-        groups: list[ExpressionGroup] = json.load(f)
+        # one group at a time, instead of decoding the whole file at once
+        count = backfill_jmdict_forms(conn, iter_json_items(f), sources)
+    # staged_entries only has the backfilled rows at this point
+    conn.execute("INSERT INTO jmdict_forms_entries (expression, id) SELECT expression, id FROM temp.staged_entries")
+    move_staged_entries(conn)
+
+    print(f"(init_db) Extra terms filled with JMdict forms: {count}")
+
+    conn.commit()
+
+
+def get_responses_signature() -> str:
+    """
+    identifies everything besides the entries that a materialized response depends on:
+    the default source order, and the display and url of each source
+    """
+    sources = [
+        (source.data.id, source.data.display, source.construct_file_url(""))
+        for source in ALL_SOURCES.values()
+    ]
+    return hashlib.sha256(json.dumps(sources).encode("utf-8")).hexdigest()
+
+
+def is_default_lookup(qcomps: QueryComponents) -> bool:
+    """
+    whether the lookup uses the default sources and users, i.e. can be answered by a materialized response
+    """
+    # an empty reading would otherwise match the response for a lookup without a reading
+    return qcomps.sources == tuple(ALL_SOURCES.keys()) and not qcomps.user and qcomps.reading != NO_READING_KEY
+
 
-    rows = []
-    rows_set = set()
-    for group in groups:
-        backfill_jmdict_forms_rows(conn, group, rows, rows_set)
+def materialize_responses(conn: sqlite3.Connection, expressions: Optional[Iterable[str]] = None):
+    """
+    Stores the ready-to-send response of every default lookup (see is_default_lookup) that has results,
+    so the server can answer it with a single indexed lookup instead of building it.
+
+    Every expression gets one response for a lookup without a reading (stored under NO_READING_KEY),
+    and one for each of its readings. The responses are built with execute_query(),
+    so they are exactly what the server would have built itself.
+    Lookups of readings that aren't in the table (and all other lookups) are still built by the server.
+
+    If expressions is given, only the responses of these expressions are replaced (see update_db),
+    which requires has_materialized_responses() to be true
+    """
+    print("(init_db) Materializing lookup responses...")
 
     cursor = conn.cursor()
-    for row in rows:
-        #print("ADDING", row)
-        cursor.execute(INSERT_ROW_SQL, row)
+    cursor.execute("DROP TABLE IF EXISTS responses_info")
+    if expressions is None:
+        cursor.execute("DROP TABLE IF EXISTS responses")
+        cursor.execute("""
+            CREATE TABLE responses (
+                expression text NOT NULL,
+                reading text NOT NULL,
+                payload blob NOT NULL,
+                PRIMARY KEY (expression, reading)
+            ) WITHOUT ROWID;
+        """)
+        keys_sql = "SELECT DISTINCT expression, reading FROM entries ORDER BY expression, reading"
+    else:
+        cursor.execute("DROP TABLE IF EXISTS temp.materialize_expressions")
+        cursor.execute("CREATE TEMP TABLE materialize_expressions (expression text PRIMARY KEY NOT NULL) WITHOUT ROWID")
+        cursor.executemany(
+            "INSERT OR IGNORE INTO temp.materialize_expressions VALUES (?)",
+            ((expression,) for expression in expressions),
+        )
+        cursor.execute(
+            "DELETE FROM responses WHERE expression IN (SELECT expression FROM temp.materialize_expressions)"
+        )
+        keys_sql = """
+            SELECT DISTINCT expression, reading FROM entries
+            WHERE expression IN (SELECT expression FROM temp.materialize_expressions)
+            ORDER BY expression, reading
+        """
+
+    sources = tuple(ALL_SOURCES.keys())
+    keys = cursor.execute(keys_sql).fetchall()
+
+    def responses():
+        prev_expression = None
+        for expression, reading in keys:
+            if expression != prev_expression:
+                prev_expression = expression
+                rows = execute_query(conn, QueryComponents(expression, None, sources, ()))
+                yield expression, NO_READING_KEY, encode_audio_source_list(build_audio_sources(rows))
+            if reading is None or reading == NO_READING_KEY:
+                continue
+            rows = execute_query(conn, QueryComponents(expression, reading, sources, ()))
+            yield expression, reading, encode_audio_source_list(build_audio_sources(rows))
+
+    count = 0
+    chunk = []
+    for response in responses():
+        chunk.append(response)
+        if len(chunk) >= MATERIALIZE_CHUNK_SIZE:
+            cursor.executemany("INSERT INTO responses VALUES (?,?,?)", chunk)
+            count += len(chunk)
+            chunk = []
+    cursor.executemany("INSERT INTO responses VALUES (?,?,?)", chunk)
+    count += len(chunk)
+
+    # written last, so the table is never used if building it was interrupted
+    cursor.execute("CREATE TABLE responses_info (signature text NOT NULL)")
+    cursor.execute("INSERT INTO responses_info VALUES (?)", (get_responses_signature(),))
     cursor.close()
+    conn.commit()
 
-    print(f"(init_db) Extra terms filled with JMdict forms: {len(rows)}")
+    print(f"(init_db) Materialized lookup responses: {count}")
 
-    conn.commit()
 
+def has_materialized_responses(conn: sqlite3.Connection) -> bool:
+    """
+    whether the database has materialized responses that match the current config
+    """
+    try:
+        row = conn.execute("SELECT signature FROM responses_info").fetchone()
+    except sqlite3.OperationalError: # no such table
+        return False
+    return row is not None and row[0] == get_responses_signature()
 
-def init_db(callback: Optional[Callable[[str], None]] = None):
+
+def get_materialized_response(conn: sqlite3.Connection, qcomps: QueryComponents) -> Optional[bytes]:
     """
-    callback is an optional function to inform the UI of the current action
+    the materialized response of a default lookup, or None if it must be built instead.
+    Only valid if has_materialized_responses() is true
     """
-    print("Initializing database. This make take a while...")
+    reading = NO_READING_KEY if qcomps.reading is None else qcomps.reading
+    row = conn.execute(
+        "SELECT payload FROM responses WHERE expression = ? AND reading = ?", (qcomps.expression, reading)
+    ).fetchone()
+    return None if row is None else row[0]
 
-    update_db_version()
+
+def init_db(callback: Optional[Callable[[str], None]] = None, jobs: int = 1):
+    """
+    Regenerates entries.db. The new database is built in a temporary file next to it,
+    which only replaces entries.db once it is complete. Until then, the server keeps answering
+    lookups from the old database, and a failed build leaves the old database untouched.
+
+    callback is an optional function to inform the UI of the current action.
+    jobs is the number of sources that are read at once (see add_sources_entries)
+    """
+    print("Initializing database. This make take a while...")
 
     original_db_path = get_db_file()
+    temp_db_path = original_db_path.with_name(original_db_path.name + TEMP_DB_SUFFIX)
+
+    # left behind if a previous build was interrupted
+    remove_db_file(temp_db_path)
 
-    # completely wipes out the file
     try:
-        with open(original_db_path, "w") as _:
-            pass
-    except Exception:
-        pass
-
-    with sqlite3.connect(original_db_path) as connection:
-        cursor = connection.cursor()
-
-        # initializes entries table
-        drop_table_sql = "DROP TABLE IF EXISTS entries"
-        cursor.execute(drop_table_sql)
-        cursor.execute("vacuum")
-
-        # - expression (term): the main lookup key, potentially in kanji
-        # - reading: kana only version of expression. If null, then no reading was
-        #   available from the source.
-        # - source: one of "jpod", "jpod_alternate", "forvo", "nhk16", "shinmeikai8"
-        # - file: file path to the audio, with the root determined by get_data_path()
-        #   Allows for easier sorting for more ideal results without post processing
-        #   or unions + subqueries.
-        # - speaker: contains the forvo username. Null for anything that isn't forvo.
-        # - display: contains the display for nhk16 and shinmeikai8. Otherwise Null.
-        #
-        # NOTES:
-        # - the reading can be exactly the same as the expression (for kana only terms)
-        # - the reading can be in katakana
-        create_table_sql = """
-            CREATE TABLE entries (
-                id integer PRIMARY KEY NOT NULL,
-                expression text NOT NULL,
-                reading text,
-                source text NOT NULL,
-                speaker text,
-                display text,
-                file text NOT NULL
-           );
-        """
-        cursor.execute(create_table_sql)
+        connection = sqlite3.connect(temp_db_path)
+        try:
+            build_db(connection, callback, jobs)
+        finally:
+            connection.close()
+        fsync_file(temp_db_path)
+        replace_db_file(temp_db_path, original_db_path)
+    except BaseException:
+        remove_db_file(temp_db_path)
+        raise
+
+    # only written once the database is complete, so a failed build is retried on the next start
+    update_db_version()
 
-        # see AudioSource.execute_query for possible queries
+    # the server's connections are still reading the old file
+    notify_db_changed()
 
-        # I'm assuming the query won't be expanded out into 4 long queries,
-        # so these indices are necessary for each side of the OR statements.
-        create_idx_reading_sql = f"""
-            CREATE INDEX idx_reading ON entries(reading);
-        """
-        cursor.execute(create_idx_reading_sql)
-        create_idx_speaker_sql = f"""
-            CREATE INDEX idx_speaker ON entries(speaker);
-        """
-        cursor.execute(create_idx_speaker_sql)
+    print("Finished initializing database!")
 
-        # optimize first query
-        create_idx_expr_reading_sql = f"""
-            CREATE INDEX idx_expr_reading ON entries(expression, reading);
-        """
-        cursor.execute(create_idx_expr_reading_sql)
 
-        # optimize second query
-        # TODO: remove this index
-        create_idx_expr_reading_speaker_sql = f"""
-            CREATE INDEX idx_reading_speaker ON entries(expression, reading, speaker);
-        """
-        cursor.execute(create_idx_expr_reading_speaker_sql)
+def build_db(connection: sqlite3.Connection, callback: Optional[Callable[[str], None]] = None, jobs: int = 1):
+    """
+    creates and fills the tables of a new (empty) database
+    """
+    with connection:
+        create_schema(connection)
 
-        # optimize third query
-        # TODO: remove this index
-        create_idx_expr_reading_speaker_sql = f"""
-            CREATE INDEX idx_all ON entries(expression, reading, source);
-        """
-        cursor.execute(create_idx_expr_reading_speaker_sql)
-        cursor.close()
+        add_sources_entries(connection, list(ALL_SOURCES.values()), callback, jobs)
+
+        if callback is not None:
+            callback("Sorting entries...")
+        start = time.perf_counter()
+        move_staged_entries(connection)
+        print(f"(init_db) Sorted entries in {time.perf_counter() - start:.2f}s")
 
-        for source in ALL_SOURCES.values():
-            print(f"(init_db) Adding entries from {source.data.id}...")
-            if callback is not None:
-                callback(f"Adding entries from {source.data.id}...")
-            source.add_entries(connection)
+        write_fingerprint(connection, JMDICT_FORMS_FINGERPRINT_NAME, get_jmdict_forms_fingerprint())
 
     if callback is not None:
         callback("Backfilling entries using JMdict data...")
     fill_jmdict_forms(connection)
 
-    print("Finished initializing database!")
+    if SERVER_CONFIG["materialize_responses"]:
+        if callback is not None:
+            callback("Materializing lookup responses...")
+        materialize_responses(connection)
+
+
+def update_db(source_ids: list[str], callback: Optional[Callable[[str], None]] = None, jobs: int = 1):
+    """
+    Updates entries.db instead of regenerating it: the entries of the given sources (see get_outdated_sources)
+    are removed, the sources that are still in the config are read again, and only their entries are backfilled.
+    If source_ids contains JMDICT_FORMS_FINGERPRINT_NAME, every backfilled row is replaced instead,
+    using the current jmdict_forms.json. Like init_db(), the changes are made to a copy of entries.db, which then replaces it.
+
+    callback is an optional function to inform the UI of the current action
+    """
+    print(f"Updating database for sources: {', '.join(source_ids)}")
+
+    original_db_path = get_db_file()
+    temp_db_path = original_db_path.with_name(original_db_path.name + TEMP_DB_SUFFIX)
+    remove_db_file(temp_db_path)
+
+    try:
+        shutil.copy(original_db_path, temp_db_path)
+        connection = sqlite3.connect(temp_db_path)
+        try:
+            update_sources(connection, source_ids, callback, jobs)
+        finally:
+            connection.close()
+        fsync_file(temp_db_path)
+        replace_db_file(temp_db_path, original_db_path)
+    except BaseException:
+        remove_db_file(temp_db_path)
+        raise
+
+    update_db_version()
+    notify_db_changed()
+
+    print("Finished updating database!")
+
+
+def update_sources(
+    connection: sqlite3.Connection,
+    source_ids: list[str],
+    callback: Optional[Callable[[str], None]] = None,
+    jobs: int = 1,
+):
+    """
+    replaces the entries of the given sources in an existing database (see update_db)
+    """
+    refill_jmdict_forms = JMDICT_FORMS_FINGERPRINT_NAME in source_ids
+    source_ids = [id for id in source_ids if id != JMDICT_FORMS_FINGERPRINT_NAME]
+    sources = [ALL_SOURCES[id] for id in source_ids if id in ALL_SOURCES]
+    n_question_marks = ",".join(["?"] * len(source_ids))
+    source_ids_sql = f"SELECT id FROM sources WHERE name IN ({n_question_marks})"
+    # the lookups whose materialized responses may have changed
+    affected_expressions_sql = f"""
+        INSERT OR IGNORE INTO temp.affected_expressions
+        SELECT expression FROM entries WHERE source IN ({n_question_marks})
+    """
+    affected_jmdict_forms_sql = """
+        INSERT OR IGNORE INTO temp.affected_expressions
+        SELECT expression FROM jmdict_forms_entries
+    """
+
+    with connection:
+        connection.execute("CREATE TEMP TABLE affected_expressions (expression text PRIMARY KEY NOT NULL) WITHOUT ROWID")
+        connection.execute(affected_expressions_sql, source_ids)
+        # the sources' rows include the rows that were backfilled from them
+        connection.execute(
+            f"""
+            DELETE FROM jmdict_forms_entries WHERE (expression, id) IN (
+                SELECT expression, id FROM audio_entries WHERE source_id IN ({source_ids_sql})
+            )
+            """,
+            source_ids,
+        )
+        connection.execute(f"DELETE FROM audio_entries WHERE source_id IN ({source_ids_sql})", source_ids)
+        connection.execute(f"DELETE FROM fingerprints WHERE name IN ({n_question_marks})", source_ids)
+
+        if refill_jmdict_forms:
+            # the rows backfilled from the previous jmdict_forms.json are all added again below,
+            # and the rows of the sources are kept as they are
+            connection.execute(affected_jmdict_forms_sql)
+            connection.execute(
+                "DELETE FROM audio_entries WHERE (expression, id) IN (SELECT expression, id FROM jmdict_forms_entries)"
+            )
+            connection.execute("DELETE FROM jmdict_forms_entries")
+            write_fingerprint(connection, JMDICT_FORMS_FINGERPRINT_NAME, get_jmdict_forms_fingerprint())
+
+        create_staged_entries_table(connection)
+        add_sources_entries(connection, sources, callback, jobs)
+        move_staged_entries(connection)
+
+    if refill_jmdict_forms or sources:
+        if callback is not None:
+            callback("Backfilling entries using JMdict data...")
+        # with a new jmdict_forms.json, the rows of every source are backfilled again
+        fill_jmdict_forms(connection, () if refill_jmdict_forms else tuple(source.data.id for source in sources))
+
+    if SERVER_CONFIG["materialize_responses"]:
+        if callback is not None:
+            callback("Materializing lookup responses...")
+        if has_materialized_responses(connection):
+            with connection:
+                connection.execute(affected_expressions_sql, source_ids)
+                if refill_jmdict_forms:
+                    connection.execute(affected_jmdict_forms_sql)
+            expressions = [row[0] for row in connection.execute("SELECT expression FROM temp.affected_expressions")]
+            materialize_responses(connection, expressions)
+        else:
+            materialize_responses(connection)
+
+
+def add_sources_entries(
+    connection: sqlite3.Connection,
+    sources: list[AudioSource],
+    callback: Optional[Callable[[str], None]] = None,
+    jobs: int = 1,
+):
+    """
+    adds the entries of the sources to staged_entries, in the order of the list.
+    With more than one job, up to `jobs` sources are read at once, each in its own process
+    (reading a source is mostly spent in Python, i.e. parsing entries.json, so threads wouldn't help).
+    Every process writes its rows to its own staging database, which are then merged
+    in the order of the list, so the result is the same as reading the sources one by one
+    """
+    # more processes than cores only adds the cost of starting them
+    jobs = min(jobs, len(sources), os.cpu_count() or 1)
+    if jobs <= 1:
+        for source in sources:
+            add_source_entries(connection, source, callback)
+        return
+
+    with tempfile.TemporaryDirectory(prefix=STAGING_DIR_PREFIX, dir=get_data_dir()) as staging_dir:
+        staging_paths = [Path(staging_dir, f"{i}.db") for i in range(len(sources))]
+
+        print(f"(init_db) Adding entries from {len(sources)} sources with {jobs} jobs...")
+        if callback is not None:
+            callback(f"Adding entries from {len(sources)} sources...")
+        # spawn instead of fork (the default on Linux), as the server's threads may be running
+        executor = ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("spawn"))
+        try:
+            futures = {
+                executor.submit(read_source_to_staging_db, source.data.id, str(path)): source
+                for source, path in zip(sources, staging_paths)
+            }
+            for done, future in enumerate(as_completed(futures), start=1):
+                source = futures[future]
+                count, elapsed = future.result()
+                print(
+                    f"(init_db) Added {count} entries from {source.data.id} in {elapsed:.2f}s "
+                    f"({count / elapsed if elapsed > 0 else 0:.0f} rows/sec)"
+                )
+                if callback is not None:
+                    callback(f"Added entries from {source.data.id} ({done}/{len(sources)})...")
+        finally:
+            # the other sources aren't needed anymore if one of them failed
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        if callback is not None:
+            callback("Merging entries...")
+        start = time.perf_counter()
+        for path in staging_paths:
+            merge_staging_db(connection, path)
+        print(f"(init_db) Merged entries in {time.perf_counter() - start:.2f}s")
+
+
+def read_source_to_staging_db(source_id: str, staging_path: str) -> tuple[int, float]:
+    """
+    runs in a worker process (see add_sources_entries): writes the entries and fingerprint of the source
+    to a new staging database. Returns the number of entries, and the seconds it took
+    """
+    start = time.perf_counter()
+    source = ALL_SOURCES[source_id]
+    connection = sqlite3.connect(staging_path)
+    try:
+        # the file is deleted once it's merged, so it doesn't have to survive a crash
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        create_staging_schema(connection)
+        with connection:
+            fingerprint = take_fingerprint(source)
+            cursor = connection.executemany("INSERT INTO entries VALUES (?,?,?,?,?,?)", source.get_entries())
+            count = cursor.rowcount
+            cursor.close()
+            write_fingerprint(connection, source_id, fingerprint)
+    finally:
+        connection.close()
+    return count, time.perf_counter() - start
+
+
+def create_staging_schema(connection: sqlite3.Connection):
+    """
+    creates the tables of a staging database: the rows as a source yields them, and the source's fingerprint
+    """
+    connection.execute("""
+        CREATE TABLE entries (
+            expression text NOT NULL,
+            reading text,
+            source text NOT NULL,
+            speaker text,
+            display text,
+            file text NOT NULL
+        );
+    """)
+    connection.execute("""
+        CREATE TABLE fingerprints (
+            name text PRIMARY KEY NOT NULL,
+            fingerprint text NOT NULL,
+            directories text NOT NULL,
+            files text NOT NULL
+        );
+    """)
+
+
+def merge_staging_db(connection: sqlite3.Connection, staging_path: Path):
+    """
+    adds the entries of a staging database (see read_source_to_staging_db) to staged_entries,
+    the same way write_entries() would have added them
+    """
+    # sqlite can't attach a database within a transaction.
+    # The database is a temporary file until it is complete, so this doesn't have to be a single transaction
+    connection.commit()
+    connection.execute("ATTACH DATABASE ? AS staging", (str(staging_path),))
+    try:
+        with connection:
+            # new names get the next ids, in the order they first appear
+            connection.execute("""
+                INSERT INTO sources (name)
+                SELECT source FROM staging.entries
+                WHERE source NOT IN (SELECT name FROM sources)
+                GROUP BY source
+                ORDER BY min(rowid)
+            """)
+            connection.execute("""
+                INSERT INTO speakers (name)
+                SELECT speaker FROM staging.entries
+                WHERE speaker IS NOT NULL AND speaker NOT IN (SELECT name FROM speakers)
+                GROUP BY speaker
+                ORDER BY min(rowid)
+            """)
+            connection.execute("""
+                INSERT INTO temp.staged_entries (expression, reading, source_id, speaker_id, display, file)
+                SELECT e.expression, e.reading, s.id, sp.id, e.display, e.file
+                FROM staging.entries AS e
+                JOIN sources AS s ON s.name = e.source
+                LEFT JOIN speakers AS sp ON sp.name = e.speaker
+                ORDER BY e.rowid
+            """)
+            connection.execute("INSERT OR REPLACE INTO fingerprints SELECT * FROM staging.fingerprints")
+    finally:
+        connection.execute("DETACH DATABASE staging")
+
+
+def add_source_entries(connection: sqlite3.Connection, source: AudioSource, callback: Optional[Callable[[str], None]] = None):
+    """
+    adds the entries of a source to staged_entries, along with the fingerprint of its files
+    """
+    print(f"(init_db) Adding entries from {source.data.id}...")
+    if callback is not None:
+        callback(f"Adding entries from {source.data.id}...")
+    start = time.perf_counter()
+    fingerprint = take_fingerprint(source)
+    count = write_entries(connection, source.get_entries())
+    write_fingerprint(connection, source.data.id, fingerprint)
+    elapsed = time.perf_counter() - start
+    print(
+        f"(init_db) Added {count} entries from {source.data.id} in {elapsed:.2f}s "
+        f"({count / elapsed if elapsed > 0 else 0:.0f} rows/sec)"
+    )
+
+
+def write_fingerprint(connection: sqlite3.Connection, name: str, fingerprint: SourceFingerprint):
+    connection.execute(
+        "INSERT OR REPLACE INTO fingerprints (name, fingerprint, directories, files) VALUES (?, ?, ?, ?)",
+        (
+            name,
+            fingerprint.fingerprint,
+            json.dumps(fingerprint.directories, ensure_ascii=False),
+            json.dumps(fingerprint.files, ensure_ascii=False),
+        ),
+    )
+
+
+def create_schema(connection: sqlite3.Connection):
+    """
+    creates the (empty) tables of entries.db, and the temporary table that write_entries() fills
+    """
+    cursor = connection.cursor()
+
+    # - sources / speakers: the ids of the source and speaker names, so every row of audio_entries
+    #   stores a small integer instead of repeating the name
+    cursor.execute("""
+        CREATE TABLE sources (
+            id integer PRIMARY KEY NOT NULL,
+            name text NOT NULL UNIQUE
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE speakers (
+            id integer PRIMARY KEY NOT NULL,
+            name text NOT NULL UNIQUE
+        );
+    """)
+
+    # - expression (term): the main lookup key, potentially in kanji
+    # - id: the order the row was added in. Rows are returned in this order
+    #   when execute_query() doesn't otherwise order them
+    # - reading: kana only version of expression. If null, then no reading was
+    #   available from the source.
+    # - source_id: one of "jpod", "jpod_alternate", "forvo", "nhk16", "shinmeikai8"
+    # - speaker_id: contains the forvo username. Null for anything that isn't forvo.
+    # - display: contains the display for nhk16 and shinmeikai8. Otherwise Null.
+    # - file: file path to the audio, with the root determined by get_data_path()
+    #   Allows for easier sorting for more ideal results without post processing
+    #   or unions + subqueries.
+    #
+    # NOTES:
+    # - the reading can be exactly the same as the expression (for kana only terms)
+    # - the reading can be in katakana
+    # - WITHOUT ROWID stores the rows in the primary key's b-tree, so all rows of an expression
+    #   are next to each other, and a lookup reads them without a separate index.
+    #   The reading can't be part of the key, as key columns can't be null.
+    #   No other index is needed (see execute_query and execute_batch_query)
+    cursor.execute("""
+        CREATE TABLE audio_entries (
+            expression text NOT NULL,
+            id integer NOT NULL,
+            reading text,
+            source_id integer NOT NULL REFERENCES sources(id),
+            speaker_id integer REFERENCES speakers(id),
+            display text,
+            file text NOT NULL,
+            PRIMARY KEY (expression, id)
+        ) WITHOUT ROWID;
+    """)
+
+    # the rows with the names of their source and speaker, in the columns of the original
+    # entries table (see ROWID..FILE in consts.py). Every query reads from this view.
+    # AnkiConnect Android reads it as well (see write_android_entries_table)
+    cursor.execute("""
+        CREATE VIEW entries (id, expression, reading, source, speaker, display, file) AS
+            SELECT e.id, e.expression, e.reading, s.name, sp.name, e.display, e.file
+            FROM audio_entries AS e
+            JOIN sources AS s ON s.id = e.source_id
+            LEFT JOIN speakers AS sp ON sp.id = e.speaker_id;
+    """)
+
+    # - name: a source id, or JMDICT_FORMS_FINGERPRINT_NAME
+    # - fingerprint / directories / files: see fingerprint.py. directories and files are json lists
+    cursor.execute("""
+        CREATE TABLE fingerprints (
+            name text PRIMARY KEY NOT NULL,
+            fingerprint text NOT NULL,
+            directories text NOT NULL,
+            files text NOT NULL
+        );
+    """)
+
+    # the keys of the rows of audio_entries that fill_jmdict_forms() added,
+    # so they can be replaced on their own once jmdict_forms.json changes (see update_sources)
+    cursor.execute("""
+        CREATE TABLE jmdict_forms_entries (
+            expression text NOT NULL,
+            id integer NOT NULL,
+            PRIMARY KEY (expression, id)
+        ) WITHOUT ROWID;
+    """)
+    cursor.close()
+
+    create_staged_entries_table(connection)
+
+
+def create_staged_entries_table(connection: sqlite3.Connection):
+    """
+    creates the temporary table that write_entries() fills. Its ids continue after the ids of audio_entries,
+    so rows added to an existing database are ordered after the rows that are already in it
+    """
+    cursor = connection.cursor()
+    # rows are added here first, in the order they are written (see move_staged_entries)
+    cursor.execute("""
+        CREATE TEMP TABLE staged_entries (
+            id integer PRIMARY KEY AUTOINCREMENT,
+            expression text NOT NULL,
+            reading text,
+            source_id integer NOT NULL,
+            speaker_id integer,
+            display text,
+            file text NOT NULL
+        );
+    """)
+    cursor.execute("""
+        INSERT INTO temp.sqlite_sequence (name, seq)
+        SELECT 'staged_entries', coalesce(max(id), 0) FROM audio_entries
+    """)
+    cursor.close()
+
+
+def write_entries(connection: sqlite3.Connection, rows: Iterable[EntryRow]) -> int:
+    """
+    adds the rows yielded by a source to staged_entries, returning the number of rows.
+    executemany() reads the rows straight from the generator, so they are never all held in memory,
+    and sqlite only prepares the statement once. Doesn't commit (build_db() commits once at the end).
+    move_staged_entries() must be called afterwards
+    """
+    source_ids: dict[str, int] = dict(connection.execute("SELECT name, id FROM sources"))
+    speaker_ids: dict[str, int] = dict(connection.execute("SELECT name, id FROM speakers"))
+    known_sources = len(source_ids)
+    known_speakers = len(speaker_ids)
+
+    def staged_rows():
+        for expression, reading, source, speaker, display, file in rows:
+            source_id = source_ids.get(source)
+            if source_id is None:
+                source_id = source_ids[source] = len(source_ids) + 1
+            speaker_id = None
+            if speaker is not None:
+                speaker_id = speaker_ids.get(speaker)
+                if speaker_id is None:
+                    speaker_id = speaker_ids[speaker] = len(speaker_ids) + 1
+            yield (expression, reading, source_id, speaker_id, display, file)
+
+    cursor = connection.executemany(INSERT_ENTRY_SQL, staged_rows())
+    count = cursor.rowcount
+    # ids are handed out in order, so the new names are the ones with the highest ids
+    cursor.executemany(
+        "INSERT INTO sources (id, name) VALUES (?, ?)",
+        ((id, name) for name, id in source_ids.items() if id > known_sources),
+    )
+    cursor.executemany(
+        "INSERT INTO speakers (id, name) VALUES (?, ?)",
+        ((id, name) for name, id in speaker_ids.items() if id > known_speakers),
+    )
+    cursor.close()
+    return count
+
+
+def move_staged_entries(connection: sqlite3.Connection):
+    """
+    moves the rows added by write_entries() into audio_entries. They are inserted in the order of its
+    primary key, so every page is filled once, instead of pages all over the table being split on each insert.
+    The staged ids keep counting up, so rows that are moved later are ordered after the ones moved before
+    """
+    connection.execute("""
+        INSERT INTO audio_entries (expression, id, reading, source_id, speaker_id, display, file)
+        SELECT expression, id, reading, source_id, speaker_id, display, file
+        FROM temp.staged_entries
+        ORDER BY expression, id
+    """)
+    connection.execute("DELETE FROM temp.staged_entries")
+
+
+def write_android_entries_table(cursor: sqlite3.Cursor):
+    """
+    AnkiConnect Android reads the entries table of android.db directly, so it gets the original
+    entries table (and indices) instead of the view, and the tables behind the view are removed
+    """
+    cursor.execute("""
+        CREATE TABLE android_entries (
+            id integer PRIMARY KEY NOT NULL,
+            expression text NOT NULL,
+            reading text,
+            source text NOT NULL,
+            speaker text,
+            display text,
+            file text NOT NULL
+        );
+    """)
+    cursor.execute("INSERT INTO android_entries SELECT * FROM entries ORDER BY id")
+    cursor.execute("DROP VIEW entries")
+    cursor.execute("DROP TABLE audio_entries")
+    cursor.execute("DROP TABLE sources")
+    cursor.execute("DROP TABLE speakers")
+    cursor.execute("DROP TABLE IF EXISTS fingerprints")
+    cursor.execute("DROP TABLE IF EXISTS jmdict_forms_entries")
+    cursor.execute("ALTER TABLE android_entries RENAME TO entries")
+    cursor.execute("CREATE INDEX idx_reading ON entries(reading);")
+    cursor.execute("CREATE INDEX idx_speaker ON entries(speaker);")
+    cursor.execute("CREATE INDEX idx_expr_reading ON entries(expression, reading);")
+
+
+def fsync_file(path: Path):
+    """
+    makes sure the file is fully written to disk before it replaces the old database,
+    so a crash can't leave behind a partially written entries.db
+    """
+    with open(path, "rb+") as f:
+        os.fsync(f.fileno())
+
+
+def replace_db_file(src: Path, dst: Path):
+    """
+    atomically replaces dst with src. Connections that still have the old file open keep reading it.
+
+    On Windows, a file that is open can't be replaced, so the server's idle connections
+    are closed and the rename is retried (connections that are in use are closed once their request is done)
+    """
+    for attempt in range(REPLACE_DB_RETRIES):
+        try:
+            os.replace(src, dst)
+            break
+        except PermissionError:
+            if attempt == REPLACE_DB_RETRIES - 1:
+                raise
+            notify_db_changed()
+            time.sleep(REPLACE_DB_RETRY_DELAY * (attempt + 1))
+
+    # the rename itself must be on disk as well (not possible on Windows, where it isn't needed)
+    if os.name != "nt":
+        dir_fd = os.open(dst.parent, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+def remove_db_file(path: Path):
+    for file in (path, path.with_name(path.name + "-journal")):
+        try:
+            file.unlink()
+        except FileNotFoundError:
+            pass
 
 
 def execute_query(cursor: sqlite3.Connection, qcomps: QueryComponents) -> list[Any]:
@@ -501,52 +1339,73 @@ def execute_query(cursor: sqlite3.Connection, qcomps: QueryComponents) -> list[A
     #      reading
     #    """
 
-    if qcomps.reading is None: # do not check reading at all
-        params = [qcomps.expression]
+    has_reading = qcomps.reading is not None
+    filter_sources = len(qcomps.sources) != len(ALL_SOURCES)
+    query = get_query_template(has_reading, len(qcomps.sources), filter_sources, len(qcomps.user))
+
+    # parameters in the same order as the placeholders of the template
+    params = [qcomps.expression]
+    if has_reading:
+        params.append(qcomps.reading)
+    if filter_sources:
+        params += qcomps.sources
+    params += qcomps.user
+    params += qcomps.sources
+    params += qcomps.user
+
+    # print(query)
+    # print(params)
+
+    return cursor.execute(query, params).fetchall()
+
+
+@lru_cache(maxsize=256)
+def get_query_template(has_reading: bool, n_sources: int, filter_sources: bool, n_users: int) -> str:
+    """
+    builds the SQL of execute_query for one shape of lookup.
+    The SQL only depends on the shape, so lookups of the same shape reuse the same string,
+    which also lets sqlite3 reuse the prepared statement from the connection's statement cache.
+    """
+    if not has_reading: # do not check reading at all
         query_where = f"""
             expression = ?
         """
     else:
-        params = [qcomps.expression, qcomps.reading]
         query_where = f"""
             expression = ?
             AND (reading IS NULL OR reading = ?)
         """
 
     # filters by sources if necessary
-    if len(qcomps.sources) != len(ALL_SOURCES):
-        n_question_marks = ",".join(["?"] * len(qcomps.sources))
+    if filter_sources:
+        n_question_marks = ",".join(["?"] * n_sources)
         query_where += f"""
             AND (source in ({n_question_marks}))
         """
-        params += qcomps.sources
 
     # filters by speakers if necessary
-    if len(qcomps.user) > 0:
-        n_question_marks = ",".join(["?"] * len(qcomps.user))
+    if n_users > 0:
+        n_question_marks = ",".join(["?"] * n_users)
         query_where += f"""
             AND (speaker IS NULL OR speaker in ({n_question_marks}))
         """
-        params += qcomps.user
 
     # orders by source
     query_order = (
         "(CASE source "
-        + "\n".join(f"WHEN ? THEN {i}" for i in range(len(qcomps.sources)))
+        + "\n".join(f"WHEN ? THEN {i}" for i in range(n_sources))
         + " END)"
     )
-    params += qcomps.sources
 
     # orders by speakers if necessary
-    if len(qcomps.user) > 0:
+    if n_users > 0:
         query_order += (
             ",\n(CASE speaker "
-            + "\n".join(f"WHEN ? THEN {i}" for i in range(len(qcomps.user)))
+            + "\n".join(f"WHEN ? THEN {i}" for i in range(n_users))
             + " END)"
         )
-        params += qcomps.user
 
-    query = f"""
+    return f"""
         SELECT * FROM entries WHERE (
             {query_where}
         )
@@ -555,7 +1414,96 @@ def execute_query(cursor: sqlite3.Connection, qcomps: QueryComponents) -> list[A
           reading
         """
 
-    # print(query)
-    # print(params)
 
-    return cursor.execute(query, params).fetchall()
+def execute_batch_query(connection: sqlite3.Connection, qcomps_list: list[QueryComponents]) -> list[list[Any]]:
+    """
+    execute_query() for many lookups at once: the lookups are written to temporary tables,
+    and answered with a single query joined against the entries table.
+    Returns the rows of each lookup (in the same order as qcomps_list), ordered the same way
+    execute_query() would order them.
+    """
+    # - batch_items: one row per lookup
+    #   - filter_sources mirrors the `len(qcomps.sources) != len(ALL_SOURCES)` check of execute_query
+    # - batch_sources / batch_users: the position of each source / speaker, used for ordering.
+    #   only the first occurrence of a duplicate is kept, like the first matching CASE branch.
+    #   Entries with a source / speaker not in the list get a NULL position (from the LEFT JOIN),
+    #   which is what the CASE expression would return as well.
+    # - temporary tables are allowed even on read-only (mode=ro) connections
+    cursor = connection.cursor()
+    try:
+        cursor.execute("""
+            CREATE TEMP TABLE batch_items (
+                item INTEGER PRIMARY KEY,
+                expression TEXT NOT NULL,
+                reading TEXT,
+                filter_sources INTEGER NOT NULL,
+                filter_users INTEGER NOT NULL
+            )
+        """)
+        cursor.execute("""
+            CREATE TEMP TABLE batch_sources (
+                item INTEGER NOT NULL,
+                source TEXT NOT NULL,
+                rank INTEGER NOT NULL,
+                PRIMARY KEY (item, source)
+            )
+        """)
+        cursor.execute("""
+            CREATE TEMP TABLE batch_users (
+                item INTEGER NOT NULL,
+                speaker TEXT NOT NULL,
+                rank INTEGER NOT NULL,
+                PRIMARY KEY (item, speaker)
+            )
+        """)
+
+        cursor.executemany(
+            "INSERT INTO batch_items VALUES (?, ?, ?, ?, ?)",
+            (
+                (i, qcomps.expression, qcomps.reading, len(qcomps.sources) != len(ALL_SOURCES), len(qcomps.user) > 0)
+                for i, qcomps in enumerate(qcomps_list)
+            ),
+        )
+        cursor.executemany(
+            "INSERT OR IGNORE INTO batch_sources VALUES (?, ?, ?)",
+            ((i, source, rank) for i, qcomps in enumerate(qcomps_list) for rank, source in enumerate(qcomps.sources)),
+        )
+        cursor.executemany(
+            "INSERT OR IGNORE INTO batch_users VALUES (?, ?, ?)",
+            ((i, speaker, rank) for i, qcomps in enumerate(qcomps_list) for rank, speaker in enumerate(qcomps.user)),
+        )
+
+        # e.id only breaks ties that execute_query leaves unspecified
+        query = """
+            SELECT i.item, e.* FROM batch_items AS i
+            JOIN entries AS e ON (
+                    e.expression = i.expression
+                AND (i.reading IS NULL OR e.reading IS NULL OR e.reading = i.reading)
+            )
+            LEFT JOIN batch_sources AS s ON (s.item = i.item AND s.source = e.source)
+            LEFT JOIN batch_users AS u ON (u.item = i.item AND u.speaker = e.speaker)
+            WHERE (
+                    (NOT i.filter_sources OR s.source IS NOT NULL)
+                AND (NOT i.filter_users OR e.speaker IS NULL OR u.speaker IS NOT NULL)
+            )
+            ORDER BY
+              i.item,
+              s.rank,
+              u.rank,
+              e.reading,
+              e.id
+        """
+
+        results: list[list[Any]] = [[] for _ in qcomps_list]
+        for row in cursor.execute(query):
+            results[row[0]].append(row[1:])
+        return results
+    finally:
+        # the INSERTs above implicitly began a transaction, which would keep the read lock on the
+        # database while the connection sits idle in the pool (so entries.db couldn't be written).
+        # Ended before the DROPs, so they aren't rolled back with it
+        connection.rollback()
+        cursor.execute("DROP TABLE IF EXISTS temp.batch_items")
+        cursor.execute("DROP TABLE IF EXISTS temp.batch_sources")
+        cursor.execute("DROP TABLE IF EXISTS temp.batch_users")
+        cursor.close()
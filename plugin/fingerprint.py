@@ -0,0 +1,135 @@
+"""
+Fingerprints of what each source reads to make its entries, stored in entries.db,
+so that only the sources whose files changed have to be read again (see db_utils.update_db).
+
+A fingerprint covers:
+- the type and media directory of the source (from the config or source_meta.json)
+- the contents of source_meta.json and of the files the source reads besides the audio files
+  (see AudioSource.get_input_files, i.e. index.json). Their size and modification time are stored
+  along with their hash, so a file is only hashed again once one of them changed
+  (these files can be hundreds of MB, and are checked on every start)
+- the modification time of every directory in the media directory.
+  Adding, removing or renaming a file changes the modification time of its directory,
+  so checking a fingerprint only stat()s the directories it was taken with,
+  instead of listing every audio file again. A new subdirectory changes its parent directory.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import NamedTuple, Optional, Sequence
+
+from .source.audio_source import AudioSource
+
+# size of the reads used to hash a file
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class SourceFingerprint(NamedTuple):
+    fingerprint: str
+    # every directory in the media dir, relative to it ("" is the media dir itself)
+    directories: list[str]
+    # [path relative to the media dir, size, mtime_ns, sha256] of every input file
+    # (see get_file_info, the last three are None if the file doesn't exist)
+    files: list[list]
+
+
+def hash_file(path: Path) -> Optional[str]:
+    """
+    the sha256 of the file's contents, or None if it doesn't exist
+    """
+    digest = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            while chunk := f.read(HASH_CHUNK_SIZE):
+                digest.update(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def get_mtime_ns(path: Path) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def list_directories(media_dir: Path) -> list[str]:
+    """
+    every directory in media_dir (including media_dir itself), without following symlinks to directories
+    (like scan_media_files)
+    """
+    directories = []
+    stack = [""]
+    while stack:
+        relative_dir = stack.pop()
+        directories.append(relative_dir)
+        try:
+            with os.scandir(media_dir.joinpath(relative_dir)) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(os.path.join(relative_dir, entry.name) if relative_dir else entry.name)
+        except OSError:
+            continue
+    return sorted(directories)
+
+
+def get_file_info(path: Path, known: Optional[Sequence] = None) -> list:
+    """
+    [size, mtime_ns, sha256] of the file, or [None, None, None] if it doesn't exist.
+    known is the info of the file from before: if its size and modification time are the same,
+    its hash is reused instead of reading the whole file again
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return [None, None, None]
+    if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+        return [stat.st_size, stat.st_mtime_ns, known[2]]
+    return [stat.st_size, stat.st_mtime_ns, hash_file(path)]
+
+
+def get_input_files_info(source: AudioSource, known_files: Sequence[Sequence] = ()) -> list[list]:
+    """
+    the info (see get_file_info) of source_meta.json and the source's input files, with their path
+    relative to the media dir. known_files is the result of a previous call
+    """
+    media_dir = source.get_media_dir_path()
+    known = {file[0]: file[1:] for file in known_files}
+    files = []
+    for path in [media_dir.joinpath("source_meta.json")] + source.get_input_files():
+        relative_path = path.relative_to(media_dir).as_posix()
+        files.append([relative_path] + get_file_info(path, known.get(relative_path)))
+    return files
+
+
+def compute_fingerprint(source: AudioSource, directories: list[str], files: list[list]) -> str:
+    media_dir = source.get_media_dir_path()
+    inputs = [
+        type(source).__name__,
+        source.data.media_dir,
+        [(relative_path, sha256) for relative_path, _, _, sha256 in files],
+        [(directory, get_mtime_ns(media_dir.joinpath(directory))) for directory in directories],
+    ]
+    return hashlib.sha256(json.dumps(inputs, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def take_fingerprint(source: AudioSource) -> SourceFingerprint:
+    """
+    must be taken before the source's entries are read, so changes made while they are read
+    are picked up the next time
+    """
+    directories = list_directories(source.get_media_dir_path())
+    files = get_input_files_info(source)
+    return SourceFingerprint(compute_fingerprint(source, directories, files), directories, files)
+
+
+def fingerprint_matches(source: AudioSource, fingerprint: str, directories: list[str], files: list[list]) -> bool:
+    """
+    whether nothing the source reads has changed since the fingerprint was taken
+    """
+    return compute_fingerprint(source, directories, get_input_files_info(source, files)) == fingerprint
@@ -9,6 +9,8 @@ from aqt.operations import QueryOp
 
 from .db_utils import (
     init_db,
+    update_db,
+    get_outdated_sources,
     android_gen,
     get_num_files_per_source,
     table_exists_and_has_data,
@@ -31,6 +33,24 @@ def attempt_init_db_gui():
         regenerate_database_operation()
     elif table_must_be_updated():
         regenerate_database_operation("Updating local audio database.")
+    else:
+        # checking the files of every source can take a while, so it runs in the background
+        # (without a progress window, as there is usually nothing to update)
+        QueryOp(
+            parent=mw,
+            op=lambda _: get_outdated_sources(),
+            success=update_outdated_sources,
+        ).run_in_background()
+
+
+def update_outdated_sources(outdated_sources: Optional[list[str]]):
+    """
+    updates the database with the result of get_outdated_sources(), once it was checked in the background
+    """
+    if outdated_sources is None:
+        regenerate_database_operation("Updating local audio database.")
+    elif outdated_sources:
+        update_database_operation(outdated_sources)
 
 
 def regenerate_database_operation(msg: Optional[str]=None):
@@ -84,6 +104,43 @@ def regenerate_database_success(start_time: float) -> None:
     showInfo(f"Local audio database was successfully regenerated in {total_time} seconds!")
 
 
+def update_database_operation(source_ids: list[str]):
+    """
+    re-reads only the given sources (see db_utils.update_db)
+    """
+    base_msg = f"Updating local audio database ({', '.join(source_ids)}).\nThis may take a while."
+
+    start_time = time.time()
+
+    op = QueryOp(
+        parent=mw,
+        op=lambda _: update_database_action(source_ids, base_msg),
+        success=lambda _: update_database_success(start_time),
+    )
+
+    # note: QueryOp.with_progress() was broken until Anki 2.1.50
+    op.with_progress(base_msg).run_in_background()
+
+
+def update_database_action(source_ids: list[str], progress_msg: str) -> int:
+    def callback(msg: str):
+        mw.taskman.run_on_main(
+            lambda: mw.progress.update(
+                label=progress_msg + "\n\n" + msg,
+            )
+        )
+
+    update_db(source_ids, callback)
+    return 1
+
+
+def update_database_success(start_time: float) -> None:
+    end_time = time.time()
+    total_time = "{:.1f}".format(end_time - start_time)
+
+    showInfo(f"Local audio database was successfully updated in {total_time} seconds!")
+
+
 def generate_android_database_operation():
     start_time = time.time()
 
@@ -0,0 +1,184 @@
+"""
+Helpers for serving audio files over HTTP (mime types, conditional and range requests),
+shared by the server engines.
+"""
+
+from __future__ import annotations
+
+import email.utils
+from http import HTTPStatus
+from typing import Mapping, NamedTuple, Optional
+
+
+# TODO: maybe use mimetypes.guess_type?
+# https://docs.python.org/3/library/mimetypes.html
+SUFFIX_TO_MIME_TYPE = {
+    ".mp3": "audio/mpeg",
+    ".aac": "audio/aac",
+    ".m4a": "audio/mp4",
+    ".ogg": "audio/ogg",
+    ".oga": "audio/ogg",
+    ".opus": "audio/ogg",
+    ".flac": "audio/flac",
+    ".wav": "audio/wav",
+}
+
+
+class AudioResponseHead(NamedTuple):
+    status: HTTPStatus
+    headers: list[tuple[str, str]]
+    # (offset, count) part of the file to send as the body, None if there is no body
+    body: Optional[tuple[int, int]]
+
+
+def make_etag(size: int, mtime_ns: int) -> str:
+    return f'"{size:x}-{mtime_ns:x}"'
+
+
+def make_last_modified(mtime_ns: int) -> str:
+    return email.utils.formatdate(mtime_ns / 1_000_000_000, usegmt=True)
+
+
+def _parse_http_date(value: str) -> Optional[float]:
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def _etag_in_list(etag: str, header: str) -> bool:
+    if header.strip() == "*":
+        return True
+    # weak comparison, as specified for If-None-Match
+    tags = [t.strip().removeprefix("W/") for t in header.split(",")]
+    return etag in tags
+
+
+def is_not_modified(headers: Mapping[str, str], etag: str, mtime_ns: int) -> bool:
+    """
+    whether a 304 Not Modified can be sent instead of the file.
+    If-None-Match takes precedence over If-Modified-Since (RFC 9110 13.2.2)
+    """
+    if_none_match = headers.get("If-None-Match", None)
+    if if_none_match is not None:
+        return _etag_in_list(etag, if_none_match)
+
+    if_modified_since = headers.get("If-Modified-Since", None)
+    if if_modified_since is not None:
+        since = _parse_http_date(if_modified_since)
+        # HTTP dates only have a resolution of one second
+        return since is not None and mtime_ns // 1_000_000_000 <= since
+
+    return False
+
+
+def if_range_matches(if_range: Optional[str], etag: str, last_modified: str) -> bool:
+    """
+    whether the Range header should be used. If-Range can either be an ETag or a date
+    """
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        # strong comparison, so weak tags never match
+        return if_range == etag
+    return if_range == last_modified
+
+
+def _is_digits(value: str) -> bool:
+    # str.isdigit() is also true for other scripts' digits and superscripts (i.e. "٣" and "²")
+    return value.isascii() and value.isdigit()
+
+
+def parse_range_header(value: str, size: int) -> Optional[tuple[int, int]]:
+    """
+    parses a "bytes=start-end" header into an inclusive (start, end) pair.
+
+    Returns None if the header should be ignored, i.e. it is malformed, uses another unit,
+    or asks for multiple ranges (sending the entire file is allowed in that case).
+    Raises ValueError if the range is valid but cannot be satisfied.
+    """
+    unit, sep, ranges = value.partition("=")
+    if not sep or unit.strip().lower() != "bytes" or "," in ranges:
+        return None
+
+    start_str, sep, end_str = ranges.strip().partition("-")
+    start_str = start_str.strip()
+    end_str = end_str.strip()
+    if not sep or not (_is_digits(start_str) or start_str == "") or not (_is_digits(end_str) or end_str == ""):
+        return None
+
+    if start_str == "":
+        # suffix range: the last N bytes
+        if end_str == "":
+            return None
+        suffix_length = int(end_str)
+        if suffix_length == 0 or size == 0:
+            raise ValueError(f"unsatisfiable range: {value}")
+        return max(0, size - suffix_length), size - 1
+
+    start = int(start_str)
+    if end_str != "" and int(end_str) < start:
+        return None
+    if start >= size:
+        raise ValueError(f"unsatisfiable range: {value}")
+    end = size - 1 if end_str == "" else min(int(end_str), size - 1)
+    return start, end
+
+
+def audio_response_head(
+    request_headers: Mapping[str, str],
+    mime_type: str,
+    size: int,
+    mtime_ns: int,
+    head_only: bool = False,
+) -> AudioResponseHead:
+    """
+    determines the status, headers and body range of an audio response,
+    handling conditional and range requests
+    """
+    etag = make_etag(size, mtime_ns)
+    last_modified = make_last_modified(mtime_ns)
+
+    if is_not_modified(request_headers, etag, mtime_ns):
+        headers = [
+            ("ETag", etag),
+            ("Last-Modified", last_modified),
+            ("Access-Control-Allow-Origin", "*"),
+        ]
+        return AudioResponseHead(HTTPStatus.NOT_MODIFIED, headers, None)
+
+    byte_range = None
+    range_header = request_headers.get("Range", None)
+    if range_header is not None and if_range_matches(request_headers.get("If-Range", None), etag, last_modified):
+        try:
+            byte_range = parse_range_header(range_header, size)
+        except ValueError:
+            headers = [
+                ("Content-Range", f"bytes */{size}"),
+                ("Content-Length", "0"),
+                ("Access-Control-Allow-Origin", "*"),
+            ]
+            return AudioResponseHead(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE, headers, None)
+
+    headers = []
+    if byte_range is None:
+        status = HTTPStatus.OK
+        offset, count = 0, size
+    else:
+        status = HTTPStatus.PARTIAL_CONTENT
+        start, end = byte_range
+        offset, count = start, end - start + 1
+        headers.append(("Content-Range", f"bytes {start}-{end}/{size}"))
+    headers += [
+        ("Content-type", mime_type),
+        ("Content-length", str(count)),
+        ("Accept-Ranges", "bytes"),
+        ("ETag", etag),
+        ("Last-Modified", last_modified),
+        ("Access-Control-Allow-Origin", "*"),
+    ]
+
+    if head_only:
+        return AudioResponseHead(status, headers, None)
+    return AudioResponseHead(status, headers, (offset, count))
@@ -0,0 +1,195 @@
+"""
+Reads the items of a large JSON array or object one at a time, instead of json.load()ing the whole file.
+
+Only the current item is ever decoded (with json.JSONDecoder.raw_decode), and the file is read in chunks,
+so memory stays about the same no matter how large the file is. Members that are skipped on the way
+to the container (i.e. "headwords" while looking for "files") are scanned over without being decoded.
+"""
+
+from __future__ import annotations
+
+import json
+import re
+from typing import Any, Iterator, Optional, Sequence, TextIO
+
+# number of characters read from the file at once
+READ_CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE_RE = re.compile(r"[ \t\n\r]*")
+# the characters that matter when skipping over an array or object (outside of strings)
+_STRUCTURE_RE = re.compile(r'["\[\]{}]')
+# the characters that can follow a complete value
+_VALUE_END_CHARS = frozenset(" \t\n\r,:]}")
+# the characters that can end a string
+_STRING_RE = re.compile(r'["\\]')
+
+_decoder = json.JSONDecoder()
+
+
+class _Reader:
+    def __init__(self, f: TextIO):
+        self.f = f
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self, size: Optional[int] = None) -> bool:
+        """
+        reads more of the file into the buffer, dropping what was already consumed.
+        Returns False at the end of the file
+        """
+        if self.eof:
+            return False
+        chunk = self.f.read(READ_CHUNK_SIZE if size is None else size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def error(self, message: str) -> json.JSONDecodeError:
+        return json.JSONDecodeError(message, self.buffer, self.pos)
+
+    def peek(self) -> str:
+        """
+        the next character that isn't whitespace (without consuming it), or "" at the end of the file
+        """
+        while True:
+            self.pos = _WHITESPACE_RE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.read_more():
+                return ""
+
+    def expect(self, char: str):
+        if self.peek() != char:
+            raise self.error(f"Expecting '{char}'")
+        self.pos += 1
+
+    def decode(self) -> Any:
+        """
+        decodes the next value
+        """
+        self.peek()
+        size = READ_CHUNK_SIZE
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+                # a number at the end of the buffer may continue in the next chunk (i.e. "1.5" of "1.5e10"),
+                # so it's only complete once the character after it is known
+                if (end < len(self.buffer) and self.buffer[end] in _VALUE_END_CHARS) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # reads larger chunks each time, so a large value isn't decoded over and over
+            self.read_more(size)
+            size *= 2
+
+    def skip(self):
+        """
+        moves past the next value without decoding it
+        """
+        if self.peek() not in ("[", "{"):
+            self.decode()
+            return
+
+        depth = 0
+        while True:
+            match = _STRUCTURE_RE.search(self.buffer, self.pos)
+            if match is None:
+                self.pos = len(self.buffer)
+                if not self.read_more():
+                    raise self.error("Unterminated array or object")
+                continue
+
+            self.pos = match.end()
+            char = match.group()
+            if char == '"':
+                self.skip_string()
+            elif char in ("[", "{"):
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def skip_string(self):
+        # the opening quote was already consumed
+        while True:
+            match = _STRING_RE.search(self.buffer, self.pos)
+            # an escape at the very end of the buffer needs the next character as well
+            if match is None or (match.group() == "\\" and match.end() >= len(self.buffer)):
+                if match is None:
+                    self.pos = len(self.buffer)
+                if not self.read_more():
+                    raise self.error("Unterminated string")
+                continue
+            if match.group() == '"':
+                self.pos = match.end()
+                return
+            self.pos = match.end() + 1
+
+    def find(self, path: Sequence[str]) -> bool:
+        """
+        moves to the value at path (the keys of nested objects, from the top level).
+        Returns False if one of the keys doesn't exist
+        """
+        for key in path:
+            self.expect("{")
+            while True:
+                if self.peek() == "}":
+                    return False
+                member_key = self.decode()
+                self.expect(":")
+                if member_key == key:
+                    break
+                self.skip()
+                if self.peek() == ",":
+                    self.pos += 1
+        return True
+
+
+def iter_json_items(f: TextIO, path: Sequence[str] = ()) -> Iterator[Any]:
+    """
+    yields the items of the JSON array at path, or the (key, value) pairs if it is an object.
+    path is a list of keys leading to it from the top-level object (the top-level value itself if empty).
+    Yields nothing if one of the keys doesn't exist
+    """
+    reader = _Reader(f)
+    if not reader.find(path):
+        return
+
+    start = reader.peek()
+    if start == "[":
+        end = "]"
+    elif start == "{":
+        end = "}"
+    else:
+        raise reader.error("Expecting an array or object")
+    reader.pos += 1
+
+    if reader.peek() == end:
+        return
+    while True:
+        if end == "]":
+            yield reader.decode()
+        else:
+            key = reader.decode()
+            reader.expect(":")
+            yield key, reader.decode()
+        if reader.peek() == end:
+            return
+        reader.expect(",")
+
+
+def load_json_value(f: TextIO, path: Sequence[str], default: Any = None) -> Any:
+    """
+    decodes only the value at path (see iter_json_items), or returns default if it doesn't exist
+    """
+    reader = _Reader(f)
+    if not reader.find(path):
+        return default
+    return reader.decode()
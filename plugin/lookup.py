@@ -0,0 +1,194 @@
+"""
+Parsing and formatting of lookup requests, shared by the server engines.
+"""
+
+from __future__ import annotations
+
+import json
+from typing import Any, Optional
+from urllib.parse import urlparse
+from urllib.parse import parse_qs
+
+from .util import (
+    QueryComponents,
+    AudioSourceJsonList,
+)
+from .consts import *
+from .config import ALL_SOURCES
+from .server_logging import logger
+
+
+def parse_query_components(path: str) -> Optional[QueryComponents]:
+    """Extract 'term', 'reading', 'sources', and 'user' query parameters"""
+    parsed_qcomps = parse_qs(urlparse(path).query)
+
+    if "term" in parsed_qcomps:
+        term = parsed_qcomps["term"][0]
+    elif "expression" in parsed_qcomps:
+        term = parsed_qcomps["expression"][0]
+    else:
+        logger.warning("Cannot find term or expression in query: %s", path)
+        return None
+
+    # reading field should actually be optional, to query just for the term / expression
+    if "reading" in parsed_qcomps:
+        reading = parsed_qcomps["reading"][0]
+    else:
+        reading = None
+
+    if "sources" in parsed_qcomps:
+        sources = tuple(parsed_qcomps["sources"][0].split(","))
+    else:
+        sources = tuple(ALL_SOURCES.keys())
+
+    if "user" in parsed_qcomps:
+        user = tuple(u.strip() for u in parsed_qcomps["user"][0].split(","))
+    else:
+        user = ()
+
+    qcomps = QueryComponents(term, reading, sources, user)
+
+    return qcomps
+
+
+def parse_batch_item(item: Any) -> QueryComponents:
+    """
+    converts one object of a batch lookup into QueryComponents, with the same fields
+    and defaults as the query parameters of a single lookup.
+    `sources` and `user` can either be lists, or comma separated strings (like in the URL)
+    """
+    if not isinstance(item, dict):
+        raise ValueError(f"Batch item must be an object: {item!r}")
+
+    term = item.get("term", item.get("expression"))
+    if not isinstance(term, str):
+        raise ValueError(f"Cannot find term or expression in batch item: {item!r}")
+
+    reading = item.get("reading")
+    if reading is not None and not isinstance(reading, str):
+        raise ValueError(f"Invalid reading in batch item: {item!r}")
+
+    sources = item.get("sources")
+    if sources is None:
+        sources = tuple(ALL_SOURCES.keys())
+    elif isinstance(sources, str):
+        sources = tuple(sources.split(","))
+    elif isinstance(sources, list) and all(isinstance(source, str) for source in sources):
+        sources = tuple(sources)
+    else:
+        raise ValueError(f"Invalid sources in batch item: {item!r}")
+
+    user = item.get("user")
+    if user is None:
+        user = ()
+    elif isinstance(user, str):
+        user = tuple(u.strip() for u in user.split(","))
+    elif isinstance(user, list) and all(isinstance(u, str) for u in user):
+        user = tuple(u.strip() for u in user)
+    else:
+        raise ValueError(f"Invalid user in batch item: {item!r}")
+
+    return QueryComponents(term, reading, sources, user)
+
+
+def parse_batch_request(body: bytes, max_items: int) -> list[QueryComponents]:
+    """
+    parses the body of a batch lookup, i.e. a JSON array of {term, reading, sources, user} objects.
+    Raises ValueError if the body is invalid
+    """
+    try:
+        items = json.loads(body)
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError(f"Batch request is not valid JSON: {e}") from e
+
+    if not isinstance(items, list):
+        raise ValueError("Batch request must be a JSON array")
+    if len(items) > max_items:
+        raise ValueError(f"Batch request has {len(items)} items, the limit is {max_items}")
+    return [parse_batch_item(item) for item in items]
+
+
+def parse_prefetch_request(body: bytes, max_items: int) -> tuple[list[QueryComponents], bool, bool]:
+    """
+    parses the body of a prefetch request, i.e. {"items": [...], "audio": false, "replace": false},
+    where items has the same format as a batch lookup.
+    Returns (lookups, audio, replace). Raises ValueError if the body is invalid
+    """
+    try:
+        request = json.loads(body)
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError(f"Prefetch request is not valid JSON: {e}") from e
+
+    if not isinstance(request, dict) or not isinstance(request.get("items"), list):
+        raise ValueError("Prefetch request must be an object with an items array")
+    items = request["items"]
+    if len(items) > max_items:
+        raise ValueError(f"Prefetch request has {len(items)} items, the limit is {max_items}")
+
+    audio = request.get("audio", False)
+    replace = request.get("replace", False)
+    if not isinstance(audio, bool) or not isinstance(replace, bool):
+        raise ValueError("audio and replace must be booleans")
+    return [parse_batch_item(item) for item in items], audio, replace
+
+
+def parse_prefetch_cancel_request(body: bytes) -> Optional[int]:
+    """
+    parses the body of a prefetch cancel request, i.e. {"id": 1}.
+    Returns the id of the job to cancel, or None (an empty body or no id) to cancel all jobs
+    """
+    if not body.strip():
+        return None
+    try:
+        request = json.loads(body)
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError(f"Prefetch cancel request is not valid JSON: {e}") from e
+
+    if not isinstance(request, dict):
+        raise ValueError("Prefetch cancel request must be an object")
+    job_id = request.get("id")
+    if job_id is not None and (not isinstance(job_id, int) or isinstance(job_id, bool)):
+        raise ValueError(f"Invalid prefetch id: {job_id!r}")
+    return job_id
+
+
+def build_audio_sources(rows: list[Any]) -> AudioSourceJsonList:
+    """
+    converts rows of the entries table into the entries of an audioSourceList
+    """
+    audio_sources_json_list = []
+    for row in rows:
+        source = row[SOURCE]
+        file = row[FILE]
+
+        audio_source = ALL_SOURCES.get(source, None)
+        if audio_source is None:
+            logger.warning("(build_audio_sources) unknown source %s", source)
+            continue
+
+        # we use the %s substitutions so it's more compatible between other languages
+        display = row[DISPLAY]
+        if display is not None:
+            name = audio_source.data.display % row[DISPLAY]
+        else:
+            name = audio_source.data.display
+        url = audio_source.construct_file_url(file)
+        entry = {"name": name, "url": url}
+        audio_sources_json_list.append(entry)
+    return audio_sources_json_list
+
+
+def encode_audio_source_list(audio_sources_json_list: AudioSourceJsonList) -> bytes:
+    # Build JSON that Yomitan requires
+    # Ref: https://github.com/yomidevs/yomitan/blob/master/ext/data/schemas/custom-audio-list-schema.json
+    resp = {"type": "audioSourceList", "audioSources": audio_sources_json_list}
+
+    # Writing the JSON contents with UTF-8
+    return bytes(json.dumps(resp), "utf8")
+
+
+def encode_batch_response(payloads: list[bytes]) -> bytes:
+    """
+    joins already encoded audioSourceList responses into a JSON array
+    """
+    return b"[" + b",".join(payloads) + b"]"
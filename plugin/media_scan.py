@@ -0,0 +1,99 @@
+"""
+Finds the audio files of a source (see AudioSource.find_media_files).
+
+Directories are read with os.scandir(), whose entries already know whether they are a file
+or a directory (d_type), so a file costs no extra stat() call. Subdirectories are read in
+parallel on a small thread pool, which mostly helps on network shares and spinning disks,
+where every directory read waits on the drive.
+"""
+
+from __future__ import annotations
+
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterator, NamedTuple, Optional
+
+# audio container formats supposedly supported by browsers (excluding webm since it's typically for videos)
+AUDIO_FILE_EXTENSIONS = frozenset([".mp3", ".m4a", ".aac", ".ogg", ".oga", ".opus", ".flac", ".wav"])
+
+# number of directories read at once
+MEDIA_SCAN_WORKERS = 8
+
+
+class MediaFile(NamedTuple):
+    # path relative to the media dir, i.e. "akitomo/読む.mp3" (with the OS's separator)
+    relative_path: str
+    # file name without its extension, i.e. "読む"
+    stem: str
+    # name of the directory the file is in, i.e. "akitomo"
+    parent_name: str
+
+
+class _Directory(NamedTuple):
+    files: list[MediaFile]
+    # in the order os.scandir() returned them
+    subdirs: list[Future[_Directory]]
+
+
+def get_audio_suffix(name: str) -> Optional[str]:
+    """
+    the (lowercase) extension of the file name if it is an audio file, same as Path(name).suffix
+    """
+    i = name.rfind(".")
+    if 0 < i < len(name) - 1:
+        suffix = name[i:].lower()
+        if suffix in AUDIO_FILE_EXTENSIONS:
+            return suffix
+    return None
+
+
+def scan_media_files(
+    media_dir: Path, log_name: str = "", workers: int = MEDIA_SCAN_WORKERS
+) -> Iterator[MediaFile]:
+    """
+    yields every audio file under media_dir, in the same order as filtering media_dir.rglob("*"):
+    the files of a directory come before the files of its subdirectories, and symlinks to
+    directories are not followed. Files that aren't audio files are skipped (and logged).
+    Directories that can't be read are skipped as well
+    """
+
+    def scan(path: str, relative_dir: str, parent_name: str) -> _Directory:
+        files = []
+        subdirs = []
+        try:
+            with os.scandir(path) as it:
+                entries = list(it)
+        except OSError:
+            return _Directory(files, subdirs)
+
+        for entry in entries:
+            name = entry.name
+            relative_path = os.path.join(relative_dir, name) if relative_dir else name
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(executor.submit(scan, entry.path, relative_path, name))
+                    continue
+                # follows symlinks, like Path.is_file()
+                if not entry.is_file():
+                    continue
+            except OSError:
+                continue
+
+            suffix = get_audio_suffix(name)
+            if suffix is None:
+                print(f"({log_name}) skipping non-audio file: {entry.path}")
+                continue
+            files.append(MediaFile(relative_path, name[: -len(suffix)], parent_name))
+        return _Directory(files, subdirs)
+
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="local-audio-scan")
+    try:
+        stack = [executor.submit(scan, str(media_dir), "", media_dir.name)]
+        while stack:
+            directory = stack.pop().result()
+            yield from directory.files
+            stack.extend(reversed(directory.subdirs))
+    finally:
+        # if the caller stops early, directories that haven't been read yet are skipped
+        executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,298 @@
+"""
+Per-request stage timings (RequestTrace), aggregated into histograms and counters (Metrics)
+that are served on /metrics, in the Prometheus text format or as JSON.
+With "server_timing" enabled, the timings of every request are also sent back in its
+Server-Timing header, along with an X-Request-ID.
+"""
+
+from __future__ import annotations
+
+import bisect
+import itertools
+import json
+import re
+import secrets
+import threading
+import time
+from typing import Any, Optional
+
+# upper bounds (in seconds) of the histogram buckets, the last bucket is +Inf
+BUCKETS = (
+    0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0,
+)
+
+REQUEST_SECONDS = "local_audio_request_duration_seconds"
+STAGE_SECONDS = "local_audio_stage_duration_seconds"
+REQUESTS_TOTAL = "local_audio_requests_total"
+REJECTED_CONNECTIONS_TOTAL = "local_audio_rejected_connections_total"
+
+HELP = {
+    REQUEST_SECONDS: "Time from reading the request line to finishing the response.",
+    STAGE_SECONDS: "Time spent in each stage of a request (parse, db, serialize, write, open, send).",
+    REQUESTS_TOTAL: "Number of finished requests.",
+    REJECTED_CONNECTIONS_TOTAL: "Number of connections turned away because every worker was busy.",
+}
+
+Labels = tuple[tuple[str, str], ...]
+
+# names of the stages in the Server-Timing header. Audio files are opened (or read from the cache)
+# before the headers are sent, but the body is sent after, so "write" and "send" are never included
+SERVER_TIMING_NAMES = {"parse": "parse", "db": "db", "serialize": "serialize", "open": "io"}
+
+# request ids sent by the client are only echoed back if they look like an id
+_REQUEST_ID_RE = re.compile(r"[A-Za-z0-9._:-]{1,64}")
+# unique per server process, so ids from different runs don't collide in the logs
+_REQUEST_ID_PREFIX = secrets.token_hex(4)
+_request_ids = itertools.count(1)
+
+
+class _StageTimer:
+    __slots__ = ("trace", "stage", "start")
+
+    def __init__(self, trace: RequestTrace, stage: str):
+        self.trace = trace
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        stages = self.trace.stages
+        stages[self.stage] = stages.get(self.stage, 0.0) + time.perf_counter() - self.start
+
+
+class RequestTrace:
+    """
+    Collects what happened while handling a single request
+    """
+
+    __slots__ = ("start", "route", "source", "cache", "stages")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        # i.e. "lookup" or "audio", see match_route()
+        self.route = "other"
+        # the audio source of an audio request
+        self.source: Optional[str] = None
+        # "hit" or "miss" if the response could have come from a cache
+        self.cache: Optional[str] = None
+        # seconds spent per stage, in the order the stages were first entered
+        self.stages: dict[str, float] = {}
+
+    def time(self, stage: str) -> _StageTimer:
+        """
+        use as `with trace.time("db"): ...`. A stage can be entered multiple times, and adds up
+        """
+        return _StageTimer(self, stage)
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def server_timing(self) -> str:
+        """
+        the value of the Server-Timing header, i.e. `parse;dur=0.05, db;dur=0.81, cache;desc=miss, total;dur=0.94`,
+        with the stages (and the total) up to now, in milliseconds
+        """
+        timings: dict[str, float] = {}
+        for stage, seconds in self.stages.items():
+            name = SERVER_TIMING_NAMES.get(stage)
+            if name is not None:
+                timings[name] = timings.get(name, 0.0) + seconds
+        metrics = [f"{name};dur={seconds * 1000:.3f}" for name, seconds in timings.items()]
+        if self.cache is not None:
+            metrics.append(f"cache;desc={self.cache}")
+        metrics.append(f"total;dur={self.elapsed() * 1000:.3f}")
+        return ", ".join(metrics)
+
+
+def get_request_id(client_request_id: Optional[str]) -> str:
+    """
+    the X-Request-ID of a response: the one sent by the client if there was one, or a new one
+    """
+    if client_request_id is not None and _REQUEST_ID_RE.fullmatch(client_request_id):
+        return client_request_id
+    return f"{_REQUEST_ID_PREFIX}-{next(_request_ids)}"
+
+
+class _Shard:
+    """
+    Metrics recorded by a single thread. Only that thread ever writes to it,
+    so recording a value never takes a lock.
+    """
+
+    __slots__ = ("owner", "histograms", "counters")
+
+    def __init__(self, owner: Optional[threading.Thread]):
+        self.owner = owner
+        # (name, labels) -> [bucket counts..., sum, count]
+        self.histograms: dict[tuple[str, Labels], list[float]] = {}
+        # (name, labels) -> [value]
+        self.counters: dict[tuple[str, Labels], list[float]] = {}
+
+
+class Metrics:
+    """
+    Histograms and counters, sharded per thread. Shards are only combined when the metrics are read.
+    The shards of threads that have exited (i.e. finished connections) are folded into one whenever
+    a new thread records its first value, so there is never more than one shard per running thread
+    (plus the ones that exited since), even if the metrics are never read.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards: list[_Shard] = []
+        self._retired = _Shard(None)
+
+    def _shard(self) -> _Shard:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = _Shard(threading.current_thread())
+            self._local.shard = shard
+            with self._lock:
+                self._retire_exited_shards()
+                self._shards.append(shard)
+        return shard
+
+    def _retire_exited_shards(self):
+        # must hold self._lock
+        live = []
+        for shard in self._shards:
+            if shard.owner is not None and not shard.owner.is_alive():
+                _merge(self._retired, shard)
+            else:
+                live.append(shard)
+        self._shards = live
+
+    def observe(self, name: str, labels: Labels, value: float):
+        histograms = self._shard().histograms
+        key = (name, labels)
+        entry = histograms.get(key)
+        if entry is None:
+            entry = histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0, 0]
+        entry[bisect.bisect_left(BUCKETS, value)] += 1
+        entry[-2] += value
+        entry[-1] += 1
+
+    def increment(self, name: str, labels: Labels, value: float = 1):
+        counters = self._shard().counters
+        key = (name, labels)
+        entry = counters.get(key)
+        if entry is None:
+            entry = counters[key] = [0]
+        entry[0] += value
+
+    def observe_request(self, trace: RequestTrace, status: int):
+        route = (("route", trace.route),)
+        if trace.source is not None:
+            route += (("source", trace.source),)
+
+        counter_labels = route + (("status", str(int(status))),)
+        if trace.cache is not None:
+            counter_labels += (("cache", trace.cache),)
+        self.increment(REQUESTS_TOTAL, counter_labels)
+        self.observe(REQUEST_SECONDS, route, trace.elapsed())
+        for stage, seconds in trace.stages.items():
+            self.observe(STAGE_SECONDS, route + (("stage", stage),), seconds)
+
+    def collect(self) -> tuple[dict[tuple[str, Labels], list[float]], dict[tuple[str, Labels], list[float]]]:
+        """
+        returns the combined (histograms, counters) of all threads
+        """
+        with self._lock:
+            self._retire_exited_shards()
+            total = _Shard(None)
+            _merge(total, self._retired)
+            for shard in self._shards:
+                _merge(total, shard)
+        return total.histograms, total.counters
+
+
+def _merge(into: _Shard, shard: _Shard):
+    # list() copies the items in one step, so a shard can be read while its thread adds to it
+    for key, entry in list(shard.histograms.items()):
+        target = into.histograms.get(key)
+        if target is None:
+            into.histograms[key] = list(entry)
+        else:
+            for i, value in enumerate(list(entry)):
+                target[i] += value
+    for key, entry in list(shard.counters.items()):
+        target = into.counters.get(key)
+        if target is None:
+            into.counters[key] = list(entry)
+        else:
+            target[0] += entry[0]
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def format_prometheus(metrics: Metrics, gauges: dict[str, float]) -> bytes:
+    """
+    the Prometheus text exposition format (version 0.0.4)
+    """
+    histograms, counters = metrics.collect()
+    lines = []
+
+    for name in sorted({name for name, _ in counters}):
+        lines.append(f"# HELP {name} {HELP.get(name, name)}")
+        lines.append(f"# TYPE {name} counter")
+        for (key_name, labels), entry in sorted(counters.items()):
+            if key_name == name:
+                lines.append(f"{name}{_format_labels(labels)} {entry[0]}")
+
+    for name in sorted({name for name, _ in histograms}):
+        lines.append(f"# HELP {name} {HELP.get(name, name)}")
+        lines.append(f"# TYPE {name} histogram")
+        for (key_name, labels), entry in sorted(histograms.items()):
+            if key_name != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS + (float("inf"),), entry):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {entry[-2]:.6f}")
+            lines.append(f"{name}_count{_format_labels(labels)} {entry[-1]}")
+
+    for name, value in gauges.items():
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def format_json(metrics: Metrics, gauges: dict[str, float]) -> bytes:
+    histograms, counters = metrics.collect()
+    result: dict[str, Any] = {"counters": {}, "histograms": {}, "gauges": gauges}
+
+    for (name, labels), entry in sorted(counters.items()):
+        result["counters"].setdefault(name, []).append({"labels": dict(labels), "value": entry[0]})
+
+    for (name, labels), entry in sorted(histograms.items()):
+        count = entry[-1]
+        result["histograms"].setdefault(name, []).append({
+            "labels": dict(labels),
+            "count": count,
+            "sum": entry[-2],
+            "mean": entry[-2] / count if count else 0.0,
+            # non-cumulative counts, keyed by the upper bound of the bucket
+            "buckets": {
+                ("+Inf" if bound == float("inf") else f"{bound:g}"): bucket_count
+                for bound, bucket_count in zip(BUCKETS + (float("inf"),), entry)
+            },
+        })
+
+    return json.dumps(result).encode("utf-8")
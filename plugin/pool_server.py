@@ -0,0 +1,263 @@
+"""
+Alternative server engine, selected with "server_engine": "pool".
+
+Connections are handled by a fixed number of worker threads instead of a new thread each,
+so no client can make the server (and with it, Anki) start an unbounded number of threads.
+Accepted connections wait in a bounded queue for a free worker, and once the queue is full,
+new connections are answered with 503 right away.
+Lookups and audio files also have separate limits on how many requests are handled at once,
+so large file transfers can't take up every worker and starve the lookups.
+"""
+
+from __future__ import annotations
+
+import queue
+import selectors
+import socket
+import threading
+import time
+from http import HTTPStatus
+from typing import Callable, Optional
+
+from .config import SERVER_CONFIG
+from .metrics import REJECTED_CONNECTIONS_TOTAL
+from .server import LocalAudioHandler, LocalAudioServer, RETRY_AFTER_SECONDS
+
+# how often an idle keep-alive connection checks whether other connections are waiting for a worker
+IDLE_POLL_INTERVAL = 0.1
+# seconds a connection that is turned away is kept open for, so it isn't closed before the client has sent its request
+REJECT_TIMEOUT = 0.1
+# how often the connections that were turned away are checked for their request
+REJECT_POLL_INTERVAL = 0.01
+# connections that were turned away and are waiting for their request, any more are closed right away
+MAX_PENDING_REJECTIONS = 64
+
+# which limit applies to each route (see match_route), the other routes are never limited
+ROUTE_LIMITS = {
+    "lookup": "lookup",
+    "batch": "lookup",
+    "audio": "audio",
+}
+
+SERVICE_UNAVAILABLE_RESPONSE = (
+    f"HTTP/1.1 {HTTPStatus.SERVICE_UNAVAILABLE.value} {HTTPStatus.SERVICE_UNAVAILABLE.phrase}\r\n"
+    f"Retry-After: {RETRY_AFTER_SECONDS}\r\n"
+    "Access-Control-Allow-Origin: *\r\n"
+    "Content-Length: 0\r\n"
+    "Connection: close\r\n"
+    "\r\n"
+).encode("latin-1")
+
+
+class RequestLimits:
+    """
+    Limits the number of lookup and audio requests that are handled at once.
+    A request over the limit is turned away instead of waiting, as waiting would still take up a worker.
+    """
+
+    def __init__(self, max_lookups: int, max_audio: int):
+        self._slots = {
+            "lookup": threading.BoundedSemaphore(max_lookups),
+            "audio": threading.BoundedSemaphore(max_audio),
+        }
+
+    def acquire(self, route: str) -> bool:
+        slots = self._slots.get(ROUTE_LIMITS.get(route, ""))
+        return slots is None or slots.acquire(blocking=False)
+
+    def release(self, route: str):
+        slots = self._slots.get(ROUTE_LIMITS.get(route, ""))
+        if slots is not None:
+            slots.release()
+
+
+class ConnectionRejecter:
+    """
+    Answers the connections that are turned away, without ever blocking the thread that accepts connections.
+    The 503 response is sent right away, and the connection is then kept open for up to REJECT_TIMEOUT
+    on a separate thread, which reads the request once it arrives: closing a socket with unread data
+    resets the connection, possibly before the client has read the response.
+    """
+
+    def __init__(self, close_request: Callable[[socket.socket], None]):
+        self.close_request = close_request
+        self._incoming: queue.SimpleQueue[Optional[socket.socket]] = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name="local-audio-reject", daemon=True)
+        self._thread.start()
+
+    def reject(self, request: socket.socket):
+        try:
+            request.setblocking(False)
+            # the send buffer of a new connection always has room for the whole response
+            request.send(SERVICE_UNAVAILABLE_RESPONSE)
+        except OSError:
+            self.close_request(request)
+            return
+        self._incoming.put(request)
+
+    def close(self):
+        self._incoming.put(None)
+        self._thread.join()
+
+    def _run(self):
+        # socket -> time at which it's closed, even if the request never arrived
+        pending: dict[socket.socket, float] = {}
+        # unlike select.select(), selectors also work for file descriptors above FD_SETSIZE (1024 on Linux)
+        with selectors.DefaultSelector() as selector:
+            while True:
+                incoming = []
+                # waits for a connection if there is nothing else to do
+                if not pending:
+                    incoming.append(self._incoming.get())
+                try:
+                    while True:
+                        incoming.append(self._incoming.get_nowait())
+                except queue.Empty:
+                    pass
+
+                closing = None in incoming
+                for request in incoming:
+                    if request is None:
+                        continue
+                    if closing or len(pending) >= MAX_PENDING_REJECTIONS:
+                        self.close_request(request)
+                        continue
+                    try:
+                        selector.register(request, selectors.EVENT_READ)
+                    except (OSError, ValueError): # closed socket
+                        self.close_request(request)
+                        continue
+                    pending[request] = time.monotonic() + REJECT_TIMEOUT
+                if closing:
+                    for request in pending:
+                        selector.unregister(request)
+                        self.close_request(request)
+                    return
+                if not pending:
+                    continue
+
+                readable = {key.fileobj for key, _ in selector.select(REJECT_POLL_INTERVAL)}
+                now = time.monotonic()
+                for request, deadline in list(pending.items()):
+                    if request in readable:
+                        try:
+                            request.recv(65536)
+                        except OSError:
+                            pass
+                    elif deadline > now:
+                        continue
+                    del pending[request]
+                    selector.unregister(request)
+                    self.close_request(request)
+
+
+class PooledLocalAudioHandler(LocalAudioHandler):
+
+    server: PooledLocalAudioServer
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self.wait_for_request():
+            self.handle_one_request()
+
+    def wait_for_request(self) -> bool:
+        """
+        waits for the next request on this keep-alive connection. Returns False if the connection should
+        be closed instead: it stayed idle for the keep-alive timeout, or it is idle while other connections
+        are waiting for a worker (clients simply reconnect)
+        """
+        sock = self.connection
+        # a pipelined request may already be buffered, which select() can't see
+        sock.settimeout(0)
+        try:
+            if self.rfile.peek(1):
+                return True
+        except OSError:
+            return False
+        finally:
+            sock.settimeout(self.timeout)
+
+        deadline = time.monotonic() + self.timeout
+        # not select.select(), which fails for file descriptors above FD_SETSIZE (see ConnectionRejecter)
+        with selectors.DefaultSelector() as selector:
+            try:
+                selector.register(sock, selectors.EVENT_READ)
+            except (OSError, ValueError): # closed socket
+                return False
+            while not self.server.has_waiting_connections():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                if selector.select(min(remaining, IDLE_POLL_INTERVAL)):
+                    return True
+        return False
+
+    def acquire_slot(self, route: str) -> bool:
+        return self.server.limits.acquire(route)
+
+    def release_slot(self, route: str):
+        self.server.limits.release(route)
+
+
+class PooledLocalAudioServer(LocalAudioServer):
+    """
+    Has the same interface as LocalAudioServer, but handles connections on a fixed pool of threads.
+    """
+
+    def __init__(self, server_address):
+        self.limits = RequestLimits(
+            SERVER_CONFIG["pool_max_lookup_requests"],
+            SERVER_CONFIG["pool_max_audio_requests"],
+        )
+        self.queue_size = SERVER_CONFIG["pool_queue_size"]
+        # only the thread running serve_forever() adds to the queue, so its size can be checked before adding
+        self._queue: queue.Queue[Optional[tuple]] = queue.Queue()
+        self._closing = False
+        self._workers: list[threading.Thread] = []
+        # only started once the state is built and the socket is bound, so a failure there doesn't leak its thread
+        self._rejecter: Optional[ConnectionRejecter] = None
+        super().__init__(server_address, PooledLocalAudioHandler)
+        self._rejecter = ConnectionRejecter(self.shutdown_request)
+
+        for i in range(SERVER_CONFIG["pool_workers"]):
+            worker = threading.Thread(target=self._work, name=f"local-audio-worker-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def has_waiting_connections(self) -> bool:
+        return not self._queue.empty()
+
+    def process_request(self, request, client_address):
+        # called by serve_forever() for every accepted connection
+        if self._queue.qsize() >= self.queue_size:
+            self.reject_request(request)
+            return
+        self._queue.put((request, client_address))
+
+    def reject_request(self, request):
+        self.state.metrics.increment(REJECTED_CONNECTIONS_TOTAL, ())
+        self._rejecter.reject(request)
+
+    def _work(self):
+        while (item := self._queue.get()) is not None:
+            request, client_address = item
+            if self._closing:
+                self.shutdown_request(request)
+                continue
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        # workers exit once their current connection is done (like the daemon threads of LocalAudioServer),
+        # and connections that are still queued are closed without a response
+        self._closing = True
+        for _ in self._workers:
+            self._queue.put(None)
+        if self._rejecter is not None:
+            self._rejecter.close()
+        super().server_close()
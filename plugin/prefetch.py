@@ -0,0 +1,170 @@
+"""
+Background lookups of words that are likely to be looked up soon (POST /prefetch),
+so the real lookup is served from the server's caches.
+"""
+
+from __future__ import annotations
+
+import itertools
+import json
+import threading
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Optional
+
+from .server_logging import logger
+from .source.audio_source import SERVE_FROM_ANDROID_DB
+from .util import QueryComponents
+
+if TYPE_CHECKING:
+    from .server import ServerState
+
+# number of words looked up at once. Interactive requests are only ever
+# delayed by (at most) the time it takes to look up a single chunk
+PREFETCH_CHUNK_SIZE = 32
+
+
+@dataclass
+class PrefetchJob:
+    id: int
+    qcomps_list: list[QueryComponents]
+    # whether the first audio file of every lookup should be read into the audio cache as well
+    audio: bool
+    position: int = 0
+    cancelled: bool = False
+
+
+class Prefetcher:
+    """
+    Runs prefetch jobs on a single background thread, at a lower priority than interactive requests:
+    the thread only starts on a chunk while no interactive request is being handled.
+    """
+
+    def __init__(self, state: ServerState):
+        self.state = state
+        self.completed = 0
+        self.cancelled = 0
+
+        self._cond = threading.Condition()
+        self._jobs: deque[PrefetchJob] = deque()
+        self._ids = itertools.count(1)
+        self._active_requests = 0
+        self._closed = False
+        self._thread: Optional[threading.Thread] = None
+
+    @contextmanager
+    def interactive(self):
+        """
+        wraps the handling of a request that prefetching must not compete with
+        """
+        with self._cond:
+            self._active_requests += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active_requests -= 1
+                if self._active_requests == 0:
+                    self._cond.notify_all()
+
+    def submit(self, qcomps_list: list[QueryComponents], audio: bool, replace: bool = False) -> int:
+        """
+        queues a prefetch job, and returns its id. If replace is set, all pending jobs are cancelled first
+        """
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Prefetcher is closed")
+            if replace:
+                self._cancel_locked(None)
+            job = PrefetchJob(next(self._ids), qcomps_list, audio)
+            self._jobs.append(job)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="local-audio-prefetch", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+            return job.id
+
+    def cancel(self, job_id: Optional[int] = None) -> int:
+        """
+        cancels the job with the given id (or all jobs if None). Returns the number of cancelled jobs
+        """
+        with self._cond:
+            return self._cancel_locked(job_id)
+
+    def _cancel_locked(self, job_id: Optional[int]) -> int:
+        cancelled = [job for job in self._jobs if job_id is None or job.id == job_id]
+        for job in cancelled:
+            # the job that is currently running stops after its current chunk
+            job.cancelled = True
+            self._jobs.remove(job)
+        self.cancelled += len(cancelled)
+        return len(cancelled)
+
+    def pending(self) -> int:
+        with self._cond:
+            return sum(len(job.qcomps_list) - job.position for job in self._jobs)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cancel_locked(None)
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _next_chunk(self) -> Optional[tuple[PrefetchJob, list[QueryComponents]]]:
+        """
+        waits until there is work, and no interactive request is running
+        """
+        with self._cond:
+            while not self._closed and (not self._jobs or self._active_requests > 0):
+                self._cond.wait()
+            if self._closed:
+                return None
+
+            job = self._jobs[0]
+            chunk = job.qcomps_list[job.position:job.position + PREFETCH_CHUNK_SIZE]
+            job.position += len(chunk)
+            if job.position >= len(job.qcomps_list):
+                self._jobs.popleft()
+                self.completed += 1
+            return job, chunk
+
+    def _run(self):
+        while (next_chunk := self._next_chunk()) is not None:
+            job, chunk = next_chunk
+            if job.cancelled:
+                continue
+            try:
+                self._prefetch(chunk, job.audio)
+            except Exception:
+                logger.exception("Prefetching failed")
+
+    def _prefetch(self, chunk: list[QueryComponents], audio: bool):
+        # imported here, as server.py imports this module
+        from .server import match_route
+
+        state = self.state
+        payloads = [state.lookup_cache.peek(qcomps) for qcomps in chunk]
+        missing = [i for i, payload in enumerate(payloads) if payload is None]
+        if missing:
+            built = state.build_lookup_payloads([chunk[i] for i in missing])
+            for i, payload in zip(missing, built):
+                payloads[i] = payload
+
+        if not audio or not state.audio_cache.enabled:
+            return
+        for payload in payloads:
+            audio_sources = json.loads(payload)["audioSources"]
+            if not audio_sources:
+                continue
+            route, audio_source, file_path = match_route(audio_sources[0]["url"])
+            if route != "audio":
+                continue
+            if audio_source.data.serve_from == SERVE_FROM_ANDROID_DB:
+                with state.android_db_connection() as connection:
+                    if connection is not None:
+                        state.open_android_audio(connection, audio_source.data.id, file_path, prefetch=True)
+            else:
+                state.get_cached_audio(audio_source.get_media_dir_path().joinpath(file_path), prefetch=True)
@@ -4,13 +4,18 @@ import http.server
 import json
 import sqlite3
 import threading
+import time
 import os
+import stat
+import sys
 
+from contextlib import closing, contextmanager
 from http import HTTPStatus
 from urllib.parse import unquote
 from urllib.parse import urlparse
 from urllib.parse import parse_qs
 from pathlib import Path
+from typing import BinaryIO, Iterator, NamedTuple, Optional
 
 from .util import (
     QueryComponents,
@@ -19,213 +24,746 @@ from .util import (
     get_version_file,
 )
 from .consts import *
-from .config import ALL_SOURCES
-from .db_utils import execute_query
+from .config import ALL_SOURCES, SERVER_CONFIG
+from .db_utils import (
+    execute_query,
+    execute_batch_query,
+    find_android_audio,
+    read_android_audio,
+    get_materialized_response,
+    has_materialized_responses,
+    is_default_lookup,
+    add_db_change_listener,
+    remove_db_change_listener,
+)
+from .db_pool import ConnectionPool
+from .http_util import (
+    SUFFIX_TO_MIME_TYPE,
+    audio_response_head,
+)
+from .cache import LookupCache, AudioCache
+from .prefetch import Prefetcher
+from .server_logging import logger, log_access, setup_logging
+from .metrics import Metrics, RequestTrace, format_json, format_prometheus, get_request_id
+from .lookup import (
+    parse_query_components,
+    build_audio_sources,
+    encode_audio_source_list,
+    encode_batch_response,
+    parse_batch_request,
+    parse_prefetch_request,
+    parse_prefetch_cancel_request,
+)
+from .source.audio_source import AudioSource, SERVE_FROM_ANDROID_DB
+
+# generous upper bound for the size of one item of a batch lookup, used to limit the request body
+BATCH_ITEM_MAX_BYTES = 1024
+BATCH_MAX_BODY_SIZE = SERVER_CONFIG["batch_max_items"] * BATCH_ITEM_MAX_BYTES
+# seconds a client is asked to wait before retrying, when the server has too many requests
+RETRY_AFTER_SECONDS = 1
+
+
+class AndroidAudio(NamedTuple):
+    """
+    an audio file stored in android.db
+    """
+
+    rowid: int
+    size: int
+    # blobs don't have their own mtime, so the mtime of android.db is used instead
+    mtime_ns: int
+    # the contents of the file, if it is in the audio cache
+    data: Optional[bytes]
+
+
+class ServerState:
+    """
+    State shared between requests (i.e. the pooled database connections and the
+    lookup cache). Owned by the server, regardless of which engine it uses.
+    """
+
+    def __init__(self):
+        setup_logging(SERVER_CONFIG)
+        self.db_pool = ConnectionPool(
+            get_db_file(),
+            mmap_size=int(SERVER_CONFIG["sqlite_mmap_size_mb"] * 1024 * 1024),
+            cache_size=int(SERVER_CONFIG["sqlite_cache_size_mb"] * 1024 * 1024),
+            immutable=SERVER_CONFIG["sqlite_immutable"],
+        )
+        # for sources with "serve_from": "android_db". Never warmed up, as it holds every audio file
+        self.android_db_pool = ConnectionPool(
+            get_android_db_file(),
+            mmap_size=int(SERVER_CONFIG["sqlite_mmap_size_mb"] * 1024 * 1024),
+            cache_size=int(SERVER_CONFIG["sqlite_cache_size_mb"] * 1024 * 1024),
+            immutable=SERVER_CONFIG["sqlite_immutable"],
+        )
+        if SERVER_CONFIG["sqlite_warmup"]:
+            self.db_pool.warm_up()
+        self.lookup_cache = LookupCache(SERVER_CONFIG["lookup_cache_size"])
+        self.audio_cache = AudioCache(
+            int(SERVER_CONFIG["audio_cache_size_mb"] * 1024 * 1024),
+            int(SERVER_CONFIG["audio_cache_max_file_size_mb"] * 1024 * 1024),
+        )
+        self.prefetcher = Prefetcher(self)
+        self.metrics = Metrics()
+        # whether entries.db has usable materialized responses, None until checked
+        self.materialized: Optional[bool] = None
+        add_db_change_listener(self.db_pool.invalidate)
+        add_db_change_listener(self.android_db_pool.invalidate)
+        add_db_change_listener(self.lookup_cache.clear)
+        add_db_change_listener(self.audio_cache.clear)
+        add_db_change_listener(self.reset_materialized)
+
+    def close(self):
+        self.prefetcher.close()
+        remove_db_change_listener(self.db_pool.invalidate)
+        remove_db_change_listener(self.android_db_pool.invalidate)
+        remove_db_change_listener(self.lookup_cache.clear)
+        remove_db_change_listener(self.audio_cache.clear)
+        remove_db_change_listener(self.reset_materialized)
+        self.db_pool.close()
+        self.android_db_pool.close()
+
+    def reset_materialized(self):
+        self.materialized = None
+
+    def get_materialized_response(self, connection: sqlite3.Connection, qcomps: QueryComponents) -> Optional[bytes]:
+        """
+        the materialized response of the lookup, if the database has one
+        """
+        if not is_default_lookup(qcomps):
+            return None
+        materialized = self.materialized
+        if materialized is None:
+            materialized = self.materialized = has_materialized_responses(connection)
+        if not materialized:
+            return None
+        return get_materialized_response(connection, qcomps)
 
+    def build_lookup_payload(self, qcomps: QueryComponents, trace: Optional[RequestTrace] = None) -> bytes:
+        """
+        queries the database, and stores the result in the lookup cache
+        """
+        if trace is None:
+            trace = RequestTrace()
+        generation = self.lookup_cache.generation
+        with trace.time("db"):
+            with self.db_pool.connection() as connection:
+                payload = self.get_materialized_response(connection, qcomps)
+                if payload is None:
+                    rows = execute_query(connection, qcomps)
+        if payload is None:
+            with trace.time("serialize"):
+                payload = encode_audio_source_list(build_audio_sources(rows))
+        self.lookup_cache.put(qcomps, payload, generation)
+        return payload
+
+    def get_lookup_payload(self, qcomps: QueryComponents, trace: Optional[RequestTrace] = None) -> bytes:
+        """
+        returns the lookup response, from the lookup cache if possible
+        """
+        payload = self.lookup_cache.get(qcomps)
+        if trace is not None:
+            trace.cache = "miss" if payload is None else "hit"
+        if payload is None:
+            payload = self.build_lookup_payload(qcomps, trace)
+        return payload
+
+    def build_lookup_payloads(
+        self, qcomps_list: list[QueryComponents], trace: Optional[RequestTrace] = None
+    ) -> list[bytes]:
+        """
+        build_lookup_payload() for many lookups. Lookups without a materialized response are answered with a single query
+        """
+        if trace is None:
+            trace = RequestTrace()
+        generation = self.lookup_cache.generation
+        with trace.time("db"):
+            with self.db_pool.connection() as connection:
+                payloads = [self.get_materialized_response(connection, qcomps) for qcomps in qcomps_list]
+                missing = [i for i, payload in enumerate(payloads) if payload is None]
+                if missing:
+                    rows_list = execute_batch_query(connection, [qcomps_list[i] for i in missing])
+        if missing:
+            with trace.time("serialize"):
+                for i, rows in zip(missing, rows_list):
+                    payloads[i] = encode_audio_source_list(build_audio_sources(rows))
+        for qcomps, payload in zip(qcomps_list, payloads):
+            self.lookup_cache.put(qcomps, payload, generation)
+        return payloads
+
+    def get_batch_payload(self, qcomps_list: list[QueryComponents], trace: Optional[RequestTrace] = None) -> bytes:
+        """
+        returns the response of a batch lookup. Lookups that aren't in the lookup cache
+        are answered with a single query, and are then stored in the cache
+        """
+        payloads = [self.lookup_cache.get(qcomps) for qcomps in qcomps_list]
+        missing = [i for i, payload in enumerate(payloads) if payload is None]
+        if trace is not None:
+            trace.cache = "miss" if missing else "hit"
+
+        if missing:
+            built = self.build_lookup_payloads([qcomps_list[i] for i in missing], trace)
+            for i, payload in zip(missing, built):
+                payloads[i] = payload
+
+        return encode_batch_response(payloads)
+
+    def get_metrics_gauges(self) -> dict[str, float]:
+        lookup_cache = self.lookup_cache.stats()
+        audio_cache = self.audio_cache.stats()
+        return {
+            "local_audio_lookup_cache_entries": lookup_cache["size"],
+            "local_audio_lookup_cache_hits": lookup_cache["hits"],
+            "local_audio_lookup_cache_misses": lookup_cache["misses"],
+            "local_audio_audio_cache_entries": audio_cache["size"],
+            "local_audio_audio_cache_resident_bytes": audio_cache["resident_bytes"],
+            "local_audio_audio_cache_hits": audio_cache["hits"],
+            "local_audio_audio_cache_misses": audio_cache["misses"],
+            "local_audio_audio_cache_hit_ratio": audio_cache["hit_ratio"],
+            "local_audio_prefetch_pending": self.prefetcher.pending(),
+        }
+
+    def get_cached_audio(self, audio_file: Path, prefetch: bool = False) -> Optional[tuple[bytes, os.stat_result]]:
+        """
+        returns the contents of the audio file (alongside its stat result) from the audio cache,
+        reading it into the cache first if it is small enough.
+        Returns None if the file should be streamed from disk instead
+        (i.e. the cache is disabled, the file is too large, or it cannot be opened).
+        Prefetching doesn't count towards the cache's hits and misses
+        """
+        if not self.audio_cache.enabled:
+            return None
+        try:
+            file_stat = os.stat(audio_file)
+        except OSError:
+            return None
+
+        key = str(audio_file)
+        data = self.audio_cache.get(key, (file_stat.st_size, file_stat.st_mtime_ns), count=not prefetch)
+        if data is not None:
+            return data, file_stat
+        if not self.audio_cache.admits(file_stat.st_size):
+            return None
+
+        generation = self.audio_cache.generation
+        opened = open_audio_file(audio_file)
+        if opened is None:
+            return None
+        fh, file_stat = opened
+        with fh:
+            data = fh.read()
+        if len(data) != file_stat.st_size:
+            # the file was modified while reading it
+            return None
+        self.audio_cache.put(key, data, (file_stat.st_size, file_stat.st_mtime_ns), generation)
+        return data, file_stat
+
+    @contextmanager
+    def android_db_connection(self) -> Iterator[Optional[sqlite3.Connection]]:
+        """
+        a pooled connection to android.db, or None if it hasn't been generated
+        """
+        if not self.android_db_pool.db_path.is_file():
+            yield None
+            return
+        with self.android_db_pool.connection() as connection:
+            yield connection
+
+    def open_android_audio(
+        self, connection: sqlite3.Connection, source_id: str, file_path: str, prefetch: bool = False
+    ) -> Optional[AndroidAudio]:
+        """
+        finds an audio file in android.db without reading it, unless it is small enough for the audio cache.
+        Returns None if android.db doesn't have the file
+        """
+        try:
+            mtime_ns = os.stat(self.android_db_pool.db_path).st_mtime_ns
+        except OSError:
+            return None
+        row = find_android_audio(connection, source_id, file_path)
+        if row is None:
+            return None
+        rowid, size = row
+
+        audio_cache = self.audio_cache
+        if not audio_cache.enabled:
+            return AndroidAudio(rowid, size, mtime_ns, None)
+        key = (SERVE_FROM_ANDROID_DB, source_id, file_path)
+        data = audio_cache.get(key, (size, mtime_ns), count=not prefetch)
+        if data is None and audio_cache.admits(size):
+            generation = audio_cache.generation
+            data = b"".join(read_android_audio(connection, rowid, 0, size))
+            audio_cache.put(key, data, (size, mtime_ns), generation)
+        return AndroidAudio(rowid, size, mtime_ns, data)
+
+
+def match_route(path: str) -> tuple[str, Optional[AudioSource], str]:
+    """
+    returns (route, audio source, file path) for the request path, where route is one of
+    "version", "favicon", "metrics", "audio" or "lookup"
+    """
+    # https://stackoverflow.com/questions/7894384/python-get-url-path-sections
+    parse_result = urlparse(path)
+    full_path = unquote(parse_result.path)
+
+    # returns version as plaintext
+    if path.strip() == "/" or path.strip() == "":
+        return "version", None, ""
+
+    if full_path.strip() == "/favicon.ico":
+        return "favicon", None, ""
+
+    if full_path.strip() == "/metrics":
+        return "metrics", None, ""
+
+    path_parts = full_path.split("/", 2)
+    if len(path_parts) == 3 and (source_id := path_parts[1]) in ALL_SOURCES:
+        return "audio", ALL_SOURCES[source_id], path_parts[2]
+
+    return "lookup", None, ""
+
+
+def get_version_payload() -> bytes:
+    latest_version_file = get_version_file()
+    with open(latest_version_file) as f:
+        ver = f.read().strip()
+    return f"Local Audio Server v{ver}".encode("utf-8")
+
+
+def get_metrics_payload(state: ServerState, path: str) -> tuple[bytes, str]:
+    """
+    returns the (payload, content type) of /metrics: the Prometheus text format,
+    or JSON with ?format=json
+    """
+    if parse_qs(urlparse(path).query).get("format", [""])[0] == "json":
+        return format_json(state.metrics, state.get_metrics_gauges()), "application/json"
+    return format_prometheus(state.metrics, state.get_metrics_gauges()), "text/plain; version=0.0.4; charset=utf-8"
+
+
+def handle_post_request(
+    state: ServerState, path: str, body: bytes, trace: Optional[RequestTrace] = None
+) -> tuple[HTTPStatus, bytes]:
+    """
+    handles the POST routes (POST /batch, /prefetch and /prefetch/cancel) for either engine.
+    Returns the (status, JSON payload) of the response, where the payload is empty for errors
+    """
+    if trace is None:
+        trace = RequestTrace()
+    route = urlparse(path).path
+    max_items = SERVER_CONFIG["batch_max_items"]
+    try:
+        if route == "/batch":
+            trace.route = "batch"
+            with trace.time("parse"):
+                qcomps_list = parse_batch_request(body, max_items)
+            with state.prefetcher.interactive():
+                return HTTPStatus.OK, state.get_batch_payload(qcomps_list, trace)
+
+        if route == "/prefetch":
+            trace.route = "prefetch"
+            qcomps_list, audio, replace = parse_prefetch_request(body, max_items)
+            if audio and not state.audio_cache.enabled:
+                # prefetched audio files are kept in the audio cache, so there is nowhere to put them
+                logger.warning("Not prefetching audio files, because audio_cache_size_mb is 0")
+                audio = False
+            job_id = state.prefetcher.submit(qcomps_list, audio, replace)
+            return HTTPStatus.ACCEPTED, json.dumps({"id": job_id, "audio": audio}).encode("utf-8")
+
+        if route == "/prefetch/cancel":
+            trace.route = "prefetch_cancel"
+            job_id = parse_prefetch_cancel_request(body)
+            cancelled = state.prefetcher.cancel(job_id)
+            return HTTPStatus.OK, json.dumps({"cancelled": cancelled}).encode("utf-8")
+    except ValueError as e:
+        logger.warning("Invalid request to %s: %s", route, e)
+        return HTTPStatus.BAD_REQUEST, b""
+
+    return HTTPStatus.NOT_FOUND, b""
+
+
+def open_audio_file(audio_file: Path) -> Optional[tuple[BinaryIO, os.stat_result]]:
+    """
+    opens a regular file, returning it alongside its stat result (or None if it cannot be opened).
+    Uses a single fstat on the open file, instead of is_file() + stat() on the path.
+    """
+    try:
+        fh = open(audio_file, "rb")
+    except OSError:
+        return None
+
+    file_stat = os.fstat(fh.fileno())
+    if not stat.S_ISREG(file_stat.st_mode):
+        fh.close()
+        return None
+    return fh, file_stat
 
 
 class LocalAudioHandler(http.server.SimpleHTTPRequestHandler):
 
-    # TODO: maybe use mimetypes.guess_type?
-    # https://docs.python.org/3/library/mimetypes.html
-    SUFFIX_TO_MIME_TYPE = {
-        ".mp3": "audio/mpeg",
-        ".aac": "audio/aac",
-        ".m4a": "audio/mp4",
-        ".ogg": "audio/ogg",
-        ".oga": "audio/ogg",
-        ".opus": "audio/ogg",
-        ".flac": "audio/flac",
-    }
-
-    def log_error(self, *args, **kwargs):
+    SUFFIX_TO_MIME_TYPE = SUFFIX_TO_MIME_TYPE
+
+    # persistent connections, so a lookup and the audio fetches after it can share one connection
+    protocol_version = "HTTP/1.1"
+    # seconds an idle connection is kept open for (also applies to stalled reads and writes)
+    timeout = SERVER_CONFIG["keepalive_timeout"]
+    # the connection is closed after this many responses
+    max_keepalive_requests = SERVER_CONFIG["keepalive_max_requests"]
+    # headers and body are written separately, so on a persistent connection Nagle's algorithm
+    # would hold back the body until the client's delayed ACK (~40ms) arrives
+    disable_nagle_algorithm = True
+    # whether every response gets Server-Timing and X-Request-ID headers
+    server_timing = SERVER_CONFIG["server_timing"]
+
+    def setup(self):
+        super().setup()
+        self.responses_on_connection = 0
+
+    def handle_one_request(self):
+        self.trace = RequestTrace()
+        self.request_id = None
+        # not set by parse_request() if the request line is malformed
+        self.path = ""
+        self.response_status = None
+        # the number of results (or the lookup response to count them from) for the access log
+        self.log_results = None
+        super().handle_one_request()
+        if self.response_status is not None:
+            self.server.state.metrics.observe_request(self.trace, self.response_status)
+            log_access(
+                self.command or "-", self.path, self.response_status, self.log_results, self.trace.elapsed(),
+                self.request_id,
+            )
+
+    def parse_request(self):
+        # starts timing once the request line has arrived, instead of while waiting on an idle connection
+        self.trace.start = time.perf_counter()
+        return super().parse_request()
+
+    def send_response(self, code, message=None):
+        self.response_status = code
+        self.sent_connection_header = False
+        super().send_response(code, message)
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == "connection":
+            # i.e. send_error() always sends "Connection: close" itself
+            self.sent_connection_header = True
+        super().send_header(keyword, value)
+
+    def log_error(self, format, *args):
         """By default, SimpleHTTPRequestHandler logs to stderr.  This would
         cause Anki to show an error, even on successful requests
-        log_error is still a useful function though, so replace it
-        with the inherited log_message."""
-        super().log_message(*args, **kwargs)
+        log_error is still a useful function though, so send it to the server's logger."""
+        logger.warning("%s - %s", self.address_string(), format % args)
 
     def log_message(self, *args):
-        """Make log_message do nothing."""
+        """Make log_message do nothing (requests are logged by log_access instead)."""
+        pass
+
+    def end_headers(self):
+        self.responses_on_connection += 1
+        if not self.sent_connection_header and (
+            self.close_connection or self.responses_on_connection >= self.max_keepalive_requests
+        ):
+            # tells the client, and also sets self.close_connection
+            self.send_header("Connection", "close")
+        if self.server_timing:
+            self.send_trace_headers()
+        super().end_headers()
+
+    def send_trace_headers(self):
+        # headers is only set once the request line could be parsed
+        headers = getattr(self, "headers", None)
+        self.request_id = get_request_id(headers.get("X-Request-ID") if headers is not None else None)
+        self.send_header("X-Request-ID", self.request_id)
+        self.send_header("Server-Timing", self.trace.server_timing())
+        # lets Yomitan (and the browser's devtools) read both headers on cross-origin requests
+        self.send_header("Timing-Allow-Origin", "*")
+        self.send_header("Access-Control-Expose-Headers", "X-Request-ID, Server-Timing")
+
+    def send_unavailable(self):
+        """
+        tells the client to retry the request later, i.e. when the server has too many requests
+        """
+        self.send_response(HTTPStatus.SERVICE_UNAVAILABLE)
+        self.send_header("Retry-After", str(RETRY_AFTER_SECONDS))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def acquire_slot(self, route: str) -> bool:
+        """
+        whether a request to the route can be handled right now. Only limited by the "pool" engine
+        """
+        return True
+
+    def release_slot(self, route: str):
         pass
 
     def send_cors_response(self, code):
         """Send response with CORS headers."""
         self.send_response(code)
         self.send_header("Access-Control-Allow-Origin", "*")
+        # required to keep the connection alive, even without a body
+        self.send_header("Content-Length", "0")
         self.end_headers()
 
     def get_audio(self, media_dir, file_path):
         audio_file = media_dir.joinpath(file_path)
-        if not audio_file.is_file():
+
+        mime_type = LocalAudioHandler.SUFFIX_TO_MIME_TYPE.get(audio_file.suffix.lower(), None)
+        if mime_type is None:
             self.send_cors_response(400)
             return
 
-        mime_type = LocalAudioHandler.SUFFIX_TO_MIME_TYPE.get(audio_file.suffix, None)
-        if mime_type is None:
+        trace = self.trace
+        with trace.time("open"):
+            cached = self.server.state.get_cached_audio(audio_file)
+        if cached is not None:
+            trace.cache = "hit"
+            data, file_stat = cached
+            body = self.send_audio_headers(mime_type, file_stat.st_size, file_stat.st_mtime_ns)
+            if body is not None:
+                offset, count = body
+                with trace.time("send"):
+                    self.send_data(memoryview(data)[offset:offset + count])
+            return
+
+        with trace.time("open"):
+            opened = open_audio_file(audio_file)
+        if opened is None:
             self.send_cors_response(400)
             return
-        self.send_response(200)
-        self.send_header("Content-type", mime_type)
-        self.send_header("Content-length", str(os.stat(audio_file).st_size))
-        self.send_header("Access-Control-Allow-Origin", "*")
+
+        fh, file_stat = opened
+        with fh:
+            body = self.send_audio_headers(mime_type, file_stat.st_size, file_stat.st_mtime_ns)
+            if body is not None:
+                offset, count = body
+                with trace.time("send"):
+                    self.send_file(fh, offset, count)
+
+    def send_audio_headers(self, mime_type: str, size: int, mtime_ns: int) -> Optional[tuple[int, int]]:
+        """
+        sends the headers for an audio response, handling conditional and range requests.
+        returns the (offset, count) part of the file that must be sent as the body,
+        or None if no body should be sent (304, 416 or HEAD)
+        """
+        head = audio_response_head(self.headers, mime_type, size, mtime_ns, self.command == "HEAD")
+        self.send_response(head.status)
+        for keyword, value in head.headers:
+            self.send_header(keyword, value)
         self.end_headers()
+        return head.body
 
-        with open(audio_file, "rb") as fh:
-            self.wfile.write(fh.read())
+    def send_file(self, fh, offset: int, count: int):
+        """
+        streams part of an open file to the client without reading it into memory.
+        socket.sendfile() uses os.sendfile() where the platform supports it, and otherwise
+        copies the file in fixed-size chunks, so memory use does not depend on the file size.
+        """
+        if count <= 0:
+            return
+        try:
+            self.connection.sendfile(fh, offset, count)
+        except (BrokenPipeError, ConnectionResetError):
+            self.log_error("Connection closed while sending file")
+            self.close_connection = True
 
-    def _get_audio_android(self, source, file_path):
+    def send_data(self, data) -> bool:
         """
-        internal testing method, shouldn't be used outside of testing the android db
+        returns False if the client has closed the connection
         """
-        audio_file = Path(file_path)
+        try:
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            self.log_error("Connection closed while sending data")
+            self.close_connection = True
+            return False
+        return True
 
-        mime_type = LocalAudioHandler.SUFFIX_TO_MIME_TYPE.get(audio_file.suffix, None)
+    def get_android_audio(self, source_id: str, file_path: str):
+        """
+        sends an audio file stored in android.db. The row is looked up before any headers are sent,
+        and the blob is then streamed in chunks on the same pooled connection
+        """
+        mime_type = LocalAudioHandler.SUFFIX_TO_MIME_TYPE.get(Path(file_path).suffix.lower(), None)
         if mime_type is None:
             self.send_cors_response(400)
             return
-        self.send_response(200)
-        self.send_header("Content-type", mime_type)
-        self.send_header("Access-Control-Allow-Origin", "*")
-        self.end_headers()
 
-        android_db_path = get_android_db_file()
-        with sqlite3.connect(android_db_path) as android_connection:
-            android_cursor = android_connection.cursor()
-            sql = """
-            SELECT data FROM android WHERE file = :file AND source = :source
-            """
-            row = android_cursor.execute(
-                sql, {"file": file_path, "source": source}
-            ).fetchone()
-            if row is None:
+        state = self.server.state
+        trace = self.trace
+        with state.android_db_connection() as connection:
+            with trace.time("open"):
+                audio = None if connection is None else state.open_android_audio(connection, source_id, file_path)
+            if audio is None:
                 self.send_cors_response(400)
                 return
 
-            data = row[0]
-            self.wfile.write(data)
-
-            android_cursor.close()
-
-    def parse_query_components(self) -> QueryComponents:
-        """Extract 'term', 'reading', 'sources', and 'user' query parameters"""
-        parsed_qcomps = parse_qs(urlparse(self.path).query)
-
-        if "term" in parsed_qcomps:
-            term = parsed_qcomps["term"][0]
-        elif "expression" in parsed_qcomps:
-            term = parsed_qcomps["expression"][0]
-        else:
-            print(f"Cannot find term or expression in query: {self.path}")
-            return None
-
-        # reading field should actually be optional, to query just for the term / expression
-        if "reading" in parsed_qcomps:
-            reading = parsed_qcomps["reading"][0]
-        else:
-            reading = None
-
-        if "sources" in parsed_qcomps:
-            sources = parsed_qcomps["sources"][0].split(",")
-        else:
-            sources = list(ALL_SOURCES.keys())
-
-        if "user" in parsed_qcomps:
-            user = [u.strip() for u in parsed_qcomps["user"][0].split(",")]
-        else:
-            user = []
-
-        qcomps = QueryComponents(term, reading, sources, user)
-
-        return qcomps
-
-    def send_version(self):
-        latest_version_file = get_version_file()
-        with open(latest_version_file) as f:
-            ver = f.read().strip()
-        payload = f"Local Audio Server v{ver}".encode("utf-8")
-
-        self.send_response(200)
-        self.send_header("Content-type", "text/plain; charset=UTF-8")
+            if audio.data is not None:
+                trace.cache = "hit"
+            body = self.send_audio_headers(mime_type, audio.size, audio.mtime_ns)
+            if body is None:
+                return
+            offset, count = body
+            with trace.time("send"):
+                if audio.data is not None:
+                    self.send_data(memoryview(audio.data)[offset:offset + count])
+                    return
+                with closing(read_android_audio(connection, audio.rowid, offset, count)) as chunks:
+                    for chunk in chunks:
+                        if not self.send_data(chunk):
+                            break
+
+    def send_payload(self, payload: bytes, content_type: str, status: int = HTTPStatus.OK):
+        self.send_response(status)
+        self.send_header("Content-type", content_type)
         self.send_header("Content-Length", str(len(payload)))
         self.send_header("Access-Control-Allow-Origin", "*")
         self.end_headers()
-        self.wfile.write(payload)
+        if self.command == "HEAD":
+            return
+        try:
+            with self.trace.time("write"):
+                self.wfile.write(payload)
+        except BrokenPipeError:
+            self.log_error("BrokenPipe when sending reply")
 
     def do_GET(self):
-        print("GET:", self.path)
+        with self.server.state.prefetcher.interactive():
+            self.handle_get()
 
-        # https://stackoverflow.com/questions/7894384/python-get-url-path-sections
-        parse_result = urlparse(self.path)
-        full_path = unquote(parse_result.path)
+    def handle_get(self):
+        trace = self.trace
+        with trace.time("parse"):
+            route, audio_source, file_path = match_route(self.path)
+        trace.route = route
 
-        # returns version as plaintext
-        if self.path.strip() == "/" or self.path.strip() == "":
-            self.send_version()
+        if not self.acquire_slot(route):
+            self.send_unavailable()
+            return
+        try:
+            self.handle_route(route, audio_source, file_path)
+        finally:
+            self.release_slot(route)
+
+    def handle_route(self, route: str, audio_source: Optional[AudioSource], file_path: str):
+        trace = self.trace
+        if route == "version":
+            self.send_payload(get_version_payload(), "text/plain; charset=UTF-8")
             return
 
-        if full_path.strip() == "/favicon.ico":
+        if route == "favicon":
             # skip entirely
             self.send_cors_response(400)
             return
 
-        path_parts = full_path.split("/", 2)
-        if len(path_parts) == 3 and (source_id := path_parts[1]) in ALL_SOURCES:
-            audio_source = ALL_SOURCES[source_id]
-            file_path = path_parts[2]
-            self.get_audio(audio_source.get_media_dir_path(), file_path)
-            # self._get_audio_android(audio_source.data.id, file_path)
+        if route == "metrics":
+            payload, content_type = get_metrics_payload(self.server.state, self.path)
+            self.send_payload(payload, content_type)
             return
 
-        qcomps = self.parse_query_components()
+        if route == "audio":
+            trace.source = audio_source.data.id
+            if audio_source.data.serve_from == SERVE_FROM_ANDROID_DB:
+                self.get_android_audio(audio_source.data.id, file_path)
+            else:
+                self.get_audio(audio_source.get_media_dir_path(), file_path)
+            return
+
+        with trace.time("parse"):
+            qcomps = parse_query_components(self.path)
         if not qcomps:
             self.send_cors_response(400)
             return
 
-        audio_sources_json_list = []
-        with sqlite3.connect(get_db_file()) as connection:
-            rows = execute_query(connection, qcomps)
-            for row in rows:
-                source = row[SOURCE]
-                file = row[FILE]
-
-                audio_source = ALL_SOURCES.get(source, None)
-                if audio_source is None:
-                    print(f"(do_GET) unknown source {source}")
-                    continue
-
-                # we use the %s substitutions so it's more compatible between other languages
-                display = row[DISPLAY]
-                if display is not None:
-                    name = audio_source.data.display % row[DISPLAY]
-                else:
-                    name = audio_source.data.display
-                url = audio_source.construct_file_url(file)
-                entry = {"name": name, "url": url}
-                audio_sources_json_list.append(entry)
-
-        # Build JSON that Yomitan requires
-        # Ref: https://github.com/yomidevs/yomitan/blob/master/ext/data/schemas/custom-audio-list-schema.json
-        resp = {"type": "audioSourceList", "audioSources": audio_sources_json_list}
-        print(audio_sources_json_list)
-
-        # Writing the JSON contents with UTF-8
-        payload = bytes(json.dumps(resp), "utf8")
-        self.send_response(HTTPStatus.OK)
-        self.send_header("Content-type", "application/json")
-        self.send_header("Content-length", str(len(payload)))
-        self.send_header("Access-Control-Allow-Origin", "*")
-        self.end_headers()
+        payload = self.server.state.get_lookup_payload(qcomps, trace)
+        self.log_results = payload
+        self.send_payload(payload, "application/json")
+
+    def do_HEAD(self):
+        # same routes as GET, the body is skipped by send_payload / send_audio_headers
+        self.do_GET()
+
+    def do_POST(self):
         try:
-            self.wfile.write(payload)
-        except BrokenPipeError:
-            self.log_error("BrokenPipe when sending reply")
-        return
+            content_length = int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            self.close_connection = True
+            self.send_cors_response(HTTPStatus.LENGTH_REQUIRED)
+            return
+        if content_length < 0:
+            # rfile.read(-1) would wait for the client to close the connection
+            self.close_connection = True
+            self.send_cors_response(HTTPStatus.BAD_REQUEST)
+            return
+        if content_length > BATCH_MAX_BODY_SIZE:
+            # the body isn't read, so the connection can't be reused
+            self.close_connection = True
+            self.send_cors_response(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+            return
+
+        body = self.rfile.read(content_length)
+        if not self.acquire_slot("batch"):
+            self.send_unavailable()
+            return
+        try:
+            status, payload = handle_post_request(self.server.state, self.path, body, self.trace)
+        finally:
+            self.release_slot("batch")
+        if status >= 400:
+            self.send_cors_response(status)
+            return
+        self.log_results = payload
+        self.send_payload(payload, "application/json", status)
+
+
+class LocalAudioServer(http.server.ThreadingHTTPServer):
+    """
+    Default server engine: one thread per connection.
+    """
+
+    def __init__(self, server_address, RequestHandlerClass=LocalAudioHandler):
+        # created first, as server_close() is also called if binding fails
+        self.state = ServerState()
+        super().__init__(server_address, RequestHandlerClass)
+
+    def server_close(self):
+        super().server_close()
+        self.state.close()
+
+    def handle_error(self, request, client_address):
+        """By default, socketserver prints the traceback to stderr, which Anki shows as an error."""
+        if isinstance(sys.exc_info()[1], (ConnectionError, TimeoutError)):
+            # i.e. the client went away in the middle of a request
+            logger.debug("Connection from %s closed", client_address, exc_info=True)
+        else:
+            logger.exception("Error while handling a connection from %s", client_address)
+
+
+def create_server(server_address=(HOSTNAME, PORT)):
+    """
+    creates the server using the engine selected by the "server_engine" option
+    """
+    engine = SERVER_CONFIG["server_engine"]
+    if engine == "threading":
+        return LocalAudioServer(server_address)
+    if engine == "asyncio":
+        from .async_server import AsyncLocalAudioServer
+
+        return AsyncLocalAudioServer(server_address)
+    if engine == "pool":
+        from .pool_server import PooledLocalAudioServer
+
+        return PooledLocalAudioServer(server_address)
+    raise Exception(f"Unknown server engine: {engine}")
 
 
 def run_server():
     # Else, run it in a separate thread so it doesn't block
-    httpd = http.server.ThreadingHTTPServer((HOSTNAME, PORT), LocalAudioHandler)
+    httpd = create_server()
     server_thread = threading.Thread(target=httpd.serve_forever)
     server_thread.daemon = True
     server_thread.start()
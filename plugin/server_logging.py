@@ -0,0 +1,156 @@
+"""
+Logging for the server.
+
+Records are put on a queue by the request threads, and written by a single background
+thread (QueueListener), so a request never waits on stdout or a log file.
+Per-request access records are logged at the INFO level, and can be sampled.
+"""
+
+from __future__ import annotations
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+from typing import Optional
+
+from .config import JsonServerConfig
+
+logger = logging.getLogger("local_audio")
+access_logger = logging.getLogger("local_audio.access")
+
+LOG_LEVELS = {
+    "off": logging.CRITICAL + 1,
+    "error": logging.ERROR,
+    "warning": logging.WARNING,
+    "info": logging.INFO,
+    "debug": logging.DEBUG,
+}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+# the handler added by setup_logging(). Other handlers (i.e. added by Anki or pytest) are left alone
+_handler: Optional[logging.Handler] = None
+_setup_lock = threading.Lock()
+_access_sample_rate = 1.0
+
+
+class ServerLogFormatter(logging.Formatter):
+    """
+    formats access records as `GET /?term=読む 200 results=3 0.52ms` (followed by `id=...` if the
+    response has a request id), and everything else as usual.
+    The number of results of a lookup is counted here (on the listener thread)
+    instead of while handling the request
+    """
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        if record.name != access_logger.name:
+            return super().format(record)
+        results = getattr(record, "results", None)
+        if isinstance(results, bytes):
+            results = count_results(results)
+        line = (
+            f"{self.formatTime(record)} {record.method} {record.path} {record.status} "
+            f"results={'-' if results is None else results} {record.duration * 1000:.2f}ms"
+        )
+        if record.request_id is not None:
+            line += f" id={record.request_id}"
+        return line
+
+
+def count_results(payload: bytes) -> Optional[int]:
+    """
+    number of audio sources in a lookup response (or of lookups in a batch response)
+    """
+    try:
+        resp = json.loads(payload)
+    except ValueError:
+        return None
+    if isinstance(resp, list):
+        return len(resp)
+    if isinstance(resp, dict) and "audioSources" in resp:
+        return len(resp["audioSources"])
+    return None
+
+
+def setup_logging(config: JsonServerConfig):
+    """
+    configures the server's loggers from the config. Only the first call has any effect
+    """
+    global _listener, _handler, _access_sample_rate
+
+    with _setup_lock:
+        if _handler is not None:
+            return
+
+        level = LOG_LEVELS.get(config["log_level"].lower(), None)
+        if level is None:
+            raise Exception(f"Unknown log level: {config['log_level']}")
+        logger.setLevel(level)
+        # never reaches Anki's root logger (or stderr, which shows an error popup in Anki)
+        logger.propagate = False
+        _access_sample_rate = config["access_log_sample_rate"]
+
+        if level > logging.CRITICAL:
+            # no handler at all, so disabled records are dropped right at the isEnabledFor() check
+            _handler = logging.NullHandler()
+            logger.addHandler(_handler)
+            return
+
+        log_file = config["log_file"]
+        if log_file:
+            output = logging.FileHandler(log_file, encoding="utf-8")
+        else:
+            output = logging.StreamHandler(sys.stdout)
+        output.setFormatter(ServerLogFormatter())
+
+        log_queue: queue.SimpleQueue = queue.SimpleQueue()
+        _handler = logging.handlers.QueueHandler(log_queue)
+        logger.addHandler(_handler)
+        _listener = logging.handlers.QueueListener(log_queue, output)
+        _listener.start()
+        # the listener thread is a daemon thread, so records still in the queue would be lost on exit
+        atexit.register(stop_logging)
+
+
+def stop_logging():
+    """
+    writes out all queued records, and stops the background thread
+    """
+    global _listener, _handler
+
+    with _setup_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+        if _handler is not None:
+            logger.removeHandler(_handler)
+            _handler.close()
+            _handler = None
+
+
+def log_access(
+    method: str, path: str, status: int, results: Optional[int | bytes], duration: float,
+    request_id: Optional[str] = None,
+):
+    """
+    logs a finished request. results is either a count, or a lookup response to count the results of.
+    Does nothing (not even formatting) unless access logging is enabled
+    """
+    if not access_logger.isEnabledFor(logging.INFO):
+        return
+    if _access_sample_rate < 1.0 and random.random() >= _access_sample_rate:
+        return
+    access_logger.info(
+        "",
+        extra={
+            "method": method, "path": path, "status": int(status), "results": results, "duration": duration,
+            "request_id": request_id,
+        },
+    )
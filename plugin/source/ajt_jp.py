@@ -2,12 +2,15 @@ from __future__ import annotations  # for Python 3.7-3.9
 
 import json
 import sqlite3
-from typing import Optional, Final, TypedDict
+from contextlib import closing
+from pathlib import Path
+from typing import Iterator, Optional, TypedDict
 # THIS REQUIRES A PIP INSTALL, making it impossible to use in Anki...
 #from typing_extensions import NotRequired
 
-from .audio_source import AudioSource
+from .audio_source import AudioSource, EntryRow
 from ..jp_util import split_into_mora, hiragana_to_katakana
+from ..json_stream import iter_json_items
 
 
 """
@@ -49,11 +52,6 @@ class AJTIndex(TypedDict):
     files: dict[str, AJTFile]
 
 
-SQL: Final[
-    str
-] = "INSERT INTO entries (expression, reading, source, display, file) VALUES (?,?,?,?,?)"
-
-
 class AJTJapaneseSource(AudioSource):
     def get_display_text(self, ajt_file: AJTFile) -> Optional[str]:
         """
@@ -78,29 +76,38 @@ class AJTJapaneseSource(AudioSource):
             mora_list.insert(pitch_accent, "＼")
         return "".join(mora_list) + f" [{pitch_accent}]"
 
-    def add_entries(self, connection: sqlite3.Connection):
-        cur = connection.cursor()
+    def get_input_files(self) -> list[Path]:
+        return [self.get_media_dir_path().joinpath("index.json")]
+
+    def get_entries(self) -> Iterator[EntryRow]:
         index_file = self.get_media_dir_path().joinpath("index.json")
 
         if not index_file.is_file(): # don't error if it simply doesn't exist
             print(f"({self.__class__.__name__}) Cannot find entries file: {index_file}")
             return
 
-        with open(index_file, encoding="utf-8") as f:
-            entries: AJTIndex = json.load(f)
-            files = entries["files"]
-
-            for expression, word_files in entries["headwords"].items():
+        # read in two passes instead of decoding the whole index at once: "files" (the largest part of the index)
+        # is written to a temporary database to look up the files of each headword, and "headwords" is read
+        # one at a time. The database is a file that's deleted once it's closed, and sqlite only keeps
+        # a few of its pages in memory
+        with open(index_file, encoding="utf-8") as f, closing(sqlite3.connect("")) as files:
+            files.execute("CREATE TABLE files (name text PRIMARY KEY NOT NULL, file text NOT NULL) WITHOUT ROWID")
+            # like a dict, a file that is in the index twice is replaced
+            files.executemany(
+                "INSERT OR REPLACE INTO files (name, file) VALUES (?, ?)",
+                ((name, json.dumps(ajt_file)) for name, ajt_file in iter_json_items(f, ["files"])),
+            )
+            f.seek(0)
+
+            for expression, word_files in iter_json_items(f, ["headwords"]):
                 for word_file in word_files:
                     fullpath = self.get_media_dir_path().joinpath("media").joinpath(word_file)
                     relpath = fullpath.relative_to(self.get_media_dir_path())
                     if not fullpath.is_file():
                         continue
-                    ajt_file = files.get(word_file, None)
-                    if ajt_file is not None:
+                    row = files.execute("SELECT file FROM files WHERE name = ?", (word_file,)).fetchone()
+                    if row is not None:
+                        ajt_file: AJTFile = json.loads(row[0])
                         reading = ajt_file.get("kana_reading", None)
                         display = self.get_display_text(ajt_file)
-                        cur.execute(SQL, (expression, reading, self.data.id, display, str(relpath)))
-
-        cur.close()
-        connection.commit()
+                        yield (expression, reading, self.data.id, None, display, str(relpath))
@@ -1,9 +1,7 @@
-import sqlite3
-
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Final
+from typing import Final, Iterator, Optional
 
 from urllib.parse import urlunparse
 
@@ -15,6 +13,17 @@ from ..consts import (
     HOSTNAME,
     PORT,
 )
+from ..media_scan import AUDIO_FILE_EXTENSIONS, MediaFile, scan_media_files
+
+
+# where the server reads the audio files of a source from (the "serve_from" config key)
+SERVE_FROM_FILES: Final = "files"
+SERVE_FROM_ANDROID_DB: Final = "android_db"
+SERVE_FROM_VALUES: Final = (SERVE_FROM_FILES, SERVE_FROM_ANDROID_DB)
+
+
+# a row of the `entries` table: (expression, reading, source, speaker, display, file)
+EntryRow = tuple[str, Optional[str], str, Optional[str], Optional[str], str]
 
 
 @dataclass
@@ -22,6 +31,7 @@ class AudioSourceData:
     id: Final[str]  # also the table name
     media_dir: Final[str]
     display: Final[str]
+    serve_from: Final[str] = SERVE_FROM_FILES
 
 
 class AudioSource(ABC):
@@ -29,12 +39,18 @@ class AudioSource(ABC):
         self.data = data
 
     @abstractmethod
-    def add_entries(self, connection: sqlite3.Connection):
+    def get_entries(self) -> Iterator[EntryRow]:
         """
-        add entries to the `entries` table
+        yields the rows of the `entries` table for this source (written by db_utils.write_entries)
         """
         pass
 
+    def get_input_files(self) -> list[Path]:
+        """
+        the files get_entries() reads besides the audio files, i.e. index files (see fingerprint.py)
+        """
+        return []
+
     def is_supported_audio_file_ext(self, path):
         """
         determine whether a given file path is a valid audio file extension
@@ -43,17 +59,16 @@ class AudioSource(ABC):
             path = Path(path)
         if not path.is_file():
             return False
-        # audio container formats supposedly supported by browsers (excluding webm since it's typically for videos)
-        if not path.suffix.lower() in ['.mp3', '.m4a', '.aac', '.ogg', '.oga', '.opus', '.flac', '.wav']:
+        if not path.suffix.lower() in AUDIO_FILE_EXTENSIONS:
             print(f"({self.__class__.__name__}) skipping non-audio file: {path}")
             return False
         return True
 
-    def find_media_files(self):
+    def find_media_files(self) -> Iterator[MediaFile]:
         """
-        returns a list of all valid audio files in the media_dir
+        returns all valid audio files in the media_dir, as (relative_path, stem, parent_name) tuples
         """
-        return filter(self.is_supported_audio_file_ext, self.get_media_dir_path().rglob("*"))
+        return scan_media_files(self.get_media_dir_path(), self.__class__.__name__)
 
     def construct_file_url(self, file_path: str):
         """
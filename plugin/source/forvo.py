@@ -1,20 +1,11 @@
-import sqlite3
+from typing import Iterator
 
-from .audio_source import AudioSource
+from .audio_source import AudioSource, EntryRow
 from ..consts import *
 
 
 class ForvoAudioSource(AudioSource):
-    def add_entries(self, connection: sqlite3.Connection):
-        sql = "INSERT INTO entries (expression, source, speaker, display, file) VALUES (?,?,?,?,?)"
-        cur = connection.cursor()
-
-        for path in self.find_media_files():
-            relative_path = str(path.relative_to(self.get_media_dir_path()))
-            speaker = path.parent.name
+    def get_entries(self) -> Iterator[EntryRow]:
+        for relative_path, expr, speaker in self.find_media_files():
             display = speaker
-            expr = path.stem
-            cur.execute(sql, (expr, self.data.id, speaker, display, relative_path))
-
-        cur.close()
-        connection.commit()
+            yield (expr, None, self.data.id, speaker, display, relative_path)
@@ -1,22 +1,12 @@
-import sqlite3
+from typing import Iterator
 
-from .audio_source import AudioSource
+from .audio_source import AudioSource, EntryRow
 from ..jp_util import is_kana
 
 
 class JPodAudioSource(AudioSource):
-    def add_entries(self, connection: sqlite3.Connection):
-        cur = connection.cursor()
-        sql = f"""
-        INSERT INTO entries
-          (expression, reading, source, file)
-        VALUES
-          (?,?,?,?)
-            """
-
-        for path in self.find_media_files():
-            relative_path = str(path.relative_to(self.get_media_dir_path()))
-            basename_noext = path.stem
+    def get_entries(self) -> Iterator[EntryRow]:
+        for relative_path, basename_noext, _ in self.find_media_files():
             parts = basename_noext.split(" - ")
 
             # Cannot parse required fields from a filename missing a " - " separator.
@@ -34,13 +24,8 @@ class JPodAudioSource(AudioSource):
             if reading == expr:
                 if is_kana(reading):
                     # it's likely safe to store kana only words like this
-                    cur.execute(
-                        sql, (reading, reading, self.data.id, relative_path)
-                    )
+                    yield (reading, reading, self.data.id, None, None, relative_path)
                 else:
-                    cur.execute(sql, (reading, None, self.data.id, relative_path))
+                    yield (reading, None, self.data.id, None, None, relative_path)
             else:
-                cur.execute(sql, (expr, reading, self.data.id, relative_path))
-
-        cur.close()
-        connection.commit()
+                yield (expr, reading, self.data.id, None, None, relative_path)
@@ -1,9 +1,10 @@
-import json
-import sqlite3
+from pathlib import Path
+from typing import Iterator
 
-from .audio_source import AudioSource
+from .audio_source import AudioSource, EntryRow
 from ..jp_util import split_into_mora, is_kana, katakana_to_hiragana
 from ..consts import *
+from ..json_stream import iter_json_items
 
 num2fullwidth = str.maketrans("0123456789", "０１２３４５６７８９")
 
@@ -87,15 +88,10 @@ class NHK16AudioSource(AudioSource):
         )
         return display_text
 
+    def get_input_files(self) -> list[Path]:
+        return [self.get_media_dir_path().joinpath("entries.json")]
 
-    def insert_entry(self, conn, entry):
-        cur = conn.cursor()
-
-        sql = 'INSERT INTO entries (expression, reading, source, display, file) VALUES (?,?,?,?,?)'
-        cur.execute(sql, entry)
-
-        cur.close()
-    def add_entries(self, conn: sqlite3.Connection):
+    def get_entries(self) -> Iterator[EntryRow]:
         media_path = self.get_media_dir_path()
         entries_file = media_path.joinpath("entries.json")
 
@@ -104,81 +100,53 @@ class NHK16AudioSource(AudioSource):
             return
 
         with open(entries_file, "r", encoding="utf-8", errors="ignore") as f:
-            entries = json.load(f)
-
-        for entry in entries:
-            reading = entry["kana"]
-            expression_list = self.parse_headwords(entry["kanji"], "，")
-
-            optional_kanji_list = self.parse_headwords(entry["kanjiNotUsed"], "，")
-            for optional_kanji in optional_kanji_list:
-                for expression in expression_list:
-                    if optional_kanji in expression:
-                        expression_list.remove(expression)
-
-            for accent in entry["accents"]:
-                sound_file = self.get_sound_relpath(accent)
-                if sound_file is None:
-                    continue
-                display_text = self.get_display_text(accent)
-                if len(expression_list) == 0:
-                    self.insert_entry(
-                        conn, (reading, reading, "nhk16", display_text, sound_file)
-                    )  # entry
-                for expression in expression_list:
-                    self.insert_entry(
-                        conn, (expression, reading, "nhk16", display_text, sound_file)
-                    )  # entry
-
-            for subentry in entry["subentries"]:
-                if "head" in subentry:
-                    head_list = self.parse_headwords([subentry["head"]], "，")
-                    for accent in subentry["accents"]:
-                        sound_file = self.get_sound_relpath(accent)
-                        if sound_file is None:
-                            continue
-                        display_text = self.get_display_text(accent)
-                        for head in head_list:
-                            if is_kana(head):
-                                self.insert_entry(
-                                    conn, (head, head, "nhk16", display_text, sound_file)
-                                )  # subentry
-                            else:
-                                self.insert_entry(
-                                    conn, (head, None, "nhk16", display_text, sound_file)
-                                )  # subentry
-                else:  # number (+counter) section
-                    expression_list = self.parse_headwords(entry["kanji"], "・")
-                    numbers = self.get_numbers(subentry["number"])
-                    for accent in subentry["accents"]:
-                        sound_file = self.get_sound_relpath(accent)
-                        if sound_file is None:
-                            continue
-                        display_text = self.get_display_text(accent)
-                        if reading == "整数":
-                            reading = ""
-                        if len(expression_list) == 0:
-                            for number in numbers:
-                                self.insert_entry(
-                                    conn,
-                                    (
-                                        f"{number}{reading}",
-                                        None,
-                                        "nhk16",
-                                        display_text,
-                                        sound_file,
-                                    ),
-                                )  # counter
-                        for expression in expression_list:
-                            for number in numbers:
-                                self.insert_entry(
-                                    conn,
-                                    (
-                                        f"{number}{expression}",
-                                        None,
-                                        "nhk16",
-                                        display_text,
-                                        sound_file,
-                                    ),
-                                )  # counter
-        conn.commit()
+            # one entry at a time, as the whole file would take hundreds of MB once decoded
+            for entry in iter_json_items(f):
+                reading = entry["kana"]
+                expression_list = self.parse_headwords(entry["kanji"], "，")
+
+                optional_kanji_list = self.parse_headwords(entry["kanjiNotUsed"], "，")
+                for optional_kanji in optional_kanji_list:
+                    for expression in expression_list:
+                        if optional_kanji in expression:
+                            expression_list.remove(expression)
+
+                for accent in entry["accents"]:
+                    sound_file = self.get_sound_relpath(accent)
+                    if sound_file is None:
+                        continue
+                    display_text = self.get_display_text(accent)
+                    if len(expression_list) == 0:
+                        yield (reading, reading, "nhk16", None, display_text, sound_file)  # entry
+                    for expression in expression_list:
+                        yield (expression, reading, "nhk16", None, display_text, sound_file)  # entry
+
+                for subentry in entry["subentries"]:
+                    if "head" in subentry:
+                        head_list = self.parse_headwords([subentry["head"]], "，")
+                        for accent in subentry["accents"]:
+                            sound_file = self.get_sound_relpath(accent)
+                            if sound_file is None:
+                                continue
+                            display_text = self.get_display_text(accent)
+                            for head in head_list:
+                                if is_kana(head):
+                                    yield (head, head, "nhk16", None, display_text, sound_file)  # subentry
+                                else:
+                                    yield (head, None, "nhk16", None, display_text, sound_file)  # subentry
+                    else:  # number (+counter) section
+                        expression_list = self.parse_headwords(entry["kanji"], "・")
+                        numbers = self.get_numbers(subentry["number"])
+                        for accent in subentry["accents"]:
+                            sound_file = self.get_sound_relpath(accent)
+                            if sound_file is None:
+                                continue
+                            display_text = self.get_display_text(accent)
+                            if reading == "整数":
+                                reading = ""
+                            if len(expression_list) == 0:
+                                for number in numbers:
+                                    yield (f"{number}{reading}", None, "nhk16", None, display_text, sound_file)  # counter
+                            for expression in expression_list:
+                                for number in numbers:
+                                    yield (f"{number}{expression}", None, "nhk16", None, display_text, sound_file)  # counter
@@ -1,11 +1,11 @@
 from __future__ import annotations  # for Python 3.7-3.9
 
-import json
-import sqlite3
-from typing import Optional, Final, TypedDict
+from pathlib import Path
+from typing import Iterator, Optional, TypedDict
 
-from .audio_source import AudioSource
+from .audio_source import AudioSource, EntryRow
 from ..jp_util import split_into_mora, hiragana_to_katakana
+from ..json_stream import iter_json_items, load_json_value
 
 
 """
@@ -58,11 +58,6 @@ class OZK5Index(TypedDict):
     kana_index: dict[str, list[int]]
 
 
-SQL: Final[
-    str
-] = "INSERT INTO entries (expression, reading, source, display, file) VALUES (?,?,?,?,?)"
-
-
 class OZK5AudioSource(AudioSource):
     def get_display_text(self, entry: OZK5Data) -> Optional[str]:
         """displays as katakana"""
@@ -71,21 +66,26 @@ class OZK5AudioSource(AudioSource):
             return None
         return "".join(split_into_mora(hiragana_to_katakana(reading)))
 
-    def add_entries(self, connection: sqlite3.Connection):
-        cur = connection.cursor()
+    def get_input_files(self) -> list[Path]:
+        return [self.get_media_dir_path().joinpath("index.json")]
+
+    def get_entries(self) -> Iterator[EntryRow]:
         index_file = self.get_media_dir_path().joinpath("index.json")
 
         if not index_file.is_file():  # don't error if it simply doesn't exist
             print(f"({self.__class__.__name__}) Cannot find entries file: {index_file}")
             return
 
+        # read in two passes instead of decoding the whole index at once:
+        # "meta" first (it may come after "entries"), and then one entry at a time
         with open(index_file, encoding="utf-8") as f:
-            data: OZK5Index = json.load(f)
-            entries = data["entries"]
-            media_dir = data["meta"].get("media_dir", "media")
+            meta: OZK5Meta = load_json_value(f, ["meta"], {})
+            media_dir = meta.get("media_dir", "media")
+            f.seek(0)
 
             # Process all entries
-            for entry in entries:
+            entry: OZK5Data
+            for entry in iter_json_items(f, ["entries"]):
                 expression = entry["kanji"] or entry["kana"]  # Use kana if no kanji
                 reading = entry["kana"]
                 audio_file = entry["audio_file"]
@@ -97,12 +97,9 @@ class OZK5AudioSource(AudioSource):
                     continue
                 
                 display = self.get_display_text(entry)
-                cur.execute(SQL, (expression, reading, self.data.id, display, str(relpath)))
+                yield (expression, reading, self.data.id, None, display, str(relpath))
                 
                 # If we have kanji, add another entry with kana as expression
                 # so it can be found by both kanji and kana lookups
                 if entry["kanji"] and entry["kanji"] != entry["kana"]:
-                    cur.execute(SQL, (reading, reading, self.data.id, display, str(relpath)))
-
-        cur.close()
-        connection.commit()
\ No newline at end of file
+                    yield (reading, reading, self.data.id, None, display, str(relpath))
@@ -172,10 +172,11 @@ class URLComponents(NamedTuple):
 
 @dataclass(frozen=True)
 class QueryComponents:
+    # hashable, so it can be used directly as a cache key
     expression: str
     reading: Optional[str]
-    sources: list[str]
-    user: list[str]
+    sources: tuple[str, ...]
+    user: tuple[str, ...]
 
 
 AudioSourceJsonEntry = dict[str, str]
@@ -1,19 +1,44 @@
+import argparse
 import socketserver
+
 from plugin.consts import HOSTNAME, PORT
-from plugin.server import LocalAudioHandler
 from plugin.db_utils import attempt_init_db
+from plugin.server import LocalAudioServer, create_server
 from plugin.util import attempt_init_data_dir
 
-class DebugTCPServer(socketserver.TCPServer):
-    # https://stackoverflow.com/a/42147927
-    allow_reuse_address = True
+
+class DebugLocalAudioServer(LocalAudioServer):
+    """
+    handles one connection at a time, on the thread running serve_forever(), for easier debugging
+    (a keep-alive connection holds up the next one until it is closed or times out)
+    """
+
+    def process_request(self, request, client_address):
+        socketserver.TCPServer.process_request(self, request, client_address)
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the local audio server without Anki.")
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of sources read at once (each in its own process) when the database is generated",
+    )
+    parser.add_argument(
+        "--single-threaded",
+        action="store_true",
+        help="handle one connection at a time instead of using the configured server engine",
+    )
+    args = parser.parse_args()
+
     # If we're not in Anki, run the server directly and blocking for easier debugging
     attempt_init_data_dir()
-    attempt_init_db()
+    attempt_init_db(jobs=args.jobs)
 
     print("Running local audio server in debug mode...")
-    httpd = DebugTCPServer((HOSTNAME, PORT), LocalAudioHandler)
+    if args.single_threaded:
+        httpd = DebugLocalAudioServer((HOSTNAME, PORT))
+    else:
+        httpd = create_server()
     httpd.serve_forever()
-
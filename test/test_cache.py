@@ -0,0 +1,63 @@
+from plugin.cache import LookupCache, AudioCache
+from plugin.util import QueryComponents
+
+
+def test_lookup_cache_lru():
+    cache = LookupCache(2)
+    a = QueryComponents("読む", "よむ", ("nhk16", "forvo"), ())
+    b = QueryComponents("読む", None, ("nhk16", "forvo"), ())
+    c = QueryComponents("読む", "よむ", ("forvo",), ("akitomo",))
+
+    assert cache.get(a) is None
+    cache.put(a, b"a", cache.generation)
+    cache.put(b, b"b", cache.generation)
+    assert cache.get(a) == b"a" # a is now the most recently used
+    cache.put(c, b"c", cache.generation)
+
+    assert cache.get(b) is None
+    assert cache.get(a) == b"a"
+    assert cache.get(c) == b"c"
+    assert (cache.hits, cache.misses) == (3, 2)
+
+
+def test_lookup_cache_invalidation():
+    cache = LookupCache(8)
+    key = QueryComponents("読む", "よむ", ("nhk16",), ())
+
+    generation = cache.generation
+    cache.put(key, b"old", generation)
+    cache.clear()
+    assert cache.get(key) is None
+
+    # computed before the clear, so it must not be stored
+    cache.put(key, b"stale", generation)
+    assert cache.get(key) is None
+
+
+def test_audio_cache_budget():
+    cache = AudioCache(max_bytes=10, max_file_size=6)
+    assert not cache.admits(7)
+
+    cache.put("a", b"aaaa", 1, cache.generation)
+    cache.put("b", b"bbbb", 1, cache.generation)
+    cache.put("big", b"x" * 7, 1, cache.generation) # larger than max_file_size
+    assert cache.get("a", 1) == b"aaaa" # a is now the most recently used
+    cache.put("c", b"cccc", 1, cache.generation) # over budget, evicts b
+
+    assert cache.get("b", 1) is None
+    assert cache.get("big", 1) is None
+    assert cache.get("c", 1) == b"cccc"
+    assert cache.resident_bytes == 8
+
+
+def test_audio_cache_version():
+    cache = AudioCache(max_bytes=10, max_file_size=10)
+    cache.put("a", b"aaaa", (4, 1), cache.generation)
+    assert cache.get("a", (4, 2)) is None # file was modified
+    assert cache.get("a", (4, 1)) is None # the stale entry was removed
+    assert cache.resident_bytes == 0
+
+    generation = cache.generation
+    cache.clear()
+    cache.put("a", b"aaaa", (4, 1), generation)
+    assert cache.get("a", (4, 1)) is None
@@ -0,0 +1,86 @@
+import sqlite3
+from pathlib import Path
+
+import pytest
+
+from plugin import db_pool
+from plugin.db_pool import ConnectionPool
+
+
+def create_db(path: Path):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE entries (expression text)")
+    conn.execute("INSERT INTO entries VALUES ('読む')")
+    conn.commit()
+    conn.close()
+
+
+def is_closed(conn: sqlite3.Connection) -> bool:
+    try:
+        conn.execute("SELECT 1")
+    except sqlite3.ProgrammingError:
+        return True
+    return False
+
+
+def test_checkout_checkin(tmp_path: Path):
+    create_db(tmp_path / "entries.db")
+    pool = ConnectionPool(tmp_path / "entries.db", max_idle=1)
+
+    with pool.connection() as first:
+        assert first.execute("SELECT expression FROM entries").fetchall() == [("読む",)]
+        # a connection is only used by one request at a time
+        with pool.connection() as second:
+            assert second is not first
+    # returned connections are reused, up to max_idle of them
+    assert is_closed(first)
+    with pool.connection() as conn:
+        assert conn is second
+    assert not is_closed(second)
+
+    pool.close()
+    assert is_closed(second)
+
+
+def test_invalidate(tmp_path: Path):
+    create_db(tmp_path / "entries.db")
+    pool = ConnectionPool(tmp_path / "entries.db")
+
+    with pool.connection() as in_use:
+        with pool.connection() as idle:
+            pass
+        # i.e. notify_db_changed() while a request is being handled
+        pool.invalidate()
+        assert is_closed(idle)
+        assert not is_closed(in_use)
+    # opened against the old file, so it isn't put back
+    assert is_closed(in_use)
+
+    with pool.connection() as conn:
+        assert conn is not in_use
+        assert conn.execute("SELECT count(*) FROM entries").fetchone() == (1,)
+    pool.close()
+
+
+@pytest.mark.parametrize("immutable", [False, True])
+def test_read_only(tmp_path: Path, monkeypatch, immutable: bool):
+    create_db(tmp_path / "entries.db")
+    uris = []
+    connect = sqlite3.connect
+
+    def record_connect(database, **kwargs):
+        uris.append(database)
+        return connect(database, **kwargs)
+
+    monkeypatch.setattr(db_pool.sqlite3, "connect", record_connect)
+    pool = ConnectionPool(tmp_path / "entries.db", immutable=immutable, mmap_size=1024 * 1024, cache_size=1024 * 1024)
+    with pool.connection() as conn:
+        with pytest.raises(sqlite3.OperationalError):
+            conn.execute("INSERT INTO entries VALUES ('書く')")
+        assert conn.execute("PRAGMA cache_size").fetchone() == (-1024,)
+    pool.close()
+
+    (uri,) = uris
+    assert uri.startswith((tmp_path / "entries.db").as_uri() + "?")
+    assert "mode=ro" in uri
+    assert ("immutable=1" in uri) == immutable
@@ -1,4 +1,37 @@
-from plugin.db_utils import update_check
+import random
+import sqlite3
+from pathlib import Path
+
+import pytest
+
+from plugin import db_utils
+from plugin.config import ALL_SOURCES
+from plugin.db_utils import (
+    init_db,
+    update_db,
+    replace_db_file,
+    REPLACE_DB_RETRIES,
+    update_check,
+    execute_query,
+    execute_batch_query,
+    materialize_responses,
+    has_materialized_responses,
+    get_materialized_response,
+    is_default_lookup,
+    find_android_audio,
+    read_android_audio,
+    ANDROID_BLOB_CHUNK_SIZE,
+    write_entries,
+    create_schema,
+    move_staged_entries,
+    write_android_entries_table,
+    create_staging_schema,
+    merge_staging_db,
+    backfill_jmdict_forms,
+)
+from plugin.jp_util import is_hiragana
+from plugin.lookup import build_audio_sources, encode_audio_source_list
+from plugin.util import QueryComponents, get_db_file
 
 
 def test_answer():
@@ -7,3 +40,348 @@ def test_answer():
     assert update_check((1,2,3), (1,2,5), [(1,2,4)]) == True
     assert update_check((1,2,3), (1,2,5), [(1,2,5)]) == True
     assert update_check((1,2,3), (1,2,5), [(1,2,6)]) == True
+
+
+def create_test_db() -> sqlite3.Connection:
+    conn = sqlite3.connect(":memory:")
+    create_schema(conn)
+    write_entries(
+        conn,
+        [
+            ("読む", "よむ", "nhk16", None, None, "a.aac"),
+            ("読む", None, "jpod", None, None, "b.mp3"),
+            ("読む", "よむ", "forvo", "akitomo", "akitomo", "c.mp3"),
+            ("読む", "よむ", "forvo", "skent", "skent", "d.mp3"),
+            ("読む", "とく", "shinmeikai8", None, "とく", "e.ogg"),
+            ("読む", "よむ", "forvo", "strawberrybrown", "strawberrybrown", "f.mp3"),
+            ("書く", "かく", "nhk16", None, None, "g.aac"),
+        ],
+    )
+    move_staged_entries(conn)
+    return conn
+
+
+def test_write_entries():
+    conn = create_test_db()
+
+    def rows():
+        yield ("見る", "みる", "jpod", None, None, "みる - 見る.mp3")
+        yield ("見る", None, "forvo", "skent", "skent", "skent/見る.mp3")
+        yield ("見る", None, "forvo", "new_speaker", "new_speaker", "new_speaker/見る.mp3")
+
+    assert write_entries(conn, rows()) == 3
+    move_staged_entries(conn)
+    assert conn.execute("SELECT id, source, speaker, file FROM entries WHERE expression = '見る' ORDER BY id").fetchall() == [
+        (8, "jpod", None, "みる - 見る.mp3"),
+        (9, "forvo", "skent", "skent/見る.mp3"),
+        (10, "forvo", "new_speaker", "new_speaker/見る.mp3"),
+    ]
+    # names are only stored once
+    assert conn.execute("SELECT count(*) FROM sources").fetchone() == (4,)
+    assert conn.execute("SELECT count(*) FROM speakers").fetchone() == (4,)
+    assert write_entries(conn, iter(())) == 0
+
+
+def test_merge_staging_db(tmp_path: Path):
+    rows = [
+        ("見る", "みる", "jpod", None, None, "みる - 見る.mp3"),
+        ("見る", None, "forvo", "skent", "skent", "skent/見る.mp3"),
+        ("見る", None, "forvo", "new_speaker", "new_speaker", "new_speaker/見る.mp3"),
+        ("聞く", None, "new_source", None, None, "聞く.mp3"),
+    ]
+    staging_path = tmp_path / "staging.db"
+    with sqlite3.connect(staging_path) as staging:
+        create_staging_schema(staging)
+        staging.executemany("INSERT INTO entries VALUES (?,?,?,?,?,?)", rows)
+        staging.execute("INSERT INTO fingerprints VALUES ('new_source', 'abc', '[]', '[]')")
+    staging.close()
+
+    written = create_test_db()
+    write_entries(written, rows)
+    move_staged_entries(written)
+
+    merged = create_test_db()
+    merge_staging_db(merged, staging_path)
+    move_staged_entries(merged)
+
+    for table in ("audio_entries", "sources", "speakers"):
+        sql = f"SELECT * FROM {table}"
+        assert merged.execute(sql).fetchall() == written.execute(sql).fetchall()
+    assert merged.execute("SELECT * FROM fingerprints").fetchall() == [("new_source", "abc", "[]", "[]")]
+
+
+def test_write_android_entries_table():
+    conn = create_test_db()
+    expected = conn.execute("SELECT * FROM entries ORDER BY id").fetchall()
+    write_android_entries_table(conn.cursor())
+    assert conn.execute("SELECT type FROM sqlite_master WHERE name = 'entries'").fetchone() == ("table",)
+    assert conn.execute("SELECT * FROM entries ORDER BY id").fetchall() == expected
+
+
+def test_execute_batch_query():
+    conn = create_test_db()
+    all_sources = tuple(ALL_SOURCES.keys())
+    qcomps_list = [
+        QueryComponents("読む", "よむ", all_sources, ()),
+        QueryComponents("読む", None, all_sources, ()),
+        QueryComponents("読む", "よむ", tuple(reversed(all_sources)), ()),
+        QueryComponents("読む", "よむ", ("forvo", "jpod"), ("skent", "akitomo")),
+        QueryComponents("読む", None, ("forvo", "forvo"), ("akitomo",)),
+        QueryComponents("書く", "かく", ("forvo",), ()),
+        QueryComponents("ない", None, all_sources, ()),
+        QueryComponents("書く", "かく", all_sources, ()),
+    ]
+
+    expected = [execute_query(conn, qcomps) for qcomps in qcomps_list]
+    assert execute_batch_query(conn, qcomps_list) == expected
+    assert execute_batch_query(conn, []) == []
+
+
+def test_execute_batch_query_ends_transaction(tmp_path: Path):
+    db_path = tmp_path / "entries.db"
+    source = create_test_db()
+    source.commit()
+    with sqlite3.connect(db_path) as dest:
+        source.backup(dest)
+    dest.close()
+
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    qcomps = QueryComponents("読む", None, tuple(ALL_SOURCES.keys()), ())
+    assert execute_batch_query(conn, [qcomps])[0]
+    # i.e. the connection doesn't keep a read lock while it's idle in the pool
+    assert not conn.in_transaction
+    writer = sqlite3.connect(db_path, timeout=0)
+    writer.execute("BEGIN EXCLUSIVE")
+    writer.rollback()
+    writer.close()
+    # the temporary tables are still dropped
+    assert execute_batch_query(conn, [qcomps])[0]
+    conn.close()
+
+
+def test_materialized_responses():
+    conn = create_test_db()
+    assert not has_materialized_responses(conn)
+    materialize_responses(conn)
+    assert has_materialized_responses(conn)
+
+    all_sources = tuple(ALL_SOURCES.keys())
+    for qcomps in [
+        QueryComponents("読む", "よむ", all_sources, ()),
+        QueryComponents("読む", "とく", all_sources, ()),
+        QueryComponents("読む", None, all_sources, ()),
+        QueryComponents("書く", "かく", all_sources, ()),
+    ]:
+        expected = encode_audio_source_list(build_audio_sources(execute_query(conn, qcomps)))
+        assert get_materialized_response(conn, qcomps) == expected
+
+    # readings that aren't in the table, and non-default lookups, are built by the server instead
+    assert get_materialized_response(conn, QueryComponents("読む", "どく", all_sources, ())) is None
+    assert not is_default_lookup(QueryComponents("読む", "よむ", ("forvo",), ()))
+    assert not is_default_lookup(QueryComponents("読む", "よむ", all_sources, ("akitomo",)))
+    assert not is_default_lookup(QueryComponents("読む", "", all_sources, ()))
+
+
+def test_read_android_audio():
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE android (id integer PRIMARY KEY NOT NULL, file text NOT NULL, source text NOT NULL, data blob NOT NULL)")
+    data = bytes(range(256)) * (ANDROID_BLOB_CHUNK_SIZE // 100)
+    conn.execute("INSERT INTO android (file, source, data) VALUES (?, ?, ?)", ("a.mp3", "nhk16", data))
+
+    assert find_android_audio(conn, "jpod", "a.mp3") is None
+    rowid, size = find_android_audio(conn, "nhk16", "a.mp3")
+    assert size == len(data)
+
+    class NoBlobConnection:
+        # Python < 3.11, which reads every chunk with substr() instead
+        def __init__(self, conn):
+            self.execute = conn.execute
+
+    for connection in (conn, NoBlobConnection(conn)):
+        chunks = list(read_android_audio(connection, rowid, 0, size))
+        assert all(len(chunk) <= ANDROID_BLOB_CHUNK_SIZE for chunk in chunks)
+        assert b"".join(chunks) == data
+        # range requests, including one past the end of the blob
+        assert b"".join(read_android_audio(connection, rowid, 1000, 70000)) == data[1000:71000]
+        assert b"".join(read_android_audio(connection, rowid, size - 10, 100)) == data[-10:]
+        assert list(read_android_audio(connection, rowid, 0, 0)) == []
+
+
+def backfill_jmdict_forms_reference(conn: sqlite3.Connection, groups, sources=()) -> list[tuple]:
+    """
+    the previous backfill, which searched the rows of each form of a group one at a time
+    """
+    search_query = "SELECT * FROM entries WHERE expression = ? AND reading = ?"
+    if sources:
+        search_query += f" AND source IN ({','.join(['?'] * len(sources))})"
+    search_query += " ORDER BY id"
+
+    new_rows = []
+    new_rows_set = set()
+    for group in groups:
+        forms = [(expression["kanji"], expression.get("reading", group["reading"])) for expression in group["expressions"]]
+        found = [set() for _ in forms]
+        all_rows = []
+        for form in forms:
+            if not is_hiragana(form[0]):
+                all_rows.extend(conn.execute(search_query, form + tuple(sources)).fetchall())
+
+        for row in all_rows:
+            for form, found_slices in zip(forms, found):
+                if form == row[1:3]:
+                    found_slices.add(row[3:])
+
+        for row in all_rows:
+            for form, found_slices in zip(forms, found):
+                if row[3:] not in found_slices:
+                    found_slices.add(row[3:])
+                    new_row = form + row[3:]
+                    if new_row not in new_rows_set:
+                        new_rows.append(new_row)
+                        new_rows_set.add(new_row)
+    return new_rows
+
+
+def test_backfill_jmdict_forms():
+    rng = random.Random(0)
+    expressions = ["六", "陸", "碌", "ろく", "ロク", "読む", "よむ", "詠む"]
+    readings = ["ろく", "よむ", "りく"]
+    sources = ["nhk16", "jpod", "forvo", "shinmeikai8"]
+    speakers = [None, "akitomo", "skent"]
+
+    for _ in range(50):
+        conn = sqlite3.connect(":memory:")
+        create_schema(conn)
+        write_entries(
+            conn,
+            [
+                (
+                    rng.choice(expressions),
+                    rng.choice(readings + [None]),
+                    rng.choice(sources),
+                    rng.choice(speakers),
+                    rng.choice([None, "display"]),
+                    f"{rng.randrange(8)}.mp3",
+                )
+                for _ in range(rng.randrange(40))
+            ],
+        )
+        move_staged_entries(conn)
+
+        groups = []
+        for _ in range(rng.randrange(1, 8)):
+            group = {"reading": rng.choice(readings), "expressions": []}
+            for _ in range(rng.randrange(1, 5)):
+                expression = {"kanji": rng.choice(expressions)}
+                if rng.random() < 0.2:
+                    expression["reading"] = rng.choice(readings)
+                group["expressions"].append(expression)
+            groups.append(group)
+        filter_sources = tuple(rng.sample(sources, rng.randrange(3)))
+
+        expected = backfill_jmdict_forms_reference(conn, groups, filter_sources)
+        (last_id,) = conn.execute("SELECT coalesce(max(id), 0) FROM entries").fetchone()
+        assert backfill_jmdict_forms(conn, iter(groups), filter_sources) == len(expected)
+        move_staged_entries(conn)
+        added = conn.execute(
+            "SELECT expression, reading, source, speaker, display, file FROM entries WHERE id > ? ORDER BY id",
+            (last_id,),
+        ).fetchall()
+        assert added == expected
+
+
+@pytest.fixture
+def db_file(tmp_path: Path, monkeypatch) -> Path:
+    """
+    an existing entries.db
+    """
+    monkeypatch.setenv("XDG_DATA_HOME", str(tmp_path))
+    db_file = get_db_file()
+    db_file.parent.mkdir(parents=True)
+    with sqlite3.connect(db_file) as conn:
+        create_schema(conn)
+        write_entries(conn, [("読む", "よむ", "nhk16", None, None, "a.aac")])
+        move_staged_entries(conn)
+    conn.close()
+    return db_file
+
+
+@pytest.fixture
+def notified(monkeypatch) -> list[bool]:
+    """
+    records every notify_db_changed() call
+    """
+    notified = []
+    monkeypatch.setattr(db_utils, "notify_db_changed", lambda: notified.append(True))
+    return notified
+
+
+def fail_partway(connection: sqlite3.Connection, *args, **kwargs):
+    connection.execute("CREATE TABLE partial (x)")
+    connection.commit()
+    raise RuntimeError("build failed")
+
+
+@pytest.mark.parametrize("failing_step", ["build", "replace"])
+def test_init_db_failure(db_file: Path, notified: list[bool], monkeypatch, failing_step: str):
+    original = db_file.read_bytes()
+    if failing_step == "build":
+        monkeypatch.setattr(db_utils, "build_db", fail_partway)
+        error = RuntimeError
+    else:
+        monkeypatch.setattr(db_utils, "build_db", lambda connection, *args: create_schema(connection))
+
+        def failing_replace(src, dst):
+            raise OSError("No space left on device")
+
+        monkeypatch.setattr(db_utils.os, "replace", failing_replace)
+        error = OSError
+
+    with pytest.raises(error):
+        init_db()
+    assert db_file.read_bytes() == original
+    assert not db_file.with_name(db_file.name + db_utils.TEMP_DB_SUFFIX).exists()
+    # the server keeps using the old database
+    assert notified == []
+
+
+def test_update_db_failure(db_file: Path, notified: list[bool], monkeypatch):
+    original = db_file.read_bytes()
+    monkeypatch.setattr(db_utils, "update_sources", fail_partway)
+    with pytest.raises(RuntimeError):
+        update_db(["nhk16"])
+    assert db_file.read_bytes() == original
+    assert not db_file.with_name(db_file.name + db_utils.TEMP_DB_SUFFIX).exists()
+    assert notified == []
+
+
+@pytest.mark.parametrize("failures", [2, REPLACE_DB_RETRIES])
+def test_replace_db_file_retries(db_file: Path, notified: list[bool], monkeypatch, failures: int):
+    """
+    i.e. on Windows, while the server still has the file open
+    """
+    src = db_file.with_name("new.db")
+    src.write_bytes(b"new")
+    original = db_file.read_bytes()
+    replace = db_utils.os.replace
+    attempts = []
+
+    def locked_replace(*args):
+        attempts.append(args)
+        if len(attempts) <= failures:
+            raise PermissionError("file is in use")
+        replace(*args)
+
+    monkeypatch.setattr(db_utils.os, "replace", locked_replace)
+    monkeypatch.setattr(db_utils, "REPLACE_DB_RETRY_DELAY", 0)
+    if failures < REPLACE_DB_RETRIES:
+        replace_db_file(src, db_file)
+        assert db_file.read_bytes() == b"new"
+        assert len(attempts) == failures + 1
+    else:
+        with pytest.raises(PermissionError):
+            replace_db_file(src, db_file)
+        assert db_file.read_bytes() == original
+        assert len(attempts) == REPLACE_DB_RETRIES
+    # the server's idle connections are closed before every retry
+    assert len(notified) == min(failures, REPLACE_DB_RETRIES - 1)
@@ -0,0 +1,69 @@
+import os
+from pathlib import Path
+
+from plugin import fingerprint
+from plugin.fingerprint import fingerprint_matches, take_fingerprint
+from plugin.source.audio_source import AudioSourceData
+from plugin.source.forvo import ForvoAudioSource
+from plugin.source.nhk16 import NHK16AudioSource
+
+
+def test_fingerprint_media_dir(tmp_path: Path):
+    media_dir = tmp_path / "forvo_files"
+    (media_dir / "akitomo").mkdir(parents=True)
+    (media_dir / "akitomo" / "読む.mp3").write_bytes(b"")
+    # the media dir is absolute, so it doesn't depend on the data dir
+    source = ForvoAudioSource(AudioSourceData("forvo", str(media_dir), "Forvo ({})"))
+
+    fingerprint = take_fingerprint(source)
+    assert fingerprint.directories == ["", "akitomo"]
+    assert fingerprint_matches(source, *fingerprint)
+
+    # replacing a file doesn't change its entries
+    (media_dir / "akitomo" / "読む.mp3").write_bytes(b"audio")
+    assert fingerprint_matches(source, *fingerprint)
+
+    (media_dir / "akitomo" / "書く.mp3").write_bytes(b"")
+    os.utime(media_dir / "akitomo", ns=(0, 0))
+    assert not fingerprint_matches(source, *fingerprint)
+
+    fingerprint = take_fingerprint(source)
+    (media_dir / "skent").mkdir()
+    os.utime(media_dir, ns=(0, 0))
+    assert not fingerprint_matches(source, *fingerprint)
+
+
+def test_fingerprint_input_files(tmp_path: Path):
+    media_dir = tmp_path / "nhk16_files"
+    media_dir.mkdir()
+    (media_dir / "entries.json").write_text("[]")
+    source = NHK16AudioSource(AudioSourceData("nhk16", str(media_dir), "NHK16 {}"))
+
+    fingerprint = take_fingerprint(source)
+    (media_dir / "entries.json").write_text("[] ")
+    assert not fingerprint_matches(source, *fingerprint)
+
+    fingerprint = take_fingerprint(source)
+    (media_dir / "source_meta.json").write_text('{"type": "nhk16"}')
+    assert not fingerprint_matches(source, *fingerprint)
+
+
+def test_fingerprint_reuses_hashes(tmp_path: Path, monkeypatch):
+    media_dir = tmp_path / "nhk16_files"
+    media_dir.mkdir()
+    (media_dir / "entries.json").write_text("[]")
+    source = NHK16AudioSource(AudioSourceData("nhk16", str(media_dir), "NHK16 {}"))
+    stored = take_fingerprint(source)
+
+    hashed = []
+    hash_file = fingerprint.hash_file
+    monkeypatch.setattr(fingerprint, "hash_file", lambda path: hashed.append(path.name) or hash_file(path))
+
+    # the size and modification time are the same, so the file isn't read again
+    assert fingerprint_matches(source, *stored)
+    assert hashed == []
+
+    # same contents, but touched: hashed again, and still the same fingerprint
+    os.utime(media_dir / "entries.json", ns=(0, 0))
+    assert fingerprint_matches(source, *stored)
+    assert hashed == ["entries.json"]
@@ -0,0 +1,51 @@
+import pytest
+
+from plugin.http_util import (
+    make_etag,
+    make_last_modified,
+    is_not_modified,
+    if_range_matches,
+    parse_range_header,
+)
+
+
+def test_parse_range_header():
+    assert parse_range_header("bytes=0-99", 1000) == (0, 99)
+    assert parse_range_header("bytes=500-", 1000) == (500, 999)
+    assert parse_range_header("bytes=-100", 1000) == (900, 999)
+    assert parse_range_header("bytes=-5000", 1000) == (0, 999)
+    assert parse_range_header("bytes=900-5000", 1000) == (900, 999)
+
+    # ignored: the entire file is sent instead
+    assert parse_range_header("bytes=0-1,5-6", 1000) is None
+    assert parse_range_header("items=0-1", 1000) is None
+    assert parse_range_header("bytes=5-1", 1000) is None
+    assert parse_range_header("bytes=a-b", 1000) is None
+    assert parse_range_header("bytes=²-", 1000) is None
+    assert parse_range_header("bytes=0-٣", 1000) is None
+    assert parse_range_header("bytes=-١٠", 1000) is None
+
+    with pytest.raises(ValueError):
+        parse_range_header("bytes=1000-", 1000)
+    with pytest.raises(ValueError):
+        parse_range_header("bytes=-0", 1000)
+
+
+def test_conditional_requests():
+    mtime_ns = 1_700_000_000_123_456_789
+    etag = make_etag(1000, mtime_ns)
+    last_modified = make_last_modified(mtime_ns)
+
+    assert is_not_modified({"If-None-Match": etag}, etag, mtime_ns)
+    assert is_not_modified({"If-None-Match": f'"abc", W/{etag}'}, etag, mtime_ns)
+    assert not is_not_modified({"If-None-Match": '"abc"'}, etag, mtime_ns)
+    assert is_not_modified({"If-Modified-Since": last_modified}, etag, mtime_ns)
+    assert not is_not_modified({"If-Modified-Since": "Thu, 01 Jan 1970 00:00:00 GMT"}, etag, mtime_ns)
+    # If-None-Match takes precedence
+    assert not is_not_modified({"If-None-Match": '"abc"', "If-Modified-Since": last_modified}, etag, mtime_ns)
+    assert not is_not_modified({}, etag, mtime_ns)
+
+    assert if_range_matches(None, etag, last_modified)
+    assert if_range_matches(etag, etag, last_modified)
+    assert if_range_matches(last_modified, etag, last_modified)
+    assert not if_range_matches(f"W/{etag}", etag, last_modified)
@@ -0,0 +1,40 @@
+import io
+import json
+
+import pytest
+
+from plugin import json_stream
+from plugin.json_stream import iter_json_items, load_json_value
+
+
+INDEX = {
+    "headwords": {"読む": ["a \"quoted\" [file].mp3", "b\\c.mp3"], "書く": []},
+    "meta": {"media_dir": "media", "version": 1.5e10, "nested": [[{}], [], {"}": "{"}]},
+    "files": {"a.mp3": {"kana_reading": "よむ", "pitch_number": "1"}, "b.mp3": None},
+    "entries": [0, -12.5e-3, True, False, None, "", "あ\n", [1, [2]], {"k": "v"}],
+}
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64 * 1024])
+def test_iter_json_items(monkeypatch, chunk_size: int):
+    monkeypatch.setattr(json_stream, "READ_CHUNK_SIZE", chunk_size)
+    for text in (json.dumps(INDEX), json.dumps(INDEX, ensure_ascii=False, indent=2)):
+        assert list(iter_json_items(io.StringIO(text), ["entries"])) == INDEX["entries"]
+        assert list(iter_json_items(io.StringIO(text), ["files"])) == list(INDEX["files"].items())
+        assert list(iter_json_items(io.StringIO(text), ["missing"])) == []
+        assert load_json_value(io.StringIO(text), ["meta"]) == INDEX["meta"]
+        assert load_json_value(io.StringIO(text), ["meta", "version"]) == 1.5e10
+        assert load_json_value(io.StringIO(text), ["missing"], {}) == {}
+
+    entries = INDEX["entries"]
+    assert list(iter_json_items(io.StringIO(json.dumps(entries)))) == entries
+    assert list(iter_json_items(io.StringIO(" [ ] "))) == []
+
+
+def test_iter_json_items_invalid():
+    with pytest.raises(json.JSONDecodeError):
+        list(iter_json_items(io.StringIO('[1, 2')))
+    with pytest.raises(json.JSONDecodeError):
+        list(iter_json_items(io.StringIO('[1 2]')))
+    with pytest.raises(json.JSONDecodeError):
+        list(iter_json_items(io.StringIO('{"a": [1, "]"'), ["b"]))
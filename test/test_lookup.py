@@ -0,0 +1,34 @@
+import pytest
+
+from plugin.config import ALL_SOURCES
+from plugin.lookup import parse_batch_request, parse_prefetch_request, parse_prefetch_cancel_request
+from plugin.util import QueryComponents
+
+
+def test_parse_batch_request():
+    body = '[{"term": "読む", "reading": "よむ"}, {"expression": "書く", "sources": "forvo,jpod", "user": ["akitomo "]}]'
+    assert parse_batch_request(body.encode("utf-8"), 2) == [
+        QueryComponents("読む", "よむ", tuple(ALL_SOURCES.keys()), ()),
+        QueryComponents("書く", None, ("forvo", "jpod"), ("akitomo",)),
+    ]
+
+    for invalid in [b"{", b'{"term": "a"}', b"[1]", b'[{"reading": "a"}]', b'[{"term": "a", "sources": 1}]']:
+        with pytest.raises(ValueError):
+            parse_batch_request(invalid, 2)
+    with pytest.raises(ValueError):
+        parse_batch_request(b'[{"term": "a"}, {"term": "b"}, {"term": "c"}]', 2)
+
+
+def test_parse_prefetch_request():
+    qcomps_list, audio, replace = parse_prefetch_request(b'{"items": [{"term": "a"}], "audio": true}', 1)
+    assert qcomps_list == [QueryComponents("a", None, tuple(ALL_SOURCES.keys()), ())]
+    assert (audio, replace) == (True, False)
+
+    with pytest.raises(ValueError):
+        parse_prefetch_request(b'[{"term": "a"}]', 1)
+
+    assert parse_prefetch_cancel_request(b"") is None
+    assert parse_prefetch_cancel_request(b"{}") is None
+    assert parse_prefetch_cancel_request(b'{"id": 3}') == 3
+    with pytest.raises(ValueError):
+        parse_prefetch_cancel_request(b'{"id": true}')
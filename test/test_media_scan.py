@@ -0,0 +1,30 @@
+import os
+from pathlib import Path
+
+from plugin.media_scan import AUDIO_FILE_EXTENSIONS, scan_media_files
+
+
+def test_scan_media_files(tmp_path: Path):
+    media_dir = tmp_path / "forvo_files"
+    for user in ["akitomo", "skent", "poyotan"]:
+        (media_dir / user / "nested").mkdir(parents=True)
+        for word in ["読む", "書く", "a.b"]:
+            (media_dir / user / f"{word}.mp3").write_bytes(b"")
+        (media_dir / user / "nested" / "見る.OGG").write_bytes(b"")
+    (media_dir / "top.opus").write_bytes(b"")
+    (media_dir / "notes.txt").write_text("not audio")
+    (media_dir / ".mp3").write_bytes(b"")
+    os.symlink(media_dir / "skent", media_dir / "linked_dir")
+    os.symlink(media_dir / "top.opus", media_dir / "linked.opus")
+
+    # what AudioSource.find_media_files() used to return
+    expected = [
+        (str(path.relative_to(media_dir)), path.stem, path.parent.name)
+        for path in media_dir.rglob("*")
+        if path.is_file() and path.suffix.lower() in AUDIO_FILE_EXTENSIONS
+    ]
+    assert len(expected) == 3 * 4 + 2
+    for workers in (1, 4):
+        assert list(scan_media_files(media_dir, workers=workers)) == expected
+
+    assert list(scan_media_files(tmp_path / "missing")) == []
@@ -0,0 +1,67 @@
+import json
+import threading
+
+from plugin.metrics import Metrics, RequestTrace, format_json, format_prometheus, get_request_id
+
+
+def test_request_metrics():
+    metrics = Metrics()
+
+    def record():
+        trace = RequestTrace()
+        trace.route = "audio"
+        trace.source = "nhk16"
+        trace.stages["open"] = 0.0003
+        metrics.observe_request(trace, 200)
+
+    # recorded by a thread that has exited (i.e. a finished connection), and by this one
+    thread = threading.Thread(target=record)
+    thread.start()
+    thread.join()
+    record()
+
+    text = format_prometheus(metrics, {"local_audio_lookup_cache_size": 3}).decode("utf-8")
+    assert 'local_audio_requests_total{route="audio",source="nhk16",status="200"} 2' in text
+    assert 'local_audio_stage_duration_seconds_bucket{route="audio",source="nhk16",stage="open",le="0.00025"} 0' in text
+    assert 'local_audio_stage_duration_seconds_bucket{route="audio",source="nhk16",stage="open",le="0.0005"} 2' in text
+    assert 'local_audio_stage_duration_seconds_bucket{route="audio",source="nhk16",stage="open",le="+Inf"} 2' in text
+    assert 'local_audio_request_duration_seconds_count{route="audio",source="nhk16"} 2' in text
+    assert "local_audio_lookup_cache_size 3" in text
+
+    # collecting again must not count the exited thread twice
+    data = json.loads(format_json(metrics, {}))
+    (stage,) = data["histograms"]["local_audio_stage_duration_seconds"]
+    assert stage["labels"] == {"route": "audio", "source": "nhk16", "stage": "open"}
+    assert stage["count"] == 2
+    assert stage["buckets"]["0.0005"] == 2
+
+
+
+def test_exited_thread_shards_are_retired():
+    metrics = Metrics()
+
+    def record():
+        metrics.increment("local_audio_requests_total", ())
+
+    # one thread per connection, and /metrics is never read
+    for _ in range(200):
+        thread = threading.Thread(target=record)
+        thread.start()
+        thread.join()
+        assert len(metrics._shards) <= 2
+
+    histograms, counters = metrics.collect()
+    assert counters[("local_audio_requests_total", ())] == [200]
+
+
+def test_server_timing():
+    trace = RequestTrace()
+    trace.stages.update({"parse": 0.0001, "db": 0.002, "serialize": 0.0005, "write": 0.001})
+    trace.cache = "miss"
+    timing = trace.server_timing()
+    assert timing.startswith("parse;dur=0.100, db;dur=2.000, serialize;dur=0.500, cache;desc=miss, total;dur=")
+    # the body is written after the headers, so its time can't be part of them
+    assert "write" not in timing
+
+    assert get_request_id("abc-123") == "abc-123"
+    assert get_request_id("not an id") != get_request_id(None)
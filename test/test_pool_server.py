@@ -0,0 +1,106 @@
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from plugin import server
+from plugin.pool_server import (
+    REJECT_TIMEOUT,
+    ConnectionRejecter,
+    PooledLocalAudioServer,
+    RequestLimits,
+    SERVICE_UNAVAILABLE_RESPONSE,
+)
+
+
+def test_request_limits():
+    limits = RequestLimits(max_lookups=2, max_audio=1)
+
+    assert limits.acquire("audio")
+    # over the limit, but lookups have their own
+    assert not limits.acquire("audio")
+    assert limits.acquire("lookup")
+    assert limits.acquire("batch")
+    assert not limits.acquire("lookup")
+    # never limited
+    assert limits.acquire("version")
+    assert limits.acquire("metrics")
+
+    limits.release("audio")
+    assert limits.acquire("audio")
+    limits.release("batch")
+    assert limits.acquire("lookup")
+
+
+def test_connection_rejecter():
+    closed = []
+
+    def close_request(request: socket.socket):
+        closed.append(request)
+        request.close()
+
+    rejecter = ConnectionRejecter(close_request)
+    try:
+        # clients that haven't sent their request yet don't hold up the caller (the thread accepting connections)
+        clients = []
+        start = time.perf_counter()
+        for _ in range(20):
+            server_side, client = socket.socketpair()
+            clients.append(client)
+            rejecter.reject(server_side)
+        assert time.perf_counter() - start < REJECT_TIMEOUT
+
+        for client in clients:
+            client.settimeout(5)
+            assert client.recv(4096) == SERVICE_UNAVAILABLE_RESPONSE
+
+        # the connection is closed once the request has been read
+        clients[0].sendall(b"GET / HTTP/1.1\r\n\r\n")
+        assert clients[0].recv(4096) == b""
+        # or after REJECT_TIMEOUT if it never arrives
+        assert clients[1].recv(4096) == b""
+    finally:
+        rejecter.close()
+        for client in clients:
+            client.close()
+    assert len(closed) == 20
+
+
+def test_connection_rejecter_high_fd():
+    """
+    select.select() can't wait on file descriptors above 1024
+    """
+    server_side, client = socket.socketpair()
+    try:
+        high_fd = os.dup2(server_side.fileno(), 2000)
+    except OSError: # i.e. a lower limit on open files
+        pytest.skip("can't open file descriptors above 1024")
+    finally:
+        server_side.close()
+    rejecter = ConnectionRejecter(lambda request: request.close())
+    try:
+        start = time.perf_counter()
+        rejecter.reject(socket.socket(fileno=high_fd))
+        client.settimeout(5)
+        assert client.recv(4096) == SERVICE_UNAVAILABLE_RESPONSE
+        # kept open while waiting for the request, instead of being closed right away
+        assert client.recv(4096) == b""
+        assert time.perf_counter() - start >= REJECT_TIMEOUT
+    finally:
+        rejecter.close()
+        client.close()
+
+
+def test_failed_state_doesnt_leak_threads(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_DATA_HOME", str(tmp_path))
+
+    def failing_state():
+        raise OSError("unable to open database file")
+
+    monkeypatch.setattr(server, "ServerState", failing_state)
+    threads = set(threading.enumerate())
+    with pytest.raises(OSError):
+        PooledLocalAudioServer(("127.0.0.1", 0))
+    assert set(threading.enumerate()) <= threads
@@ -0,0 +1,326 @@
+import http.client
+import json
+import random
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from http import HTTPStatus
+from pathlib import Path
+from typing import Iterator
+from urllib.parse import quote
+
+import pytest
+
+from plugin.async_server import AsyncLocalAudioServer
+from plugin.config import ALL_SOURCES, SERVER_CONFIG
+from plugin.db_utils import create_schema, write_entries, move_staged_entries
+from plugin.http_util import make_etag
+from plugin.pool_server import PooledLocalAudioServer
+from plugin.server import LocalAudioHandler, LocalAudioServer, ServerState, handle_post_request
+from plugin.util import QueryComponents, get_data_dir, get_db_file
+
+ENTRIES = [
+    ("読む", "よむ", "jpod", None, None, "よむ - 読む.mp3"),
+    ("読む", "よむ", "forvo", "skent", "skent", "skent/読む.mp3"),
+    ("書く", "かく", "jpod", None, None, "かく - 書く.mp3"),
+]
+AUDIO_PATH = "/jpod/" + quote("よむ - 読む.mp3")
+AUDIO = bytes(range(256)) * 4
+LOOKUP_PATH = "/?term=" + quote("読む") + "&reading=" + quote("よむ")
+
+ENGINES = [LocalAudioServer, AsyncLocalAudioServer, PooledLocalAudioServer]
+
+
+@pytest.fixture
+def data_dir(tmp_path: Path, monkeypatch) -> Path:
+    """
+    a data directory with a small entries.db
+    """
+    monkeypatch.setenv("XDG_DATA_HOME", str(tmp_path))
+    data_dir = get_data_dir()
+    data_dir.mkdir(parents=True)
+    with sqlite3.connect(get_db_file()) as conn:
+        create_schema(conn)
+        write_entries(conn, ENTRIES)
+        move_staged_entries(conn)
+    conn.close()
+    (data_dir / "jpod_files").mkdir()
+    (data_dir / "jpod_files" / "よむ - 読む.mp3").write_bytes(AUDIO)
+    return data_dir
+
+
+@contextmanager
+def running_server(server_class) -> Iterator[socket.socket]:
+    """
+    runs the server on a free port, and yields a client connection to it
+    """
+    server = server_class(("127.0.0.1", 0))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        with socket.create_connection(server.socket.getsockname(), timeout=5) as client:
+            yield client
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def request(
+    client: socket.socket, method: str, path: str, headers: dict[str, str] = {}, body: bytes = b""
+) -> tuple[http.client.HTTPResponse, bytes]:
+    """
+    sends a request on the (possibly already used) connection, and reads the whole response
+    """
+    lines = [f"{method} {path} HTTP/1.1", "Host: localhost"]
+    lines += [f"{keyword}: {value}" for keyword, value in headers.items()]
+    if body:
+        lines.append(f"Content-Length: {len(body)}")
+    client.sendall(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+    response = http.client.HTTPResponse(client, method=method)
+    response.begin()
+    # only reads up to Content-Length (without it, this would wait for the connection to close)
+    return response, response.read()
+
+
+def is_closed(client: socket.socket) -> bool:
+    try:
+        return client.recv(1) == b""
+    except ConnectionResetError:
+        return True
+
+
+@pytest.fixture
+def max_keepalive_requests(monkeypatch) -> int:
+    monkeypatch.setattr(LocalAudioHandler, "max_keepalive_requests", 3)
+    # read by the asyncio engine's handlers when they are created
+    monkeypatch.setitem(SERVER_CONFIG, "keepalive_max_requests", 3)
+    return 3
+
+
+@pytest.mark.parametrize("server_class", ENGINES)
+def test_keepalive(data_dir: Path, server_class):
+    with running_server(server_class) as client:
+        batch = json.dumps([{"term": "読む", "reading": "よむ"}]).encode("utf-8")
+        requests = [("GET", LOOKUP_PATH, b""), ("GET", AUDIO_PATH, b""), ("GET", "/", b""), ("POST", "/batch", batch)]
+        for method, path, body in requests:
+            response, response_body = request(client, method, path, body=body)
+            assert response.status == HTTPStatus.OK
+            assert int(response.getheader("Content-Length")) == len(response_body)
+            assert response.getheader("Connection") is None
+
+
+def test_engines_match(data_dir: Path):
+    """
+    every engine sends the same responses (apart from the Server and Date headers)
+    """
+    audio_stat = (data_dir / "jpod_files" / "よむ - 読む.mp3").stat()
+    requests = [
+        ("GET", LOOKUP_PATH, {}, b""),
+        ("HEAD", LOOKUP_PATH, {}, b""),
+        ("GET", "/?term=" + quote("読む") + "&sources=forvo,jpod&user=skent", {}, b""),
+        ("GET", "/?term=" + quote("ない"), {}, b""),
+        ("POST", "/batch", {}, json.dumps([{"term": "読む"}, {"term": "書く", "reading": "かく"}]).encode("utf-8")),
+        ("POST", "/unknown", {}, b"[]"),
+        ("GET", "/", {}, b""),
+        ("GET", AUDIO_PATH, {}, b""),
+        ("GET", AUDIO_PATH, {"Range": "bytes=-10"}, b""),
+        ("GET", AUDIO_PATH, {"If-None-Match": make_etag(audio_stat.st_size, audio_stat.st_mtime_ns)}, b""),
+    ]
+    compared_headers = [
+        "Content-Type", "Content-Length", "Content-Range", "Accept-Ranges", "ETag", "Last-Modified",
+        "Access-Control-Allow-Origin", "Connection",
+    ]
+
+    responses = {}
+    for server_class in ENGINES:
+        responses[server_class] = []
+        with running_server(server_class) as client:
+            for method, path, headers, body in requests:
+                response, response_body = request(client, method, path, headers, body)
+                response_headers = {keyword: response.getheader(keyword) for keyword in compared_headers}
+                responses[server_class].append((method, path, response.status, response_headers, response_body))
+
+    expected = responses[LocalAudioServer]
+    assert [status for _, _, status, _, _ in expected] == [200, 200, 200, 200, 200, 404, 200, 200, 206, 304]
+    assert len(json.loads(expected[0][4])["audioSources"]) == 2
+    for server_class in ENGINES:
+        assert responses[server_class] == expected
+
+
+@pytest.mark.parametrize("server_class", ENGINES)
+def test_keepalive_errors(data_dir: Path, server_class):
+    """
+    error responses have a Content-Length, so the connection can be reused after them
+    """
+    errors = [
+        ("GET", "/favicon.ico", {}, b"", HTTPStatus.BAD_REQUEST),
+        ("GET", "/?reading=" + quote("よむ"), {}, b"", HTTPStatus.BAD_REQUEST),
+        ("GET", "/jpod/missing.mp3", {}, b"", HTTPStatus.BAD_REQUEST),
+        ("GET", "/jpod/unknown.txt", {}, b"", HTTPStatus.BAD_REQUEST),
+        ("GET", AUDIO_PATH, {"Range": f"bytes={len(AUDIO)}-"}, b"", HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE),
+        ("POST", "/batch", {}, b"[", HTTPStatus.BAD_REQUEST),
+        ("POST", "/unknown", {}, b"[]", HTTPStatus.NOT_FOUND),
+    ]
+    with running_server(server_class) as client:
+        for method, path, headers, body, status in errors:
+            response, response_body = request(client, method, path, headers, body)
+            assert response.status == status
+            assert int(response.getheader("Content-Length")) == len(response_body)
+            assert response.getheader("Connection") is None
+        assert request(client, "GET", AUDIO_PATH)[1] == AUDIO
+
+
+@pytest.mark.parametrize("server_class", ENGINES)
+@pytest.mark.parametrize(
+    "raw_request, status",
+    [
+        # the body can't be skipped, so the connection can't be reused
+        (b"POST /batch HTTP/1.1\r\nHost: localhost\r\n\r\n", HTTPStatus.LENGTH_REQUIRED),
+        (b"POST /batch HTTP/1.1\r\nHost: localhost\r\nContent-Length: -1\r\n\r\n", HTTPStatus.BAD_REQUEST),
+        (b"POST /batch HTTP/1.1\r\nHost: localhost\r\nContent-Length: 1000000000\r\n\r\n", HTTPStatus.REQUEST_ENTITY_TOO_LARGE),
+        (b"GET / / HTTP/1.1\r\nHost: localhost\r\n\r\n", HTTPStatus.BAD_REQUEST),
+        (b"PUT / HTTP/1.1\r\nHost: localhost\r\n\r\n", HTTPStatus.NOT_IMPLEMENTED),
+    ],
+)
+def test_closing_errors(data_dir: Path, server_class, raw_request: bytes, status: int):
+    with running_server(server_class) as client:
+        client.sendall(raw_request)
+        response = http.client.HTTPResponse(client)
+        response.begin()
+        body = response.read()
+        assert response.status == status
+        assert int(response.getheader("Content-Length")) == len(body)
+        assert response.getheader("Connection") == "close"
+        assert is_closed(client)
+
+
+@pytest.mark.parametrize("server_class", [LocalAudioServer, PooledLocalAudioServer])
+def test_send_file(data_dir: Path, monkeypatch, server_class):
+    # larger than the socket buffers, so it takes several sendfile() calls
+    audio = random.Random(0).randbytes(4 * 1024 * 1024 + 3)
+    (data_dir / "jpod_files" / "large.mp3").write_bytes(audio)
+    sent = []
+    send_file = LocalAudioHandler.send_file
+
+    def record_send_file(self, fh, offset: int, count: int):
+        sent.append((offset, count))
+        send_file(self, fh, offset, count)
+
+    monkeypatch.setattr(LocalAudioHandler, "send_file", record_send_file)
+    with running_server(server_class) as client:
+        response, body = request(client, "GET", "/jpod/large.mp3")
+        assert response.status == HTTPStatus.OK
+        assert body == audio
+
+        start = 1024 * 1024 + 1
+        response, body = request(client, "GET", "/jpod/large.mp3", {"Range": f"bytes={start}-"})
+        assert response.status == HTTPStatus.PARTIAL_CONTENT
+        assert response.getheader("Content-Range") == f"bytes {start}-{len(audio) - 1}/{len(audio)}"
+        assert body == audio[start:]
+
+        response, body = request(client, "GET", "/jpod/large.mp3", {"Range": "bytes=-100"})
+        assert body == audio[-100:]
+    assert sent == [(0, len(audio)), (start, len(audio) - start), (len(audio) - 100, 100)]
+
+
+@pytest.mark.parametrize("server_class", ENGINES)
+def test_conditional_range_requests(data_dir: Path, server_class):
+    with running_server(server_class) as client:
+        response, body = request(client, "GET", AUDIO_PATH)
+        assert response.status == HTTPStatus.OK
+        assert response.getheader("Accept-Ranges") == "bytes"
+        assert body == AUDIO
+        etag = response.getheader("ETag")
+        last_modified = response.getheader("Last-Modified")
+
+        response, body = request(client, "GET", AUDIO_PATH, {"Range": "bytes=10-19"})
+        assert response.status == HTTPStatus.PARTIAL_CONTENT
+        assert response.getheader("Content-Range") == f"bytes 10-19/{len(AUDIO)}"
+        assert body == AUDIO[10:20]
+
+        for headers in ({"If-None-Match": etag}, {"If-Modified-Since": last_modified}):
+            response, body = request(client, "GET", AUDIO_PATH, headers)
+            assert response.status == HTTPStatus.NOT_MODIFIED
+            assert response.getheader("ETag") == etag
+            assert body == b""
+
+        # the range is only used if the file hasn't changed since the client's copy
+        for if_range in (etag, last_modified):
+            response, body = request(client, "GET", AUDIO_PATH, {"Range": "bytes=10-19", "If-Range": if_range})
+            assert response.status == HTTPStatus.PARTIAL_CONTENT
+            assert body == AUDIO[10:20]
+        response, body = request(client, "GET", AUDIO_PATH, {"Range": "bytes=10-19", "If-Range": '"outdated"'})
+        assert response.status == HTTPStatus.OK
+        assert body == AUDIO
+
+        # malformed ranges are ignored
+        response, body = request(client, "GET", AUDIO_PATH, {"Range": "bytes=²-"})
+        assert response.status == HTTPStatus.OK
+        assert body == AUDIO
+
+        response, body = request(client, "HEAD", AUDIO_PATH, {"Range": "bytes=10-"})
+        assert response.status == HTTPStatus.PARTIAL_CONTENT
+        assert response.getheader("Content-Length") == str(len(AUDIO) - 10)
+        assert body == b""
+        # the connection is still usable after responses without a body
+        assert request(client, "GET", AUDIO_PATH)[1] == AUDIO
+
+
+@pytest.mark.parametrize("server_class", ENGINES)
+def test_keepalive_max_requests(data_dir: Path, server_class, max_keepalive_requests: int):
+    with running_server(server_class) as client:
+        for i in range(max_keepalive_requests):
+            response, _ = request(client, "GET", LOOKUP_PATH)
+            assert response.status == HTTPStatus.OK
+            last = i == max_keepalive_requests - 1
+            assert response.getheader("Connection") == ("close" if last else None)
+        assert is_closed(client)
+
+
+def test_prefetch_audio_without_audio_cache(tmp_path: Path, monkeypatch):
+    monkeypatch.setenv("XDG_DATA_HOME", str(tmp_path))
+    state = ServerState()
+    try:
+        assert not state.audio_cache.enabled
+        # an empty job, so the prefetcher never opens the database
+        status, payload = handle_post_request(state, "/prefetch", b'{"items": [], "audio": true}')
+        assert status == HTTPStatus.ACCEPTED
+        assert json.loads(payload)["audio"] is False
+    finally:
+        state.close()
+
+
+def test_async_server_bind_failure_closes_state(tmp_path: Path, monkeypatch):
+    monkeypatch.setenv("XDG_DATA_HOME", str(tmp_path))
+    closed = []
+    monkeypatch.setattr(ServerState, "close", lambda self: closed.append(self))
+    with socket.create_server(("127.0.0.1", 0)) as taken:
+        with pytest.raises(OSError):
+            AsyncLocalAudioServer(taken.getsockname())
+    assert len(closed) == 1
+
+
+def test_prefetch_leaves_connection_idle(data_dir: Path):
+    state = ServerState()
+    try:
+        body = json.dumps({"items": [{"term": "読む", "reading": "よむ"}]}).encode("utf-8")
+        status, _ = handle_post_request(state, "/prefetch", body)
+        assert status == HTTPStatus.ACCEPTED
+        qcomps = QueryComponents("読む", "よむ", tuple(ALL_SOURCES.keys()), ())
+        deadline = time.monotonic() + 5
+        # stored in the lookup cache once the connection is back in the pool
+        while state.lookup_cache.peek(qcomps) is None:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+
+        with state.db_pool.connection() as conn:
+            assert not conn.in_transaction
+        writer = sqlite3.connect(get_db_file(), timeout=0)
+        writer.execute("BEGIN EXCLUSIVE")
+        writer.rollback()
+        writer.close()
+    finally:
+        state.close()
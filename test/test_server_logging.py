@@ -0,0 +1,89 @@
+import logging
+import logging.handlers
+import random
+from pathlib import Path
+
+import pytest
+
+from plugin import server_logging
+from plugin.config import SERVER_CONFIG
+from plugin.server_logging import log_access, logger, setup_logging, stop_logging
+
+
+@pytest.fixture
+def log_file(tmp_path: Path):
+    """
+    a log file for setup_logging(). Logging is set up again by the next ServerState
+    """
+    # i.e. set up by the ServerState of another test
+    stop_logging()
+    yield tmp_path / "server.log"
+    stop_logging()
+
+
+def read_log(log_file: Path) -> list[str]:
+    # writes out the queued records first
+    stop_logging()
+    if not log_file.exists():
+        return []
+    return log_file.read_text(encoding="utf-8").splitlines()
+
+
+def test_queued_logging(log_file: Path):
+    setup_logging(dict(SERVER_CONFIG, log_level="info", log_file=str(log_file)))
+    # the request threads only put records on the queue, which the listener thread writes to the file
+    assert any(isinstance(handler, logging.handlers.QueueHandler) for handler in logger.handlers)
+    assert not any(isinstance(handler, logging.FileHandler) for handler in logger.handlers)
+
+    logger.warning("Invalid request to %s", "/batch")
+    log_access("GET", "/?term=読む", 200, b'{"type": "audioSourceList", "audioSources": [{}, {}]}', 0.0005, "abc")
+    lines = read_log(log_file)
+    assert len(lines) == 2
+    assert lines[0].endswith("WARNING local_audio: Invalid request to /batch")
+    assert lines[1].endswith("GET /?term=読む 200 results=2 0.50ms id=abc")
+
+
+@pytest.mark.parametrize(
+    "log_level, logged",
+    [
+        ("off", []),
+        ("error", ["error message"]),
+        ("warning", ["error message", "warning message"]),
+        ("info", ["error message", "warning message", "info message", "/access"]),
+        ("debug", ["error message", "warning message", "info message", "/access", "debug message"]),
+    ],
+)
+def test_log_levels(log_file: Path, log_level: str, logged: list[str]):
+    setup_logging(dict(SERVER_CONFIG, log_level=log_level, log_file=str(log_file)))
+    assert logger.level == server_logging.LOG_LEVELS[log_level]
+
+    logger.error("error message")
+    logger.warning("warning message")
+    logger.info("info message")
+    log_access("GET", "/access", 200, None, 0.0)
+    logger.debug("debug message")
+    log = "\n".join(read_log(log_file))
+    messages = ["error message", "warning message", "info message", "/access", "debug message"]
+    assert [message for message in messages if message in log] == logged
+
+
+def test_unknown_log_level(log_file: Path):
+    with pytest.raises(Exception, match="Unknown log level"):
+        setup_logging(dict(SERVER_CONFIG, log_level="verbose", log_file=str(log_file)))
+
+
+@pytest.mark.parametrize("sample_rate", [0, 0.1, 0.5, 1])
+def test_access_log_sampling(log_file: Path, monkeypatch, sample_rate: float):
+    monkeypatch.setattr(server_logging, "random", random.Random(0))
+    setup_logging(
+        dict(SERVER_CONFIG, log_level="info", log_file=str(log_file), access_log_sample_rate=sample_rate)
+    )
+    requests = 2000
+    for _ in range(requests):
+        log_access("GET", "/", 200, None, 0.0)
+    # other records are never sampled
+    logger.warning("warning")
+
+    lines = read_log(log_file)
+    assert lines[-1].endswith("warning")
+    assert len(lines) - 1 == pytest.approx(requests * sample_rate, abs=requests * 0.03)
@@ -0,0 +1,471 @@
+"""
+Benchmarks for the local audio server, for development purposes.
+
+Must be run from the root of the repo, i.e.
+
+$ WO_ANKI=1 python3 -m tools.benchmark load --clients 16 --seconds 10
+
+`load` command:
+    - runs against an already running server (i.e. `run_server.py`)
+    - every client repeatedly looks up a random word, then fetches its first audio file,
+        over one keep-alive connection (like Yomitan does)
+    - use `--pid` to also sample the thread count of the server process (Linux only)
+
+`query` command:
+    - runs execute_query() directly against entries.db (no server needed), and reports the
+        CPU time per lookup, for a mix of lookups with and without a reading / sources / users
+    - use `--rebuild-sql` to rebuild the SQL of every lookup instead of using the cached
+        templates, for comparison
+
+`open` command:
+    - compares how the server's connections are opened: plain read-only connections ("default"),
+        against the mmap_size / cache_size / immutable settings of the config ("tuned"),
+        and the tuned settings after the background warm-up has read the file ("tuned+warmup")
+    - "cold" is the first pass over the lookups, right after evicting entries.db from the
+        OS page cache (uses posix_fadvise, so Linux only). "steady" is the passes after it
+
+`scan` command:
+    - compares how fast the audio files of a source are found: the old Path.rglob() + is_file()
+        walk, against scan_media_files() on one thread and on --workers threads, in files/sec
+    - scans a synthetic tree (like forvo_files, one folder per speaker) in a temporary directory,
+        or an existing folder with `--dir` (i.e. on a network share, where the difference is largest)
+
+`memory` command:
+    - compares the peak memory (RSS) of reading every entry of a large JSON file with json.load(),
+        against iter_json_items(), each in a new process (uses the resource module, so not on Windows)
+    - reads a synthetic file like nhk16_files/entries.json in a temporary directory,
+        or an existing file with `--file` (i.e. jmdict_forms.json)
+    - with `--ajt`, compares json.load() of a synthetic AJT index.json (like shinmeikai8_files)
+        against reading every entry of it with AJTJapaneseSource.get_entries()
+"""
+
+from __future__ import annotations
+
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from urllib.parse import urlencode, urlparse, quote
+
+from plugin.config import ALL_SOURCES, SERVER_CONFIG
+from plugin.consts import HOSTNAME, PORT
+from plugin.db_pool import ConnectionPool
+from plugin.db_utils import execute_query, get_query_template
+from plugin.json_stream import iter_json_items
+from plugin.media_scan import AUDIO_FILE_EXTENSIONS, MEDIA_SCAN_WORKERS, scan_media_files
+from plugin.source.ajt_jp import AJTJapaneseSource
+from plugin.source.audio_source import AudioSourceData
+from plugin.util import QueryComponents, get_db_file
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def print_latencies(name: str, values: list[float]):
+    print(
+        f"{name:>8}: n={len(values):<7} "
+        f"p50={percentile(values, 0.5) * 1000:.2f}ms "
+        f"p95={percentile(values, 0.95) * 1000:.2f}ms "
+        f"p99={percentile(values, 0.99) * 1000:.2f}ms"
+    )
+
+
+def sample_terms(db_path: Path, count: int) -> list[tuple[str, str | None]]:
+    with sqlite3.connect(db_path) as conn:
+        rows = conn.execute(
+            "SELECT expression, reading FROM entries ORDER BY random() LIMIT ?", (count,)
+        ).fetchall()
+    return [(expression, reading) for expression, reading in rows]
+
+
+def get_thread_count(pid: int) -> int | None:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("Threads:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def load_client(
+    terms, deadline: float, lookups: list[float], audio: list[float], errors: list[int], rejected: list[int]
+):
+    conn = http.client.HTTPConnection(HOSTNAME, PORT, timeout=30)
+    while time.perf_counter() < deadline:
+        expression, reading = random.choice(terms)
+        params = {"term": expression}
+        if reading is not None:
+            params["reading"] = reading
+        try:
+            start = time.perf_counter()
+            conn.request("GET", "/?" + urlencode(params))
+            resp = conn.getresponse()
+            body = resp.read()
+            if resp.status == 503: # turned away by the "pool" engine
+                rejected.append(1)
+                continue
+            lookups.append(time.perf_counter() - start)
+
+            sources = json.loads(body)["audioSources"]
+            if not sources:
+                continue
+            path = quote(urlparse(sources[0]["url"]).path)
+            start = time.perf_counter()
+            conn.request("GET", path)
+            resp = conn.getresponse()
+            resp.read()
+            if resp.status == 503:
+                rejected.append(1)
+                continue
+            audio.append(time.perf_counter() - start)
+        except http.client.RemoteDisconnected:
+            # an idle keep-alive connection closed by the server, which browsers simply retry
+            conn.close()
+            conn = http.client.HTTPConnection(HOSTNAME, PORT, timeout=30)
+        except (OSError, http.client.HTTPException):
+            errors.append(1)
+            conn.close()
+            conn = http.client.HTTPConnection(HOSTNAME, PORT, timeout=30)
+    conn.close()
+
+
+def run_load(args):
+    terms = sample_terms(Path(args.db), args.terms)
+    if not terms:
+        print("Database is empty.")
+        return
+
+    lookups: list[float] = []
+    audio: list[float] = []
+    errors: list[int] = []
+    rejected: list[int] = []
+    deadline = time.perf_counter() + args.seconds
+    clients = [
+        threading.Thread(target=load_client, args=(terms, deadline, lookups, audio, errors, rejected))
+        for _ in range(args.clients)
+    ]
+    for client in clients:
+        client.start()
+
+    max_threads = None
+    while any(client.is_alive() for client in clients):
+        if args.pid is not None:
+            threads = get_thread_count(args.pid)
+            if threads is not None:
+                max_threads = max(threads, max_threads or 0)
+        time.sleep(0.1)
+
+    print(f"{args.clients} clients, {args.seconds}s, {len(errors)} errors, {len(rejected)} rejected (503)")
+    print(f"throughput: {(len(lookups) + len(audio)) / args.seconds:.0f} requests/s")
+    print_latencies("lookup", lookups)
+    print_latencies("audio", audio)
+    if max_threads is not None:
+        print(f"max server threads: {max_threads}")
+
+
+def query_shapes(terms: list[tuple[str, str | None]]) -> list[QueryComponents]:
+    """
+    a mix of lookups like the ones Yomitan sends, i.e. with and without a reading,
+    and with the default sources or the `sources` / `user` parameters
+    """
+    all_sources = tuple(ALL_SOURCES.keys())
+    some_sources = all_sources[:3]
+    users = ("akitomo", "strawberrybrown", "skent")
+    qcomps_list = []
+    for i, (expression, reading) in enumerate(terms):
+        shape = i % 4
+        if shape == 0:
+            qcomps_list.append(QueryComponents(expression, reading, all_sources, ()))
+        elif shape == 1:
+            qcomps_list.append(QueryComponents(expression, None, all_sources, ()))
+        elif shape == 2:
+            qcomps_list.append(QueryComponents(expression, reading, some_sources, ()))
+        else:
+            qcomps_list.append(QueryComponents(expression, reading, all_sources, users))
+    return qcomps_list
+
+
+def run_query(args):
+    terms = sample_terms(Path(args.db), args.terms)
+    if not terms:
+        print("Database is empty.")
+        return
+    qcomps_list = query_shapes(terms)
+
+    with sqlite3.connect(Path(args.db).as_uri() + "?mode=ro", uri=True) as conn:
+        for qcomps in qcomps_list: # warm up the page cache
+            execute_query(conn, qcomps)
+
+        latencies = []
+        cpu_start = time.process_time()
+        for _ in range(args.rounds):
+            for qcomps in qcomps_list:
+                if args.rebuild_sql:
+                    get_query_template.cache_clear()
+                start = time.perf_counter()
+                execute_query(conn, qcomps)
+                latencies.append(time.perf_counter() - start)
+        cpu = time.process_time() - cpu_start
+    conn.close()
+
+    print(f"{len(latencies)} lookups, {'rebuilding' if args.rebuild_sql else 'cached'} SQL")
+    print(f"cpu per lookup: {cpu / len(latencies) * 1_000_000:.1f}us")
+    print_latencies("lookup", latencies)
+
+
+def evict_page_cache(db_path: Path) -> bool:
+    if not hasattr(os, "posix_fadvise"):
+        return False
+    fd = os.open(db_path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+    return True
+
+
+def time_lookups(pool: ConnectionPool, qcomps_list: list[QueryComponents]) -> list[float]:
+    latencies = []
+    with pool.connection() as conn:
+        for qcomps in qcomps_list:
+            start = time.perf_counter()
+            execute_query(conn, qcomps)
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def run_open(args):
+    db_path = Path(args.db)
+    terms = sample_terms(db_path, args.terms)
+    if not terms:
+        print("Database is empty.")
+        return
+    qcomps_list = query_shapes(terms)
+
+    tuned = {
+        "mmap_size": int(args.mmap_size_mb * 1024 * 1024),
+        "cache_size": int(args.cache_size_mb * 1024 * 1024),
+        "immutable": args.immutable,
+    }
+    print(
+        f"tuned: mmap_size={args.mmap_size_mb}MB cache_size={args.cache_size_mb}MB "
+        f"immutable={args.immutable}, {len(qcomps_list)} lookups"
+    )
+    for name, pool_args, warm_up in (
+        ("default", {}, False),
+        ("tuned", tuned, False),
+        ("tuned+warmup", tuned, True),
+    ):
+        if not evict_page_cache(db_path):
+            print("Cannot evict the page cache on this platform, cold results are not cold.")
+        pool = ConnectionPool(db_path, **pool_args)
+        if warm_up:
+            start = time.perf_counter()
+            pool.warm_up().join()
+            print(f"{name}: warm-up took {(time.perf_counter() - start) * 1000:.0f}ms")
+
+        start = time.perf_counter()
+        cold = time_lookups(pool, qcomps_list)
+        cold_total = time.perf_counter() - start
+        steady = []
+        for _ in range(args.rounds):
+            steady += time_lookups(pool, qcomps_list)
+        pool.close()
+
+        print(f"{name}: first lookup {cold[0] * 1000:.2f}ms, cold pass {cold_total * 1000:.0f}ms")
+        print_latencies("cold", cold)
+        print_latencies("steady", steady)
+
+
+def make_media_tree(root: Path, files: int, dirs: int):
+    for i in range(files):
+        speaker_dir = root / f"speaker{i % dirs}"
+        if i < dirs:
+            speaker_dir.mkdir()
+        (speaker_dir / f"word{i}.mp3").touch()
+
+
+def rglob_media_files(media_dir: Path) -> list[tuple[str, str, str]]:
+    # AudioSource.find_media_files() before scan_media_files()
+    return [
+        (str(path.relative_to(media_dir)), path.stem, path.parent.name)
+        for path in media_dir.rglob("*")
+        if path.is_file() and path.suffix.lower() in AUDIO_FILE_EXTENSIONS
+    ]
+
+
+def run_scan(args):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if args.dir is None:
+            media_dir = Path(temp_dir)
+            make_media_tree(media_dir, args.files, args.dirs)
+        else:
+            media_dir = Path(args.dir)
+
+        for name, scan in (
+            ("rglob", rglob_media_files),
+            ("scandir", lambda path: list(scan_media_files(path, workers=1))),
+            (f"scandir x{args.workers}", lambda path: list(scan_media_files(path, workers=args.workers))),
+        ):
+            timings = []
+            for _ in range(args.rounds):
+                start = time.perf_counter()
+                found = scan(media_dir)
+                timings.append(time.perf_counter() - start)
+            best = min(timings)
+            print(f"{name:>12}: {len(found)} files in {best * 1000:.0f}ms, {len(found) / best:,.0f} files/sec")
+
+
+def make_entries_json(path: Path, entries: int):
+    # like nhk16_files/entries.json
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("[")
+        for i in range(entries):
+            if i > 0:
+                f.write(", ")
+            entry = {
+                "kana": f"よみ{i}",
+                "kanji": [f"読み{i}", f"詠み{i}"],
+                "kanjiNotUsed": [],
+                "accents": [{
+                    "soundFile": f"{i}.aac",
+                    "accent": [{"pronunciation": f"ヨミ{i}", "silencedMora": [], "pitchAccent": str(i % 3)}],
+                }],
+                "subentries": [],
+            }
+            json.dump(entry, f, ensure_ascii=False)
+        f.write("]")
+
+
+def make_ajt_index(media_dir: Path, entries: int):
+    # like shinmeikai8_files: index.json, with an (empty) audio file per entry in media/.
+    # Written one entry at a time, as the processes that are measured start out with the peak RSS of this one
+    (media_dir / "media").mkdir(parents=True)
+    with open(media_dir / "index.json", "w", encoding="utf-8") as f:
+        f.write('{"meta": {"version": 1}, "headwords": {')
+        for i in range(entries):
+            (media_dir / "media" / f"{i}.ogg").touch()
+            f.write(f'{", " if i > 0 else ""}"読み{i}": ["{i}.ogg"]')
+        f.write('}, "files": {')
+        for i in range(entries):
+            # a distinct kana reading for every entry
+            reading = "".join(chr(ord("あ") + int(digit)) for digit in str(i))
+            ajt_file = {"kana_reading": reading, "pitch_number": str(i % 3)}
+            f.write(f'{", " if i > 0 else ""}"{i}.ogg": {json.dumps(ajt_file, ensure_ascii=False)}')
+        f.write("}}")
+
+
+def read_json_entries(path: str, mode: str) -> tuple[int, int, float]:
+    """
+    runs in a new process: reads every item of the file's top-level array (or object), either with json.load()
+    or iter_json_items() ("stream"), or every entry of the AJT source whose index.json it is ("ajt").
+    Returns the number of items, how much the peak RSS grew (in KiB), and the seconds it took
+    """
+    import resource
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    if mode == "ajt":
+        source = AJTJapaneseSource(AudioSourceData("ajt", str(Path(path).parent), "AJT"))
+        count = sum(1 for _ in source.get_entries())
+    else:
+        with open(path, encoding="utf-8") as f:
+            if mode == "stream":
+                count = sum(1 for _ in iter_json_items(f))
+            else:
+                count = len(json.load(f))
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, and in KiB everywhere else
+    scale = 1024 if sys.platform == "darwin" else 1
+    return count, (peak - baseline) // scale, elapsed
+
+
+def run_memory(args):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        modes = ("json.load", "stream")
+        if args.ajt:
+            path = Path(temp_dir, "index.json")
+            make_ajt_index(Path(temp_dir), args.entries)
+            modes = ("json.load", "ajt")
+        elif args.file is None:
+            path = Path(temp_dir, "entries.json")
+            make_entries_json(path, args.entries)
+        else:
+            path = Path(args.file)
+        print(f"{path.name}: {path.stat().st_size / 1024 / 1024:.1f} MiB")
+
+        # a new process for each, as the peak RSS of a process never goes down
+        context = multiprocessing.get_context("spawn")
+        for name in modes:
+            with context.Pool(1) as pool:
+                count, peak_kib, elapsed = pool.apply(read_json_entries, (str(path), name))
+            print(f"{name:>10}: {count} items in {elapsed:.2f}s, peak RSS +{peak_kib / 1024:.1f} MiB")
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    load = subparsers.add_parser("load", help="load test a running server")
+    load.add_argument("--clients", type=int, default=8)
+    load.add_argument("--seconds", type=float, default=10)
+    load.add_argument("--terms", type=int, default=1000, help="number of distinct words to look up")
+    load.add_argument("--pid", type=int, default=None, help="server process to sample the thread count of")
+    load.add_argument("--db", type=str, default=str(get_db_file()))
+    load.set_defaults(func=run_load)
+
+    query = subparsers.add_parser("query", help="time execute_query() against entries.db")
+    query.add_argument("--terms", type=int, default=2000, help="number of distinct words to look up")
+    query.add_argument("--rounds", type=int, default=5)
+    query.add_argument("--rebuild-sql", action="store_true", help="don't use the cached SQL templates")
+    query.add_argument("--db", type=str, default=str(get_db_file()))
+    query.set_defaults(func=run_query)
+
+    open_ = subparsers.add_parser("open", help="compare cold and steady lookups between connection settings")
+    open_.add_argument("--terms", type=int, default=2000, help="number of distinct words to look up")
+    open_.add_argument("--rounds", type=int, default=3, help="number of steady passes")
+    open_.add_argument("--mmap-size-mb", type=float, default=SERVER_CONFIG["sqlite_mmap_size_mb"])
+    open_.add_argument("--cache-size-mb", type=float, default=SERVER_CONFIG["sqlite_cache_size_mb"])
+    open_.add_argument("--immutable", action="store_true", default=SERVER_CONFIG["sqlite_immutable"])
+    open_.add_argument("--db", type=str, default=str(get_db_file()))
+    open_.set_defaults(func=run_open)
+
+    scan = subparsers.add_parser("scan", help="time finding the audio files of a source")
+    scan.add_argument("--files", type=int, default=100_000, help="size of the synthetic tree")
+    scan.add_argument("--dirs", type=int, default=200, help="number of folders in the synthetic tree")
+    scan.add_argument("--dir", type=str, default=None, help="scan this folder instead of a synthetic tree")
+    scan.add_argument("--workers", type=int, default=MEDIA_SCAN_WORKERS)
+    scan.add_argument("--rounds", type=int, default=3)
+    scan.set_defaults(func=run_scan)
+
+    memory = subparsers.add_parser("memory", help="compare the peak memory of reading a large JSON file")
+    memory.add_argument("--entries", type=int, default=200_000, help="size of the synthetic file")
+    memory.add_argument("--file", type=str, default=None, help="read this file instead of a synthetic file")
+    memory.add_argument("--ajt", action="store_true", help="read a synthetic AJT source instead")
+    memory.set_defaults(func=run_memory)
+
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
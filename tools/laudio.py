@@ -21,6 +21,11 @@ Usage:
 `play` command:
     - directly queries the server with the word (and optionally, reading)
     - cannot add the result to any card, can only play
+`prefetch` command:
+    - asks the server to look up the words in the background, so later lookups are instant
+    - words can be given as `word` or `word:reading`
+    - `--audio` also loads the first audio file of each word into the server's audio cache
+    - `--cancel` cancels all prefetching that hasn't finished yet
 
 Examples:
 
@@ -28,6 +33,8 @@ $ python3 laudio.py current
 $ python3 laudio.py anki 偽物
 $ python3 laudio.py play 偽物
 $ python3 laudio.py play 偽物 にせもの
+$ python3 laudio.py prefetch 偽物:にせもの 本物 --audio
+$ python3 laudio.py prefetch --cancel
 
 Usage (audio selector):
 
@@ -120,6 +127,20 @@ def get_args():
     play = subparsers.add_parser("play")
     play.add_argument("wordreading", type=str, nargs="+", action=required_length(1, 2))
 
+    prefetch = subparsers.add_parser(
+        "prefetch", help="look up words in the background, so later lookups are faster"
+    )
+    prefetch.add_argument("words", type=str, nargs="*", help="word or word:reading")
+    prefetch.add_argument(
+        "--audio", action="store_true", help="also cache the first audio file of each word"
+    )
+    prefetch.add_argument(
+        "--replace", action="store_true", help="cancel any previous prefetching first"
+    )
+    prefetch.add_argument(
+        "--cancel", action="store_true", help="cancel all unfinished prefetching"
+    )
+
     return parser.parse_args()
 
 
@@ -217,6 +238,52 @@ def parse_args(args, config) -> tuple[str | None, str | None, int | None]:
     return word, reading, note_id
 
 
+def prefetch_words(
+    words: list[tuple[str, str | None]], audio: bool = False, replace: bool = False
+) -> int:
+    """
+    asks the server to look up (word, reading) pairs in the background.
+    Returns the id of the prefetch job, which can be passed to cancel_prefetch()
+    """
+    items = [{"term": word, "reading": reading} for word, reading in words]
+    r = requests.post(
+        f"http://{HOSTNAME}:{PORT}/prefetch",
+        json={"items": items, "audio": audio, "replace": replace},
+    )
+    r.raise_for_status()
+    if audio and not r.json()["audio"]:
+        print("Not prefetching audio files: the server's audio cache is disabled (audio_cache_size_mb)")
+    return r.json()["id"]
+
+
+def cancel_prefetch(job_id: int | None = None) -> int:
+    """
+    cancels the given prefetch job (or all of them). Returns the number of cancelled jobs
+    """
+    r = requests.post(
+        f"http://{HOSTNAME}:{PORT}/prefetch/cancel",
+        json={} if job_id is None else {"id": job_id},
+    )
+    r.raise_for_status()
+    return r.json()["cancelled"]
+
+
+def run_prefetch(args):
+    if args.cancel:
+        print(f"Cancelled {cancel_prefetch()} prefetch job(s)")
+        return
+
+    words = []
+    for word in args.words:
+        if ":" in word:
+            word, reading = word.split(":", 1)
+            words.append((word, reading))
+        else:
+            words.append((word, None))
+    job_id = prefetch_words(words, args.audio, args.replace)
+    print(f"Prefetching {len(words)} word(s) (id: {job_id})")
+
+
 class AudioPlayer:
     def __init__(
         self,
@@ -330,6 +397,9 @@ class AudioPlayer:
 def main():
     config = get_global_config()
     args = get_args()
+    if args.command == "prefetch":
+        run_prefetch(args)
+        return
     word, reading, note_id = parse_args(args, config)
     # TODO: accept either word is None or reading is None
     if word is None: